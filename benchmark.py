@@ -0,0 +1,485 @@
+#!/usr/bin/python
+
+# Copyright (c) 2013, Paul Michael Furley <paul@paulfurley.com>
+# All rights reserved.
+
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+
+# - Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+# - Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# - Neither the name of the <ORGANIZATION> nor the names of its contributors
+#   may be used to endorse or promote products derived from this software
+#   without specific prior written permission.
+
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+DEFAULT_SCENARIOS = []  # Empty list means 'all'
+DEFAULT_ROWS = None     # None means each scenario's own row count
+DEFAULT_ENGINE = 'pybloom'
+DEFAULT_OUTPUT = '-'    # '-' means write results to stdout
+DEFAULT_BASELINE = ''   # Empty means don't compare with earlier results
+DEFAULT_TOLERANCE = 0.1
+DEFAULT_SEED = 1
+
+_VERBOSE = False       # switched by the --verbose argument
+
+_EXITCODE_OK = 0
+_EXITCODE_IMPORT_ERROR = 1
+_EXITCODE_INVALID_ARG = 2
+_EXITCODE_MISSING_ARG = 3
+_EXITCODE_REGRESSION = 4
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import getopt
+import hashlib
+import platform
+import resource
+import tempfile
+import multiprocessing
+
+import bloom_indexer
+from bloom_indexer import (InvalidArgument, MissingArgument, ENGINES,
+                           create_index)
+from build_stats import BuildStats
+
+RESULTS_VERSION = 1
+
+# Stages of create_index timed by its BuildStats, in pipeline order.
+STAGES = ('parse', 'expand', 'dedup', 'insert', 'write')
+
+SCENARIOS = [
+    {'name': 'narrow', 'rows': 100000, 'columns': 3, 'cardinality': 10000,
+     'domain_ratio': 0.0, 'value_length': 12},
+    {'name': 'wide', 'rows': 20000, 'columns': 40, 'cardinality': 5000,
+     'domain_ratio': 0.0, 'value_length': 8},
+    {'name': 'domains', 'rows': 100000, 'columns': 2, 'cardinality': 50000,
+     'domain_ratio': 0.8, 'value_length': 24},
+    {'name': 'unique', 'rows': 100000, 'columns': 2, 'cardinality': 1000000,
+     'domain_ratio': 0.0, 'value_length': 32},
+]
+
+_TLDS = ('com', 'net', 'org', 'co.uk', 'de', 'io')
+
+
+class Conf:
+    """Provides the keys to the config dictionary."""
+    Scenarios = 'scenarios'
+    Rows = 'rows'
+    Engine = 'engine'
+    Output = 'output'
+    Baseline = 'baseline'
+    Tolerance = 'tolerance'
+    Seed = 'seed'
+
+
+def main():
+    try:
+        config = parse_arguments(sys.argv)
+        if not config:
+            sys.exit(_EXITCODE_OK)
+
+        scenarios = [dict(scenario) for scenario in SCENARIOS
+                     if not config[Conf.Scenarios] or
+                     scenario['name'] in config[Conf.Scenarios]]
+        for scenario in scenarios:
+            if config[Conf.Rows] is not None:
+                scenario['rows'] = config[Conf.Rows]
+
+        results = run_benchmarks(scenarios, config[Conf.Engine],
+                                 config[Conf.Seed])
+
+        if config[Conf.Output] == '-':
+            json.dump(results, sys.stdout, indent=2, sort_keys=True)
+            sys.stdout.write('\n')
+        else:
+            with open(config[Conf.Output], 'wb') as f:
+                json.dump(results, f, indent=2, sort_keys=True)
+
+        if config[Conf.Baseline]:
+            with open(config[Conf.Baseline], 'rb') as f:
+                baseline = json.load(f)
+            regressions = compare_results(baseline, results,
+                                          config[Conf.Tolerance])
+            for regression in regressions:
+                sys.stderr.write("Regression: %s\n" % regression)
+            if regressions:
+                sys.exit(_EXITCODE_REGRESSION)
+
+    except InvalidArgument, e:
+        sys.stderr.write("\nInvalid argument: %s\n" % e)
+        usage()
+        sys.exit(_EXITCODE_INVALID_ARG)
+
+    except MissingArgument, e:
+        sys.stderr.write("\nMissing required argument(s): %s\n" % e)
+        usage()
+        sys.exit(_EXITCODE_MISSING_ARG)
+
+
+def parse_arguments(argv):
+    """
+    Parse out whatever arguments are available on the command line and call the
+    approriate validate function on them. Throw InvalidArgument or
+    MissingArgument.
+    """
+    try:
+        (opts, args) = getopt.getopt(
+            argv[1:],
+            "c:n:E:o:b:t:S:hv",
+            ['scenarios=', 'rows=', 'engine=', 'output=', 'baseline=',
+             'tolerance=', 'seed=', 'help', 'verbose'])
+    except getopt.GetoptError as err:
+        raise InvalidArgument(err)
+
+    if args:
+        raise InvalidArgument(' '.join(args))
+
+    config = {
+        Conf.Scenarios: DEFAULT_SCENARIOS,
+        Conf.Rows: DEFAULT_ROWS,
+        Conf.Engine: DEFAULT_ENGINE,
+        Conf.Output: DEFAULT_OUTPUT,
+        Conf.Baseline: DEFAULT_BASELINE,
+        Conf.Tolerance: DEFAULT_TOLERANCE,
+        Conf.Seed: DEFAULT_SEED,
+    }
+
+    for (opt, arg) in opts:
+        if opt in ('-c', '--scenarios'):
+            config[Conf.Scenarios] = validate_scenarios(arg)
+
+        elif opt in ('-n', '--rows'):
+            config[Conf.Rows] = validate_positive_int('rows', arg)
+
+        elif opt in ('-E', '--engine'):
+            config[Conf.Engine] = bloom_indexer.validate_engine(arg)
+
+        elif opt in ('-o', '--output'):
+            config[Conf.Output] = arg
+
+        elif opt in ('-b', '--baseline'):
+            if not os.path.isfile(arg):
+                raise InvalidArgument("baseline is not a file: '%s'" % arg)
+            config[Conf.Baseline] = arg
+
+        elif opt in ('-t', '--tolerance'):
+            config[Conf.Tolerance] = validate_tolerance(arg)
+
+        elif opt in ('-S', '--seed'):
+            config[Conf.Seed] = validate_positive_int('seed', arg)
+
+        elif opt in ('-v', '--verbose'):
+            global _VERBOSE
+            _VERBOSE = True
+
+        elif opt in ('-h', '--help'):
+            usage()
+            return None
+
+    return config
+
+
+def validate_scenarios(arg):
+    """
+    Convert a comma-separated string of scenario names into a list, checking
+    that each is known. The special value 'all' should return an empty list.
+
+    >>> validate_scenarios('narrow,wide')
+    ['narrow', 'wide']
+
+    >>> validate_scenarios('all')
+    []
+
+    >>> validate_scenarios('tiny')
+    Traceback (most recent call last):
+    ...
+    InvalidArgument: unknown scenario 'tiny', expected some of narrow, wide, domains, unique
+    """
+    if arg.lower() == 'all':
+        return []
+
+    names = [scenario['name'] for scenario in SCENARIOS]
+    scenarios = arg.split(',')
+    for scenario in scenarios:
+        if scenario not in names:
+            raise InvalidArgument("unknown scenario '%s', expected some of "
+                                  "%s" % (scenario, ', '.join(names)))
+    return scenarios
+
+
+def validate_positive_int(name, arg):
+    """
+    Convert to integer and validate that the value is >= 1
+    >>> validate_positive_int('rows', '10')
+    10
+
+    >>> validate_positive_int('rows', '0')
+    Traceback (most recent call last):
+    ...
+    InvalidArgument: rows must be at least 1: '0'
+    """
+    try:
+        value = int(arg)
+    except ValueError:
+        raise InvalidArgument("%s not an integer: '%s'" % (name, arg))
+
+    if value < 1:
+        raise InvalidArgument("%s must be at least 1: '%s'" % (name, arg))
+
+    return value
+
+
+def validate_tolerance(arg):
+    """
+    Convert to float and validate it's not negative.
+    >>> validate_tolerance('0.25')
+    0.25
+
+    >>> validate_tolerance('-1')
+    Traceback (most recent call last):
+    ...
+    InvalidArgument: tolerance cannot be < 0: '-1'
+    """
+    try:
+        tolerance = float(arg)
+    except ValueError:
+        raise InvalidArgument("tolerance not a float: '%s'" % arg)
+
+    if tolerance < 0:
+        raise InvalidArgument("tolerance cannot be < 0: '%s'" % arg)
+
+    return tolerance
+
+
+def usage():
+    text = (
+        "\nUsage: %s [-c <scenario,...>] [-o results.json]\n\n"
+        "  -c, --scenarios=NAME1,NAME2      "
+        "scenarios to run, from %s [default all]\n"
+        "  -n, --rows=NUMBER                "
+        "override the number of rows in each scenario\n"
+        "  -E, --engine=NAME                "
+        "filter engine, one of %s [default %s]\n"
+        "  -o, --output=FILENAME            "
+        "write JSON results to FILENAME [default stdout]\n"
+        "  -b, --baseline=FILENAME          "
+        "compare with earlier JSON results in FILENAME\n"
+        "  -t, --tolerance=RATIO            "
+        "slowdown allowed before reporting a regression [default %s]\n"
+        "  -S, --seed=NUMBER                "
+        "seed for the synthetic CSV generator [default %d]\n"
+        "  -v, --verbose                    "
+        "produce output to stderr\n"
+        "  -h, --help                       "
+        "display this message.\n\n" % (
+            sys.argv[0], ', '.join(s['name'] for s in SCENARIOS),
+            ', '.join(ENGINES), DEFAULT_ENGINE, DEFAULT_TOLERANCE,
+            DEFAULT_SEED))
+    sys.stderr.write(text)
+
+
+def debug(text):
+    """Print text to stderr if _VERBOSE has been set."""
+    if _VERBOSE:
+        sys.stderr.write(text)
+
+
+def generate_csv(out_file, rows, columns, cardinality, domain_ratio,
+                 value_length, delimiter=';', seed=DEFAULT_SEED):
+    """
+    Write a synthetic CSV file with a header line and rows lines of columns
+    fields to the file object out_file. Each field is drawn from cardinality
+    distinct values per column; a domain_ratio fraction of those are domain
+    names, and the rest are tokens of value_length characters. The output is
+    the same for the same seed.
+
+    >>> from cStringIO import StringIO
+    >>> out = StringIO()
+    >>> generate_csv(out, 2, 2, 10, 0.5, 12, seed=1)
+    >>> print out.getvalue(),
+    field1;field2
+    81c996800339;www.796a.org
+    86e449378833;def474a313bf
+    """
+    rand = random.Random(seed)
+    out_file.write(delimiter.join('field%d' % column
+                                  for column in xrange(1, columns + 1)))
+    out_file.write('\n')
+    for row in xrange(rows):
+        out_file.write(delimiter.join(
+            synthetic_value(rand.randrange(cardinality), column, domain_ratio,
+                            value_length)
+            for column in xrange(columns)))
+        out_file.write('\n')
+
+
+def synthetic_value(number, column, domain_ratio, value_length):
+    """
+    Return the synthetic value numbered number in the given column: a domain
+    name for a domain_ratio fraction of numbers, otherwise a hex token of
+    value_length characters.
+    """
+    digest = hashlib.md5('%d:%d' % (column, number)).hexdigest()
+    token = (digest * (value_length // len(digest) + 1))[:value_length]
+    if int(digest[:8], 16) < domain_ratio * 0x100000000:
+        label_length = max(1, value_length - 8)
+        return 'www.%s.%s' % (token[:label_length],
+                              _TLDS[number % len(_TLDS)])
+    return token
+
+
+def run_benchmarks(scenarios, engine=DEFAULT_ENGINE, seed=DEFAULT_SEED):
+    """
+    Run each scenario with run_scenario and return the results as a
+    JSON-serialisable dictionary.
+    """
+    results = {
+        'version': RESULTS_VERSION,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'engine': engine,
+        'scenarios': {},
+    }
+    for scenario in scenarios:
+        debug("Running scenario %s\n" % scenario['name'])
+        results['scenarios'][scenario['name']] = run_scenario(
+            scenario, engine, seed)
+    return results
+
+
+def run_scenario(scenario, engine=DEFAULT_ENGINE, seed=DEFAULT_SEED):
+    """
+    Generate the CSV for scenario and build its indexes with create_index in
+    a separate process (see measure_create_index), so that the peak memory
+    is that of the build alone, returning a dictionary of results.
+    """
+    tmpdir = tempfile.mkdtemp(prefix='bloom-benchmark-')
+    try:
+        infile = os.path.join(tmpdir, 'bench.csv')
+        with open(infile, 'wb') as f:
+            generate_csv(f, scenario['rows'], scenario['columns'],
+                         scenario['cardinality'], scenario['domain_ratio'],
+                         scenario['value_length'], seed=seed)
+        size = os.path.getsize(infile)
+        recursive = scenario['domain_ratio'] > 0
+
+        build = _call_in_child(measure_create_index, infile, engine,
+                               recursive)
+    finally:
+        shutil.rmtree(tmpdir)
+
+    elapsed = build['seconds']
+    return {
+        'params': scenario,
+        'bytes': size,
+        'seconds': elapsed,
+        'rows_per_second': scenario['rows'] / elapsed,
+        'mb_per_second': size / elapsed / (1024 * 1024),
+        'peak_rss_kb': build['peak_rss_kb'],
+        'stages': build['stages'],
+    }
+
+
+def measure_create_index(infile, engine, recursive_domains):
+    """
+    Run create_index over infile, returning the seconds it took, the time
+    spent in each of STAGES as its BuildStats recorded them, and the peak
+    resident memory of this process. Run it in a fresh process, so that the
+    peak is not that of earlier work.
+    """
+    stats = BuildStats()
+    start = time.time()
+    with open(infile, 'rU') as csvfile:
+        create_index(infile, csvfile,
+                     bloom_indexer.DEFAULT_FALSE_POSITIVE_RATE, 1, [], ';',
+                     recursive_domains, engine=engine, stats=stats)
+    stages = dict.fromkeys(STAGES, 0.0)
+    stages.update(stats.stages)
+    return {
+        'seconds': time.time() - start,
+        'stages': stages,
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+
+def _call_in_child(function, *args):
+    """
+    Return function(*args), called in a separate process. An exception it
+    raises is raised again here.
+    """
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_run_in_child,
+                                      args=(queue, function, args))
+    process.start()
+    result = queue.get()
+    process.join()
+    if isinstance(result, Exception):
+        raise result
+    return result
+
+
+def _run_in_child(queue, function, args):
+    try:
+        queue.put(function(*args))
+    except Exception, e:
+        queue.put(e)
+
+
+def compare_results(baseline, results, tolerance=DEFAULT_TOLERANCE):
+    """
+    Return a list of descriptions of each scenario or stage present in both
+    baseline and results which became more than tolerance slower.
+
+    >>> old = {'scenarios': {'a': {'seconds': 1.0, 'stages': {'parse': 0.5}}}}
+    >>> new = {'scenarios': {'a': {'seconds': 1.5, 'stages': {'parse': 0.5}}}}
+    >>> compare_results(old, new)
+    ['a: total 1.000s -> 1.500s (+50%)']
+    """
+    regressions = []
+    for (name, result) in sorted(results['scenarios'].items()):
+        old = baseline['scenarios'].get(name)
+        if old is None:
+            continue
+
+        timings = [('total', old['seconds'], result['seconds'])]
+        for stage in STAGES:
+            if stage in old['stages'] and stage in result['stages']:
+                timings.append((stage, old['stages'][stage],
+                                result['stages'][stage]))
+
+        for (what, before, after) in timings:
+            if before > 0 and after > before * (1 + tolerance):
+                regressions.append("%s: %s %.3fs -> %.3fs (+%.0f%%)" % (
+                    name, what, before, after,
+                    100 * (after - before) / before))
+    return regressions
+
+
+if __name__ == '__main__':
+    if bloom_indexer.BloomFilter is None:
+        sys.stderr.write("\nError: Failed to import pybloom: %s\n"
+                         "Have you installed 'python-bloomfilter'?\n\n" %
+                         bloom_indexer._PYBLOOM_IMPORT_ERROR)
+        usage()
+        sys.exit(_EXITCODE_IMPORT_ERROR)
+    else:
+        main()
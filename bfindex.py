@@ -0,0 +1,381 @@
+#!/usr/bin/python
+
+# Copyright (c) 2013, Paul Michael Furley <paul@paulfurley.com>
+# All rights reserved.
+
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+
+# - Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+# - Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# - Neither the name of the <ORGANIZATION> nor the names of its contributors
+#   may be used to endorse or promote products derived from this software
+#   without specific prior written permission.
+
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Engine-independent helpers for working with filters and the .bfindex files
+they are stored in, whichever engine (pybloom, numpy_bloom, blocked_bloom or
+fingerprint_filters) built them.
+"""
+
+from struct import pack, unpack, calcsize
+
+from filter_file import (is_typed_filter, read_filter_type,
+                         TYPE_BLOCKED_BLOOM, TYPE_CUCKOO, TYPE_XOR,
+                         TYPE_BINARY_FUSE, FILTER_TYPE_NAMES)
+
+try:
+    from pybloom import BloomFilter
+except ImportError:
+    BloomFilter = None
+
+try:
+    from numpy_bloom import NumpyBloomFilter, SCHEME_PYBLOOM
+    from blocked_bloom import BlockedBloomFilter
+    from fingerprint_filters import CuckooFilter, XorFilter, BinaryFuseFilter
+except ImportError:
+    NumpyBloomFilter = None
+    BlockedBloomFilter = None
+    CuckooFilter = XorFilter = BinaryFuseFilter = None
+
+# Each new layer of a LayeredBloomFilter is at least this many times larger
+# than the one before it.
+LAYER_GROWTH = 2
+
+_LAYERED_MAGIC = 'BFLY'
+_LAYERED_VERSION = 1
+_LAYERED_FILE_FMT = '<4sBxxxdQ'
+
+
+def read_filter(f, n=-1):
+    """
+    Read a filter of any supported kind from the current position of file
+    object f, which must be seekable, reading at most n bytes if n > 0.
+    """
+    start = f.tell()
+    magic = f.read(len(_LAYERED_MAGIC))
+    f.seek(start)
+    if magic == _LAYERED_MAGIC:
+        return LayeredBloomFilter.fromfile(f)
+    return _read_single_filter(f, n)
+
+
+def _read_single_filter(f, n=-1):
+    """
+    Read a filter which is not layered from file object f, reading at most
+    n bytes if n > 0.
+    """
+    start = f.tell()
+    magic = f.read(len(_LAYERED_MAGIC))
+    f.seek(start)
+    if is_typed_filter(magic):
+        return typed_filter_class(read_filter_type(f)).fromfile(f, n)
+    elif NumpyBloomFilter is not None:
+        return NumpyBloomFilter.fromfile(f, n)
+    return BloomFilter.fromfile(f, n)
+
+
+def _typed_filter_classes():
+    """Return the class implementing each typed filter type, or None."""
+    return {
+        TYPE_BLOCKED_BLOOM: BlockedBloomFilter,
+        TYPE_CUCKOO: CuckooFilter,
+        TYPE_XOR: XorFilter,
+        TYPE_BINARY_FUSE: BinaryFuseFilter,
+    }
+
+
+def typed_filter_class(filter_type):
+    """Return the class implementing a typed filter_type."""
+    classes = _typed_filter_classes()
+    if filter_type not in FILTER_TYPE_NAMES:
+        raise ValueError("Unknown filter type %d" % filter_type)
+    if classes[filter_type] is None:
+        raise ValueError("Reading %s filters requires numpy" %
+                         FILTER_TYPE_NAMES[filter_type])
+    return classes[filter_type]
+
+
+def load_filter(path, use_mmap=False):
+    """
+    Load the filter in the file named by path. With use_mmap, and when NumPy
+    is available, the filter's bits are memory mapped rather than read; such
+    filters are read-only.
+    """
+    if use_mmap and NumpyBloomFilter is not None:
+        return mmap_filter(path)
+
+    with open(path, 'rb') as f:
+        return read_filter(f)
+
+
+def mmap_filter(path, offset=0, length=None):
+    """
+    Memory map the filter of any supported kind at offset in the file named
+    by path, length bytes long or running to the end of the file. Requires
+    NumPy.
+    """
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        magic = f.read(len(_LAYERED_MAGIC))
+    if magic == _LAYERED_MAGIC:
+        return LayeredBloomFilter.mmapfile(path, offset)
+    return _mmap_single_filter(path, offset, length)
+
+
+def _mmap_single_filter(path, offset=0, length=None):
+    """Memory map a filter which is not layered, as load_filter does."""
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        magic = f.read(len(_LAYERED_MAGIC))
+        f.seek(offset)
+        if is_typed_filter(magic):
+            filter_class = typed_filter_class(read_filter_type(f))
+        else:
+            filter_class = NumpyBloomFilter
+    return filter_class.mmapfile(path, offset, length)
+
+
+def probe_many(bloom_filter, keys):
+    """Return a list saying whether each of keys is in bloom_filter."""
+    if hasattr(bloom_filter, 'contains_many'):
+        return list(bloom_filter.contains_many(keys))
+    return [key in bloom_filter for key in keys]
+
+
+def add_values(bloom_filter, values):
+    """Add each of values to bloom_filter, in one batch where supported."""
+    if hasattr(bloom_filter, 'add_many'):
+        bloom_filter.add_many(values)
+    else:
+        for value in values:
+            bloom_filter.add(value)
+
+
+def filter_kind(bloom_filter):
+    """
+    Return the kind of bloom_filter: 'layered', one of the typed filter
+    names in filter_file.FILTER_TYPE_NAMES, or the engine which built a
+    classic Bloom filter ('numpy', 'numpy-compat' or 'pybloom').
+    """
+    if isinstance(bloom_filter, LayeredBloomFilter):
+        return 'layered'
+    if NumpyBloomFilter is not None:
+        for (filter_type, filter_class) in _typed_filter_classes().items():
+            if isinstance(bloom_filter, filter_class):
+                return FILTER_TYPE_NAMES[filter_type]
+        if isinstance(bloom_filter, NumpyBloomFilter):
+            if bloom_filter.scheme == SCHEME_PYBLOOM:
+                return 'numpy-compat'
+            return 'numpy'
+    return 'pybloom'
+
+
+def estimated_error_rate(bloom_filter):
+    """
+    Return the false positive rate implied by the bits currently set in
+    bloom_filter, rather than the rate it was designed for.
+    """
+    if hasattr(bloom_filter, 'estimated_error_rate'):
+        return bloom_filter.estimated_error_rate()
+
+    bits_per_slice = bloom_filter.bits_per_slice
+    rate = 1.0
+    for offset in xrange(0, bloom_filter.num_bits, bits_per_slice):
+        rate *= (bloom_filter.bitarray[offset:offset + bits_per_slice].count()
+                 / float(bits_per_slice))
+    return rate
+
+
+def bit_counts(bloom_filter):
+    """
+    Return a tuple of (bits set, total bits) for bloom_filter. For
+    fingerprint filters, the bits of occupied entries count as set.
+    """
+    if isinstance(bloom_filter, LayeredBloomFilter):
+        counts = [bit_counts(layer) for layer in bloom_filter.layers]
+        return (sum(c[0] for c in counts), sum(c[1] for c in counts))
+    elif hasattr(bloom_filter, 'fill_ratio'):
+        return (int(bloom_filter.fill_ratio() * bloom_filter.num_bits + 0.5),
+                bloom_filter.num_bits)
+    return (bloom_filter.bitarray.count(), bloom_filter.num_bits)
+
+
+def new_layer_like(bloom_filter, capacity, error_rate):
+    """Return an empty filter of the same engine and scheme as bloom_filter."""
+    if BlockedBloomFilter is not None and isinstance(
+            bloom_filter, (BlockedBloomFilter, CuckooFilter, XorFilter,
+                           BinaryFuseFilter)):
+        return bloom_filter.__class__(capacity, error_rate)
+    elif NumpyBloomFilter is not None and isinstance(bloom_filter,
+                                                     NumpyBloomFilter):
+        return NumpyBloomFilter(capacity, error_rate,
+                                scheme=bloom_filter.scheme)
+    return BloomFilter(capacity=capacity, error_rate=error_rate)
+
+
+def reserve_capacity(bloom_filter, num_new, error_rate):
+    """
+    Return a filter holding everything in bloom_filter which can take
+    num_new more distinct values while keeping the false positive rate
+    within error_rate. That is bloom_filter itself if it has room, otherwise
+    a LayeredBloomFilter built on top of it.
+    """
+    if not isinstance(bloom_filter, LayeredBloomFilter):
+        if bloom_filter.count + num_new <= bloom_filter.capacity:
+            return bloom_filter
+        bloom_filter = LayeredBloomFilter(error_rate, [bloom_filter])
+    bloom_filter.error_rate = error_rate
+    bloom_filter.reserve(num_new)
+    return bloom_filter
+
+
+class LayeredBloomFilter(object):
+    """
+    A stack of filters which grows by adding layers rather than rebuilding.
+    Only the newest layer accepts values. The error budget is split up front:
+    the k-th layer added is built for error_rate / 2**k, so adding a layer
+    never depends on how full the older ones happen to be. The combined false
+    positive rate, bounded by the sum over all layers, stays below that of
+    the first layer plus error_rate however many layers are added.
+    """
+
+    def __init__(self, error_rate, layers):
+        self.error_rate = error_rate
+        self.layers = list(layers)
+
+    @property
+    def capacity(self):
+        return sum(layer.capacity for layer in self.layers)
+
+    @property
+    def count(self):
+        return sum(layer.count for layer in self.layers)
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, key):
+        for layer in reversed(self.layers):
+            if key in layer:
+                return True
+        return False
+
+    def contains_many(self, keys):
+        """Return a list saying whether each of keys is in any layer."""
+        keys = list(keys)
+        found = [False] * len(keys)
+        for layer in self.layers:
+            found = [a or b for (a, b) in zip(found, probe_many(layer, keys))]
+        return found
+
+    def add(self, key):
+        """
+        Add a key to the newest layer unless some layer already holds it.
+        Returns True if the key was (probably) already present.
+        """
+        if key in self:
+            return True
+        self.layers[-1].add(key)
+        return False
+
+    def add_many(self, values):
+        """Add each of values which is not already in some layer."""
+        values = list(values)
+        present = self.contains_many(values)
+        add_values(self.layers[-1],
+                   [value for (value, found) in zip(values, present)
+                    if not found])
+
+    def estimated_error_rate(self):
+        """
+        Return the chance that a key absent from every layer is (falsely)
+        found in at least one of them, given the bits currently set.
+        """
+        miss = 1.0
+        for layer in self.layers:
+            miss *= 1 - estimated_error_rate(layer)
+        return 1 - miss
+
+    def reserve(self, num_new):
+        """
+        Make sure the newest layer has room for num_new more values, adding
+        a layer if it does not.
+        """
+        newest = self.layers[-1]
+        if newest.count + num_new <= newest.capacity:
+            return
+
+        capacity = max(num_new, LAYER_GROWTH * newest.capacity)
+        error_rate = self.error_rate / 2.0 ** len(self.layers)
+        self.layers.append(new_layer_like(newest, capacity, error_rate))
+
+    def tofile(self, f):
+        """
+        Write the layered filter to file object f: a header, the byte length
+        of each layer, then each layer as written by its own tofile.
+        """
+        f.write(pack(_LAYERED_FILE_FMT, _LAYERED_MAGIC, _LAYERED_VERSION,
+                     self.error_rate, len(self.layers)))
+        lengths_pos = f.tell()
+        lengths_fmt = '<' + 'Q' * len(self.layers)
+        f.write('\0' * calcsize(lengths_fmt))
+        lengths = []
+        for layer in self.layers:
+            begin = f.tell()
+            layer.tofile(f)
+            lengths.append(f.tell() - begin)
+        end = f.tell()
+        f.seek(lengths_pos)
+        f.write(pack(lengths_fmt, *lengths))
+        f.seek(end)
+
+    @classmethod
+    def _read_directory(cls, f):
+        """Read the header and layer lengths from file object f."""
+        (magic, version, error_rate, num_layers) = unpack(
+            _LAYERED_FILE_FMT, f.read(calcsize(_LAYERED_FILE_FMT)))
+        if magic != _LAYERED_MAGIC or version != _LAYERED_VERSION:
+            raise ValueError("Not a version %d layered filter" %
+                             _LAYERED_VERSION)
+        lengths_fmt = '<' + 'Q' * num_layers
+        lengths = unpack(lengths_fmt, f.read(calcsize(lengths_fmt)))
+        return (error_rate, lengths)
+
+    @classmethod
+    def fromfile(cls, f):
+        """Read a layered filter written by tofile from file object f."""
+        (error_rate, lengths) = cls._read_directory(f)
+        return cls(error_rate, [_read_single_filter(f, length)
+                                for length in lengths])
+
+    @classmethod
+    def mmapfile(cls, path, offset=0):
+        """
+        Open the layered filter at offset in the file named by path with
+        each layer memory mapped.
+        """
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            (error_rate, lengths) = cls._read_directory(f)
+            offset = f.tell()
+        layers = []
+        for length in lengths:
+            layers.append(_mmap_single_filter(path, offset, length))
+            offset += length
+        return cls(error_rate, layers)
@@ -0,0 +1,379 @@
+#!/usr/bin/python
+
+# Copyright (c) 2013, Paul Michael Furley <paul@paulfurley.com>
+# All rights reserved.
+
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+
+# - Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+# - Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# - Neither the name of the <ORGANIZATION> nor the names of its contributors
+#   may be used to endorse or promote products derived from this software
+#   without specific prior written permission.
+
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+DEFAULT_OPERATION = None  # None means only report on the indexes
+DEFAULT_OUTPUT = None
+DEFAULT_REPORT = 'text'
+
+OPERATIONS = ('union', 'intersection')
+REPORT_FORMATS = ('json', 'text')
+
+_VERBOSE = False       # switched by the --verbose argument
+
+_EXITCODE_OK = 0
+_EXITCODE_IMPORT_ERROR = 1
+_EXITCODE_INVALID_ARG = 2
+_EXITCODE_MISSING_ARG = 3
+
+import os
+import sys
+import json
+import getopt
+from bfindex import mmap_filter, filter_kind, bit_counts
+from index_container import is_container
+from shards import is_shard_manifest
+from generations import is_generation_manifest
+from pipeline import write_atomically
+from bloom_indexer import InvalidArgument, MissingArgument
+from bloom_query import validate_index_file
+
+try:
+    from numpy_bloom import NumpyBloomFilter
+    from blocked_bloom import BlockedBloomFilter
+except ImportError, e:
+    NumpyBloomFilter = None
+    _NUMPY_IMPORT_ERROR = e
+
+
+class Conf:
+    """Provides the keys to the config dictionary."""
+    Indexes = 'indexes'
+    Operation = 'operation'
+    Output = 'output'
+    Report = 'report'
+
+
+def main():
+    try:
+        config = parse_arguments(sys.argv)
+        if not config:
+            sys.exit(_EXITCODE_OK)
+
+        report = combine_index_files(config[Conf.Indexes],
+                                     config[Conf.Operation],
+                                     config[Conf.Output])
+        write_report(report, config[Conf.Report])
+
+    except InvalidArgument, e:
+        sys.stderr.write("\nInvalid argument: %s\n" % e)
+        usage()
+        sys.exit(_EXITCODE_INVALID_ARG)
+
+    except MissingArgument, e:
+        sys.stderr.write("\nMissing required argument(s): %s\n" % e)
+        usage()
+        sys.exit(_EXITCODE_MISSING_ARG)
+
+
+def parse_arguments(argv):
+    """
+    Parse out whatever arguments are available on the command line and call the
+    approriate validate function on them. Throw InvalidArgument or
+    MissingArgument.
+    """
+    try:
+        (opts, args) = getopt.getopt(
+            argv[1:],
+            "b:UIo:hv",
+            ['index=', 'union', 'intersection', 'output=', 'report=',
+             'help', 'verbose'])
+    except getopt.GetoptError as err:
+        raise InvalidArgument(err)
+
+    if args:
+        raise InvalidArgument(' '.join(args))
+
+    config = {
+        Conf.Indexes: [],
+        Conf.Operation: DEFAULT_OPERATION,
+        Conf.Output: DEFAULT_OUTPUT,
+        Conf.Report: DEFAULT_REPORT,
+    }
+
+    for (opt, arg) in opts:
+        if opt in ('-b', '--index'):
+            config[Conf.Indexes].append(validate_index_file(arg))
+
+        elif opt in ('-U', '--union', '-I', '--intersection'):
+            operation = 'union' if opt in ('-U', '--union') else 'intersection'
+            if config[Conf.Operation] not in (None, operation):
+                raise InvalidArgument("union and intersection are exclusive")
+            config[Conf.Operation] = operation
+
+        elif opt in ('-o', '--output'):
+            config[Conf.Output] = arg
+
+        elif opt == '--report':
+            config[Conf.Report] = validate_report(arg)
+
+        elif opt in ('-v', '--verbose'):
+            global _VERBOSE
+            _VERBOSE = True
+
+        elif opt in ('-h', '--help'):
+            usage()
+            return None
+
+    if not config[Conf.Indexes]:
+        raise MissingArgument(Conf.Indexes)
+
+    if config[Conf.Operation] is None:
+        if config[Conf.Output] is not None:
+            raise InvalidArgument("output needs union or intersection")
+    else:
+        if config[Conf.Output] is None:
+            raise MissingArgument(Conf.Output)
+        validate_output(config[Conf.Output], config[Conf.Indexes])
+        if len(config[Conf.Indexes]) < 2:
+            raise InvalidArgument("%s needs at least two indexes" %
+                                  config[Conf.Operation])
+
+    return config
+
+
+def validate_report(arg):
+    """
+    Validate that the report format is one of REPORT_FORMATS.
+
+    >>> validate_report('json')
+    'json'
+    >>> validate_report('xml')
+    Traceback (most recent call last):
+    ...
+    InvalidArgument: report must be one of json, text: 'xml'
+    """
+    if arg not in REPORT_FORMATS:
+        raise InvalidArgument("report must be one of %s: '%s'" % (
+            ', '.join(REPORT_FORMATS), arg))
+    return arg
+
+
+def validate_output(arg, indexes):
+    """
+    Validate that the output filename does not name one of the indexes, so
+    that combining them never overwrites a source.
+
+    >>> validate_output('/tmp/a.bfindex', ['/tmp/b.bfindex'])
+    '/tmp/a.bfindex'
+    >>> validate_output('/tmp/../tmp/a.bfindex', ['/tmp/a.bfindex'])
+    Traceback (most recent call last):
+    ...
+    InvalidArgument: output is one of the indexes: '/tmp/../tmp/a.bfindex'
+    """
+    if os.path.realpath(arg) in [os.path.realpath(i) for i in indexes]:
+        raise InvalidArgument("output is one of the indexes: '%s'" % arg)
+    return arg
+
+
+def usage():
+    text = (
+        "\nUsage: %s -b <a.bfindex> -b <b.bfindex> [-U|-I -o <out.bfindex>]\n"
+        "\n"
+        "  -b, --index=FILENAME             "
+        "read the index FILENAME (repeatable)\n"
+        "  -U, --union                      "
+        "write the union of the indexes to --output\n"
+        "  -I, --intersection               "
+        "write the intersection of the indexes to --output\n"
+        "  -o, --output=FILENAME            "
+        "write the combined index to FILENAME\n"
+        "      --report=FORMAT              "
+        "write the report as %s [default %s]\n"
+        "  -v, --verbose                    "
+        "produce output to stderr\n"
+        "  -h, --help                       "
+        "display this message.\n\n"
+        "The indexes must be Bloom filters built by the same engine with the\n"
+        "same capacity and error rate. Without --union or --intersection,\n"
+        "only the report is written: for each index, and for the combined\n"
+        "index, its bits set, fill ratio, estimated number of values and\n"
+        "estimated false positive rate.\n"
+        "\n" % (sys.argv[0], ' or '.join(REPORT_FORMATS), DEFAULT_REPORT))
+    sys.stderr.write(text)
+
+
+def debug(text):
+    """Print text to stderr if _VERBOSE has been set."""
+    if _VERBOSE:
+        sys.stderr.write(text)
+
+
+def open_bloom_filter(path):
+    """
+    Memory map the Bloom filter in the index file named by path, so that
+    its bits are read straight from the page cache and never written.
+    Throw InvalidArgument if the file holds anything other than a single
+    NumPy or blocked Bloom filter.
+    """
+    if (is_container(path) or is_shard_manifest(path) or
+            is_generation_manifest(path)):
+        raise InvalidArgument("index is a container or manifest, not a "
+                              "single filter: '%s'" % path)
+    debug("Mapping %s\n" % path)
+    bloom = mmap_filter(path)
+    if not isinstance(bloom, (NumpyBloomFilter, BlockedBloomFilter)):
+        raise InvalidArgument("index is a %s filter, which cannot be "
+                              "combined: '%s'" % (filter_kind(bloom), path))
+    return bloom
+
+
+def combine_filters(blooms, operation):
+    """
+    Return a tuple of (filter, cardinality): a new filter holding the union
+    or intersection, as operation says, of the Bloom filters in blooms,
+    which are not modified, and the estimated number of keys in it, which
+    is also set as its count. Throw ValueError unless the filters are of one
+    kind, size and hashing scheme, since bits at the same position would
+    otherwise stand for different keys.
+
+    >>> a = NumpyBloomFilter(capacity=100, error_rate=0.001)
+    >>> b = NumpyBloomFilter(capacity=100, error_rate=0.001)
+    >>> a.add_many(['apple', 'banana'])
+    2
+    >>> b.add_many(['banana', 'cherry'])
+    2
+    >>> (c, cardinality) = combine_filters([a, b], 'union')
+    >>> (len(c), list(c.contains_many(['apple', 'banana', 'cherry'])))
+    (3, [True, True, True])
+    >>> len(combine_filters([a, b], 'intersection')[0])
+    1
+    >>> combine_filters([a, NumpyBloomFilter(capacity=200)], 'union')
+    Traceback (most recent call last):
+    ...
+    ValueError: Filters must have the same size and hashing scheme to be combined
+    """
+    first = blooms[0]
+    for bloom in blooms[1:]:
+        if type(bloom) is not type(first):
+            raise ValueError("Filters must be of the same kind to be "
+                             "combined")
+
+    result = first
+    for bloom in blooms[1:]:
+        if operation == 'union':
+            result = result.union(bloom)
+        else:
+            result = result.intersection(bloom)
+    if result is first:
+        result = first.copy()
+
+    cardinality = result.estimated_cardinality()
+    if operation == 'intersection' and len(blooms) == 2:
+        # The AND of two filters keeps the bits that keys of each happened
+        # to share as well as those of the common keys, so its own estimate
+        # errs high. Count by inclusion-exclusion over the union instead.
+        (a, b) = blooms
+        shared = (a.estimated_cardinality() + b.estimated_cardinality() -
+                  a.union(b).estimated_cardinality())
+        if shared == shared:  # NaN when a filter is saturated
+            cardinality = max(0.0, min(shared, cardinality))
+
+    if cardinality == float('inf'):
+        result.count = result.capacity
+    else:
+        result.count = int(round(cardinality))
+    return (result, cardinality)
+
+
+def filter_report(bloom, cardinality=None):
+    """
+    Return a dictionary of the kind, size and fill of bloom, with the
+    number of keys and the false positive rate implied by its bits. The
+    number of keys is cardinality instead, if it is given.
+    """
+    if cardinality is None:
+        cardinality = bloom.estimated_cardinality()
+    (bits_set, num_bits) = bit_counts(bloom)
+    return {
+        'kind': filter_kind(bloom),
+        'capacity': bloom.capacity,
+        'count': bloom.count,
+        'bits': num_bits,
+        'bits_set': bits_set,
+        'fill_ratio': float(bits_set) / num_bits,
+        'estimated_cardinality': cardinality,
+        'estimated_error_rate': bloom.estimated_error_rate(),
+    }
+
+
+def combine_index_files(paths, operation=DEFAULT_OPERATION,
+                        output=DEFAULT_OUTPUT):
+    """
+    Memory map the index files named by paths and, if operation is given,
+    write the union or intersection of their filters to output. The output
+    is written atomically and the indexes are only read. Returns a report
+    dictionary with a filter_report for each index under 'indexes' and, if
+    combined, for the output under 'result'. Throw InvalidArgument if the
+    indexes cannot be combined.
+    """
+    blooms = [open_bloom_filter(path) for path in paths]
+    report = {'indexes': dict((path, filter_report(bloom))
+                              for (path, bloom) in zip(paths, blooms))}
+    if operation is None:
+        return report
+
+    try:
+        (result, cardinality) = combine_filters(blooms, operation)
+    except ValueError, e:
+        raise InvalidArgument("cannot take the %s of %s: %s" % (
+            operation, ', '.join(paths), e))
+
+    debug("Writing %s\n" % output)
+    write_atomically(output, result.tofile)
+    report.update({'operation': operation, 'output': output,
+                   'result': filter_report(result, cardinality)})
+    return report
+
+
+def write_report(report, report_format, out_file=sys.stdout):
+    """Write a report made by combine_index_files as 'json' or 'text'."""
+    if report_format == 'json':
+        json.dump(report, out_file, indent=2, sort_keys=True)
+        out_file.write('\n')
+        return
+
+    for (path, stats) in sorted(report['indexes'].items()):
+        for (name, value) in sorted(stats.items()):
+            out_file.write("index.%s.%s: %s\n" % (path, name, value))
+    if 'result' in report:
+        out_file.write("operation: %s\noutput: %s\n" % (
+            report['operation'], report['output']))
+        for (name, value) in sorted(report['result'].items()):
+            out_file.write("result.%s: %s\n" % (name, value))
+
+
+if __name__ == '__main__':
+    if NumpyBloomFilter is None:
+        sys.stderr.write("\nError: Failed to import numpy: %s\n"
+                         "Combining indexes needs NumPy.\n\n" %
+                         _NUMPY_IMPORT_ERROR)
+        usage()
+        sys.exit(_EXITCODE_IMPORT_ERROR)
+    else:
+        main()
@@ -28,11 +28,29 @@
 # POSSIBILITY OF SUCH DAMAGE.
 
 DEFAULT_INFILE = None  # None makes this argument mandatory
+DEFAULT_FILE_LIST = ''  # Empty string means no list of input files
+DEFAULT_OUTPUT = ''     # Empty string means name indexes after the infile
 DEFAULT_FIELDS = []    # Empty list means 'all'
 DEFAULT_SKIP_LINES = 1
 DEFAULT_FALSE_POSITIVE_RATE = 0.00001
 DEFAULT_DELIMITER = ';'
 DEFAULT_INDEX_DOMAINS_RECURSIVELY = False
+DEFAULT_STREAMING = False
+DEFAULT_ENGINE = 'pybloom'
+DEFAULT_JOBS = 1
+DEFAULT_APPEND = False
+DEFAULT_INCREMENTAL = False
+DEFAULT_STATS = ''     # Empty string means no metrics output
+DEFAULT_PARSER = 'csv'
+DEFAULT_FILTER_TYPE = 'bloom'
+DEFAULT_PLAN = False
+DEFAULT_COMPOSITE = []  # Empty list means no composite keys
+DEFAULT_CONTAINER = False
+DEFAULT_SHARDS = 1
+DEFAULT_SHARD = []      # Empty list means build every shard
+DEFAULT_NORMALIZE = []  # Empty list means values are indexed as they are
+DEFAULT_GENERATIONS = 0  # 0 means one index, rather than rotating generations
+DEFAULT_BUCKET = 86400   # seconds in the time bucket of a generation
 
 _VERBOSE = False       # switched by the --verbose argument
 
@@ -44,19 +62,117 @@ _EXITCODE_MISSING_ARG = 3
 import os
 import sys
 import csv
+import glob
+import time
 import getopt
+import multiprocessing
+from cStringIO import StringIO
+from functools import partial
+from itertools import chain, izip, imap
+from operator import itemgetter, methodcaller
 from collections import defaultdict
-from isdomain import is_domain
+from isdomain import is_domain, is_domain_many
+from cardinality import HyperLogLog
+from bfindex import load_filter, probe_many, add_values, reserve_capacity
+from checkpoint import (read_checkpoint, write_checkpoint, resume_offset,
+                        last_line_end)
+from build_stats import BuildStats, NULL_STATS, STATS_FORMATS
+from compression import detect_compression, open_input, UnsupportedCompression
+from index_container import (ContainerWriter, container_filename,
+                             container_member)
+from shards import Sharding, manifest_filename
+from generations import (Generations,
+                         manifest_filename as generation_manifest_filename)
+from pipeline import BackgroundIterator, BackgroundWriter, write_atomically
+from normalize import Normalizer, NORMALIZATIONS
+from planner import (ColumnSample, read_sample, sample_budgets,
+                     filter_file_bytes, estimate_peak_memory, current_memory,
+                     write_plan, DEFAULT_SAMPLE_BYTES)
+
+try:
+    from pybloom import BloomFilter
+except ImportError, e:
+    BloomFilter = None
+    _PYBLOOM_IMPORT_ERROR = e
+
+try:
+    from numpy_bloom import NumpyBloomFilter, SCHEME_DOUBLE, SCHEME_PYBLOOM
+    from blocked_bloom import BlockedBloomFilter
+    from fingerprint_filters import CuckooFilter, XorFilter, BinaryFuseFilter
+except ImportError:
+    NumpyBloomFilter = None
+
+# Filter engines selectable with --engine. 'numpy' uses vectorized double
+# hashing; 'numpy-compat' uses pybloom's hashing so its output can be read by
+# pybloom.BloomFilter.fromfile; 'blocked' keeps each key's bits in one cache
+# line, for faster lookups in large filters.
+ENGINES = ('pybloom', 'numpy', 'numpy-compat', 'blocked')
+
+# Filter types selectable with --filter-type. 'bloom' is built by the --engine
+# chosen; the others need numpy. 'xor' and 'binary-fuse' filters are smaller
+# than Bloom filters at low error rates but are built once, when written, so
+# appending to one adds a layer; 'cuckoo' filters allow keys to be removed.
+FILTER_TYPES = ('bloom', 'cuckoo', 'xor', 'binary-fuse')
+
+# Row parsers selectable with --parser. 'fast' splits unquoted delimited text
+# in bulk and hands over to 'csv' if it finds the quote character.
+PARSERS = ('csv', 'fast')
+
+_QUOTECHAR = '|'
+
+# A composite group of fields, given to --composite as '1+3', is indexed under
+# that label, each row adding the group's values joined by COMPOSITE_SEPARATOR
+# (the ASCII unit separator, which delimited text does not contain).
+COMPOSITE_JOINER = '+'
+COMPOSITE_SEPARATOR = '\x1f'
+
+# Number of bytes read at a time by the fast parser.
+_FAST_PARSE_BUFFER_SIZE = 1024 * 1024
+
+# Streaming builds size each filter from a HyperLogLog estimate, so allow this
+# many standard errors of headroom before the filter would reach capacity.
+_STREAMING_CAPACITY_SIGMAS = 5
+
+# Number of values buffered per column before a batch insert while streaming.
+_STREAMING_BATCH_SIZE = 65536
+
+# Number of distinct sampled values per column which --plan inserts into a
+# scratch filter, to time insertion, and the largest capacity it gives that
+# filter (enough for it to outgrow the CPU caches, as the real one may).
+_PLAN_CALIBRATION_VALUES = 20000
+_PLAN_CALIBRATION_CAPACITY = 1 << 22
+
+# Number of recently produced domain suffixes remembered per column (and per
+# generation; see DomainExpander) so that they are not produced again.
+_DOMAIN_SUFFIX_CACHE_SIZE = 65536
 
 
 class Conf:
     """Provides the keys to the config dictionary."""
     Infile = 'infile'
+    FileList = 'file-list'
+    Output = 'output'
     FalsePositiveRate = 'false-positive-rate'
     SkipLines = 'skip-lines'
     Fields = 'fields'
     Delimiter = 'delimiter'
     IndexDomainsRecursively = 'index-domains-recursively'
+    Streaming = 'streaming'
+    Engine = 'engine'
+    Jobs = 'jobs'
+    Append = 'append'
+    Incremental = 'incremental'
+    Stats = 'stats'
+    Parser = 'parser'
+    FilterType = 'filter-type'
+    Plan = 'plan'
+    Composite = 'composite'
+    Container = 'container'
+    Shards = 'shards'
+    Shard = 'shard'
+    Normalize = 'normalize'
+    Generations = 'generations'
+    Bucket = 'bucket'
 
 
 class InvalidArgument(Exception):
@@ -73,11 +189,22 @@ def main():
         if not config:
             sys.exit(_EXITCODE_OK)
 
-        bloom_filters = open_and_create(config)
+        if config[Conf.Plan]:
+            write_plan(open_and_plan(config), config[Conf.Stats] or 'text')
+            return
+
+        stats = BuildStats() if config[Conf.Stats] else None
+        bloom_filters = open_and_create(config, stats)
 
         for (outfile, num_entries) in bloom_filters.items():
             debug("%s : %s entries\n" % (outfile, num_entries))
 
+        if stats:
+            if config[Conf.Stats] == 'json':
+                stats.write('json', sys.stdout)
+            else:
+                stats.write('text', sys.stderr)
+
     except InvalidArgument, e:
         sys.stderr.write("\nInvalid argument: %s\n" % e)
         usage()
@@ -89,25 +216,208 @@ def main():
         sys.exit(_EXITCODE_MISSING_ARG)
 
 
-def open_and_create(config):
+def open_and_create(config, stats=None):
     """
     Open the CSV file in the validated config dictionary and create the bloom
-    filter index.
+    filter index, recording metrics in stats if given. Compressed files are
+    decompressed as they are read, which rules out incremental. Several
+    input files, or an output prefix, build one index per column over all
+    of the files.
     """
 
-    with open(config[Conf.Infile], 'rU') as csvfile:
-        result = create_index(
-            config[Conf.Infile],
+    infiles = input_files(config)
+    if not infiles:
+        raise InvalidArgument("no input files given")
+    limit_fields = index_fields(config)
+
+    if config[Conf.Generations]:
+        if len(infiles) > 1 and not config[Conf.Output]:
+            raise InvalidArgument("output is required with several input "
+                                  "files")
+        return create_generation_index(
+            infiles,
+            config[Conf.Output] or infiles[0],
+            config[Conf.FalsePositiveRate],
+            config[Conf.SkipLines],
+            limit_fields,
+            config[Conf.Delimiter],
+            config[Conf.IndexDomainsRecursively],
+            Generations(config[Conf.Generations], config[Conf.Bucket]),
+            engine=config[Conf.Engine],
+            filter_type=config[Conf.FilterType],
+            streaming=config[Conf.Streaming],
+            stats=stats,
+            parser=config[Conf.Parser],
+            normalize=config[Conf.Normalize])
+
+    if len(infiles) > 1 or config[Conf.Output]:
+        if not config[Conf.Output]:
+            raise InvalidArgument("output is required with several input "
+                                  "files")
+        if config[Conf.Append] or config[Conf.Incremental]:
+            raise InvalidArgument("append and incremental cannot be combined "
+                                  "with output")
+        return create_multi_file_index(
+            infiles,
+            config[Conf.Output],
+            config[Conf.FalsePositiveRate],
+            config[Conf.SkipLines],
+            limit_fields,
+            config[Conf.Delimiter],
+            config[Conf.IndexDomainsRecursively],
+            config[Conf.Jobs],
+            engine=config[Conf.Engine],
+            filter_type=config[Conf.FilterType],
+            stats=stats,
+            parser=config[Conf.Parser],
+            normalize=config[Conf.Normalize],
+            container=config[Conf.Container])
+
+    infile = infiles[0]
+    compression = detect_compression(infile)
+    if compression and config[Conf.Incremental]:
+        raise InvalidArgument("%s compressed infile cannot be combined with "
+                              "incremental" % compression)
+
+    if config[Conf.Incremental]:
+        return create_incremental_index(
+            infile,
+            config[Conf.FalsePositiveRate],
+            config[Conf.SkipLines],
+            limit_fields,
+            config[Conf.Delimiter],
+            config[Conf.IndexDomainsRecursively],
+            engine=config[Conf.Engine],
+            filter_type=config[Conf.FilterType],
+            streaming=config[Conf.Streaming],
+            stats=stats,
+            parser=config[Conf.Parser],
+            normalize=config[Conf.Normalize])
+
+    if config[Conf.Jobs] > 1:
+        return create_parallel_index(
+            infile,
+            config[Conf.FalsePositiveRate],
+            config[Conf.SkipLines],
+            limit_fields,
+            config[Conf.Delimiter],
+            config[Conf.IndexDomainsRecursively],
+            config[Conf.Jobs],
+            engine=config[Conf.Engine],
+            filter_type=config[Conf.FilterType],
+            stats=stats,
+            parser=config[Conf.Parser],
+            normalize=config[Conf.Normalize],
+            container=config[Conf.Container])
+
+    if config[Conf.Streaming]:
+        create = create_streaming_index
+    else:
+        create = create_index
+
+    try:
+        csvfile = open_input(infile)
+    except UnsupportedCompression, e:
+        raise InvalidArgument(e)
+
+    with csvfile:
+        result = create(
+            infile,
             csvfile,
             config[Conf.FalsePositiveRate],
             config[Conf.SkipLines],
-            config[Conf.Fields],
+            limit_fields,
             config[Conf.Delimiter],
-            config[Conf.IndexDomainsRecursively])
+            config[Conf.IndexDomainsRecursively],
+            engine=config[Conf.Engine],
+            filter_type=config[Conf.FilterType],
+            append=config[Conf.Append],
+            stats=stats,
+            parser=config[Conf.Parser],
+            normalize=config[Conf.Normalize],
+            container=config[Conf.Container],
+            sharding=new_sharding(config))
 
     return result
 
 
+def open_and_plan(config):
+    """
+    Predict what open_and_create would take to build the indexes in the
+    validated config dictionary, without building them. The plan is for a
+    build from scratch, whether or not append or incremental are set.
+    """
+
+    infiles = input_files(config)
+    if not infiles:
+        raise InvalidArgument("no input files given")
+    limit_fields = index_fields(config)
+
+    try:
+        return plan_index(
+            infiles,
+            config[Conf.Output],
+            config[Conf.FalsePositiveRate],
+            config[Conf.SkipLines],
+            limit_fields,
+            config[Conf.Delimiter],
+            config[Conf.IndexDomainsRecursively],
+            config[Conf.Jobs],
+            engine=config[Conf.Engine],
+            filter_type=config[Conf.FilterType],
+            streaming=config[Conf.Streaming],
+            parser=config[Conf.Parser],
+            normalize=config[Conf.Normalize],
+            container=config[Conf.Container])
+    except UnsupportedCompression, e:
+        raise InvalidArgument(e)
+
+
+def new_sharding(config):
+    """
+    Return the shards.Sharding for the validated config dictionary, or None
+    if it does not shard the indexes.
+    """
+    if config[Conf.Shards] == 1:
+        return None
+    return Sharding(config[Conf.Shards], config[Conf.Shard])
+
+
+def index_fields(config):
+    """
+    Return the fields to index for the validated config dictionary: the
+    field numbers given by fields followed by the labels of the composite
+    groups. Composite groups alone leave out the single fields, which are
+    otherwise all indexed when none are given.
+
+    >>> index_fields({Conf.Fields: [2], Conf.Composite: ['1+3']})
+    [2, '1+3']
+    """
+    return config[Conf.Fields] + config[Conf.Composite]
+
+
+def input_files(config):
+    """
+    Return the list of input files named by the validated config dictionary:
+    those matching the infile, which may be a glob pattern, followed by
+    those listed one per line in the file-list file.
+    """
+    infiles = []
+    if config[Conf.Infile]:
+        if glob.has_magic(config[Conf.Infile]):
+            infiles.extend(sorted(glob.glob(config[Conf.Infile])))
+        else:
+            infiles.append(config[Conf.Infile])
+
+    if config[Conf.FileList]:
+        with open(config[Conf.FileList], 'rU') as f:
+            for line in f:
+                if line.strip():
+                    infiles.append(validate_infile(line.strip()))
+
+    return infiles
+
+
 def parse_arguments(argv):
     """
     Parse out whatever arguments are available on the command line and call the
@@ -117,9 +427,13 @@ def parse_arguments(argv):
     try:
         (opts, args) = getopt.getopt(
             argv[1:],
-            "i:f:s:e:d:rhv",
-            ['infile=', 'fields=', 'skip-lines=', 'false-positive-rate=',
-             'delimiter=', 'index-domains-recursively', 'help', 'verbose'])
+            "i:l:o:f:c:s:e:d:rSE:t:j:aICN:G:P:hv",
+            ['infile=', 'file-list=', 'output=', 'fields=', 'composite=',
+             'skip-lines=', 'false-positive-rate=',
+             'delimiter=', 'index-domains-recursively', 'streaming',
+             'engine=', 'filter-type=', 'jobs=', 'append', 'incremental',
+             'stats=', 'parser=', 'plan', 'container', 'shards=', 'shard=',
+             'normalize=', 'generations=', 'bucket=', 'help', 'verbose'])
     except getopt.GetoptError as err:
         raise InvalidArgument(err)
 
@@ -128,20 +442,47 @@ def parse_arguments(argv):
 
     config = {
         Conf.Infile: DEFAULT_INFILE,
+        Conf.FileList: DEFAULT_FILE_LIST,
+        Conf.Output: DEFAULT_OUTPUT,
         Conf.Fields: DEFAULT_FIELDS,
         Conf.SkipLines: DEFAULT_SKIP_LINES,
         Conf.FalsePositiveRate: DEFAULT_FALSE_POSITIVE_RATE,
         Conf.Delimiter: DEFAULT_DELIMITER,
         Conf.IndexDomainsRecursively: DEFAULT_INDEX_DOMAINS_RECURSIVELY,
+        Conf.Streaming: DEFAULT_STREAMING,
+        Conf.Engine: DEFAULT_ENGINE,
+        Conf.Jobs: DEFAULT_JOBS,
+        Conf.Append: DEFAULT_APPEND,
+        Conf.Incremental: DEFAULT_INCREMENTAL,
+        Conf.Stats: DEFAULT_STATS,
+        Conf.Parser: DEFAULT_PARSER,
+        Conf.FilterType: DEFAULT_FILTER_TYPE,
+        Conf.Plan: DEFAULT_PLAN,
+        Conf.Composite: DEFAULT_COMPOSITE,
+        Conf.Container: DEFAULT_CONTAINER,
+        Conf.Shards: DEFAULT_SHARDS,
+        Conf.Shard: DEFAULT_SHARD,
+        Conf.Normalize: DEFAULT_NORMALIZE,
+        Conf.Generations: DEFAULT_GENERATIONS,
+        Conf.Bucket: DEFAULT_BUCKET,
     }
 
     for (opt, arg) in opts:
         if opt in ('-i', '--infile'):
             config[Conf.Infile] = validate_infile(arg)
 
+        elif opt in ('-l', '--file-list'):
+            config[Conf.FileList] = validate_file_list(arg)
+
+        elif opt in ('-o', '--output'):
+            config[Conf.Output] = arg
+
         elif opt in ('-f', '--fields'):
             config[Conf.Fields] = validate_fields(arg)
 
+        elif opt in ('-c', '--composite'):
+            config[Conf.Composite] = validate_composite(arg)
+
         elif opt in ('-s', '--skip-lines'):
             config[Conf.SkipLines] = validate_skip_lines(arg)
 
@@ -154,6 +495,51 @@ def parse_arguments(argv):
         elif opt in ('-r', '--index-domains-recursively'):
             config[Conf.IndexDomainsRecursively] = True
 
+        elif opt in ('-S', '--streaming'):
+            config[Conf.Streaming] = True
+
+        elif opt in ('-E', '--engine'):
+            config[Conf.Engine] = validate_engine(arg)
+
+        elif opt in ('-t', '--filter-type'):
+            config[Conf.FilterType] = validate_filter_type(arg)
+
+        elif opt in ('-j', '--jobs'):
+            config[Conf.Jobs] = validate_jobs(arg)
+
+        elif opt in ('-a', '--append'):
+            config[Conf.Append] = True
+
+        elif opt in ('-I', '--incremental'):
+            config[Conf.Incremental] = True
+
+        elif opt in ('-C', '--container'):
+            config[Conf.Container] = True
+
+        elif opt in ('-N', '--shards'):
+            config[Conf.Shards] = validate_shards(arg)
+
+        elif opt == '--shard':
+            config[Conf.Shard] = validate_shard(arg)
+
+        elif opt == '--normalize':
+            config[Conf.Normalize] = validate_normalize(arg)
+
+        elif opt in ('-G', '--generations'):
+            config[Conf.Generations] = validate_generations(arg)
+
+        elif opt == '--bucket':
+            config[Conf.Bucket] = validate_bucket(arg)
+
+        elif opt == '--stats':
+            config[Conf.Stats] = validate_stats_format(arg)
+
+        elif opt in ('-P', '--parser'):
+            config[Conf.Parser] = validate_parser(arg)
+
+        elif opt == '--plan':
+            config[Conf.Plan] = True
+
         elif opt in ('-v', '--verbose'):
             global _VERBOSE
             _VERBOSE = True
@@ -162,26 +548,92 @@ def parse_arguments(argv):
             usage()
             return None
 
+    if config[Conf.FileList] and config[Conf.Infile] is None:
+        config[Conf.Infile] = ''
+
     if None in config.values():
         raise MissingArgument(', '.join([key for key, value in config.items()
                                          if value is None]))
+
+    if config[Conf.Append] and config[Conf.Jobs] > 1:
+        raise InvalidArgument("append cannot be combined with jobs")
+
+    if config[Conf.Incremental] and config[Conf.Jobs] > 1:
+        raise InvalidArgument("incremental cannot be combined with jobs")
+
+    if config[Conf.Container] and (config[Conf.Append] or
+                                   config[Conf.Incremental]):
+        raise InvalidArgument("container cannot be combined with append or "
+                              "incremental")
+
+    if config[Conf.Shards] > 1 and (
+            config[Conf.Jobs] > 1 or config[Conf.Output] or
+            config[Conf.Incremental] or config[Conf.Container] or
+            config[Conf.Plan]):
+        raise InvalidArgument("shards cannot be combined with jobs, output, "
+                              "incremental, container or plan")
+
+    if [shard for shard in config[Conf.Shard]
+            if shard >= config[Conf.Shards]]:
+        raise InvalidArgument("shard must be less than shards")
+
+    if config[Conf.Generations] and (
+            config[Conf.Jobs] > 1 or config[Conf.Append] or
+            config[Conf.Incremental] or config[Conf.Container] or
+            config[Conf.Shards] > 1 or config[Conf.Plan]):
+        raise InvalidArgument("generations cannot be combined with jobs, "
+                              "append, incremental, container, shards or "
+                              "plan")
+
+    if (config[Conf.Bucket] != DEFAULT_BUCKET and
+            not config[Conf.Generations]):
+        raise InvalidArgument("bucket only applies to generations")
+
+    if (config[Conf.FilterType] != 'bloom' and
+            config[Conf.Engine] != DEFAULT_ENGINE):
+        raise InvalidArgument("engine only applies to the bloom filter-type")
+
     return config
 
 
 def validate_infile(arg):
     """
-    Validate that the filename is a valid file.
+    Validate that the filename is a valid file, or that the glob pattern
+    matches at least one file.
 
     >>> validate_infile('/non/existent/file')
     Traceback (most recent call last):
     ...
     InvalidArgument: infile is not a file: '/non/existent/file'
+
+    >>> validate_infile('/non/existent/*.csv')
+    Traceback (most recent call last):
+    ...
+    InvalidArgument: infile pattern matches no files: '/non/existent/*.csv'
     """
-    if not os.path.isfile(arg):
+    if glob.has_magic(arg):
+        if not any(os.path.isfile(path) for path in glob.iglob(arg)):
+            raise InvalidArgument("infile pattern matches no files: '%s'" %
+                                  arg)
+    elif not os.path.isfile(arg):
         raise InvalidArgument("infile is not a file: '%s'" % arg)
     return arg
 
 
+def validate_file_list(arg):
+    """
+    Validate that the file listing input filenames is a valid file.
+
+    >>> validate_file_list('/non/existent/file')
+    Traceback (most recent call last):
+    ...
+    InvalidArgument: file-list is not a file: '/non/existent/file'
+    """
+    if not os.path.isfile(arg):
+        raise InvalidArgument("file-list is not a file: '%s'" % arg)
+    return arg
+
+
 def validate_false_positive_rate(arg):
     """
     Convert to float and validate it's positive.
@@ -255,6 +707,258 @@ def validate_fields(arg):
     return fields
 
 
+def validate_composite(arg):
+    """
+    Convert a comma-separated list of groups of field numbers joined by '+'
+    into a list of group labels, checking that each group has at least two
+    distinct fields, each greater than zero.
+
+    >>> validate_composite('1+3,2+04+5')
+    ['1+3', '2+4+5']
+
+    >>> validate_composite('1+3,2')
+    Traceback (most recent call last):
+    ...
+    InvalidArgument: composite groups need two or more fields: '1+3,2'
+    """
+    groups = []
+    for group in arg.split(','):
+        try:
+            fields = [int(field) for field in group.split(COMPOSITE_JOINER)]
+        except ValueError:
+            raise InvalidArgument("composite not groups of integers joined by "
+                                  "'%s': '%s'" % (COMPOSITE_JOINER, arg))
+
+        if len(set(fields)) < 2:
+            raise InvalidArgument("composite groups need two or more fields: "
+                                  "'%s'" % arg)
+
+        if min(fields) <= 0:
+            raise InvalidArgument("composite fields must all be > zero: '%s'"
+                                  % arg)
+
+        groups.append(COMPOSITE_JOINER.join(map(str, fields)))
+
+    return groups
+
+
+def validate_engine(arg):
+    """
+    Validate that the engine is one of ENGINES and is importable.
+    >>> validate_engine('pybloom')
+    'pybloom'
+
+    >>> validate_engine('foo')
+    Traceback (most recent call last):
+    ...
+    InvalidArgument: engine must be one of pybloom, numpy, numpy-compat, blocked: 'foo'
+    """
+    if arg not in ENGINES:
+        raise InvalidArgument("engine must be one of %s: '%s'" % (
+            ', '.join(ENGINES), arg))
+
+    if arg != 'pybloom' and NumpyBloomFilter is None:
+        raise InvalidArgument("engine '%s' requires numpy" % arg)
+
+    return arg
+
+
+def validate_filter_type(arg):
+    """
+    Validate that the filter type is one of FILTER_TYPES and is importable.
+    >>> validate_filter_type('bloom')
+    'bloom'
+
+    >>> validate_filter_type('quotient')
+    Traceback (most recent call last):
+    ...
+    InvalidArgument: filter-type must be one of bloom, cuckoo, xor, binary-fuse: 'quotient'
+    """
+    if arg not in FILTER_TYPES:
+        raise InvalidArgument("filter-type must be one of %s: '%s'" % (
+            ', '.join(FILTER_TYPES), arg))
+
+    if arg != 'bloom' and NumpyBloomFilter is None:
+        raise InvalidArgument("filter-type '%s' requires numpy" % arg)
+
+    return arg
+
+
+def validate_jobs(arg):
+    """
+    Convert to integer and validate that the value is >= 1
+    >>> validate_jobs('4')
+    4
+
+    >>> validate_jobs('0')
+    Traceback (most recent call last):
+    ...
+    InvalidArgument: jobs must be at least 1: '0'
+    """
+    try:
+        jobs = int(arg)
+    except ValueError:
+        raise InvalidArgument("jobs not an integer: '%s'" % arg)
+
+    if jobs < 1:
+        raise InvalidArgument("jobs must be at least 1: '%s'" % arg)
+
+    return jobs
+
+
+def validate_shards(arg):
+    """
+    Validate the number of shards to split each index into.
+
+    >>> validate_shards('16')
+    16
+    >>> validate_shards('0')
+    Traceback (most recent call last):
+        ...
+    InvalidArgument: shards must be > 0
+    """
+    try:
+        num_shards = int(arg)
+    except ValueError:
+        raise InvalidArgument("shards must be a number")
+
+    if num_shards < 1:
+        raise InvalidArgument("shards must be > 0")
+
+    return num_shards
+
+
+def validate_shard(arg):
+    """
+    Validate the comma separated shards to build, numbered from 0.
+
+    >>> validate_shard('3,0')
+    [0, 3]
+    >>> validate_shard('x')
+    Traceback (most recent call last):
+        ...
+    InvalidArgument: shard must be a comma separated list of numbers
+    """
+    try:
+        shards = sorted(set(int(shard) for shard in arg.split(',')))
+    except ValueError:
+        raise InvalidArgument("shard must be a comma separated list of "
+                              "numbers")
+
+    if shards[0] < 0:
+        raise InvalidArgument("shard must be >= 0")
+
+    return shards
+
+
+def validate_generations(arg):
+    """
+    Validate the number of time buckets whose generations are kept.
+
+    >>> validate_generations('7')
+    7
+    >>> validate_generations('0')
+    Traceback (most recent call last):
+        ...
+    InvalidArgument: generations must be > 0
+    """
+    try:
+        num_generations = int(arg)
+    except ValueError:
+        raise InvalidArgument("generations must be a number")
+
+    if num_generations < 1:
+        raise InvalidArgument("generations must be > 0")
+
+    return num_generations
+
+
+def validate_bucket(arg):
+    """
+    Validate the length of a time bucket: a number of seconds, or of
+    minutes, hours or days with an 'm', 'h' or 'd' suffix. Returns it in
+    seconds.
+
+    >>> [validate_bucket(arg) for arg in ('90', '30m', '6h', '1d')]
+    [90, 1800, 21600, 86400]
+    >>> validate_bucket('1w')
+    Traceback (most recent call last):
+        ...
+    InvalidArgument: bucket must be a number of seconds, or end in m, h or d: '1w'
+    """
+    units = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+    (number, unit) = (arg[:-1], arg[-1:]) if arg[-1:].isalpha() else (arg,
+                                                                      's')
+    try:
+        seconds = int(number) * units[unit]
+    except (ValueError, KeyError):
+        raise InvalidArgument("bucket must be a number of seconds, or end in "
+                              "m, h or d: '%s'" % arg)
+
+    if seconds < 1:
+        raise InvalidArgument("bucket must be > 0")
+
+    return seconds
+
+
+def validate_normalize(arg):
+    """
+    Validate the comma separated normalization steps, each one of
+    NORMALIZATIONS, or 'all' for every one, returning them in the order they
+    are applied.
+
+    >>> validate_normalize('dot,case')
+    ['case', 'dot']
+    >>> validate_normalize('all')
+    ['space', 'case', 'idna', 'dot']
+    >>> validate_normalize('upper')
+    Traceback (most recent call last):
+        ...
+    InvalidArgument: normalize must be all or some of space, case, idna, dot: 'upper'
+    """
+    steps = set(arg.split(','))
+    if steps == set(['all']):
+        return list(NORMALIZATIONS)
+    if not steps.issubset(NORMALIZATIONS):
+        raise InvalidArgument("normalize must be all or some of %s: '%s'" % (
+            ', '.join(NORMALIZATIONS), arg))
+    return [step for step in NORMALIZATIONS if step in steps]
+
+
+def validate_parser(arg):
+    """
+    Validate that the row parser is one of PARSERS.
+    >>> validate_parser('fast')
+    'fast'
+
+    >>> validate_parser('regex')
+    Traceback (most recent call last):
+    ...
+    InvalidArgument: parser must be one of csv, fast: 'regex'
+    """
+    if arg not in PARSERS:
+        raise InvalidArgument("parser must be one of %s: '%s'" % (
+            ', '.join(PARSERS), arg))
+    return arg
+
+
+def validate_stats_format(arg):
+    """
+    Validate that the metrics output format is one of STATS_FORMATS.
+    >>> validate_stats_format('json')
+    'json'
+
+    >>> validate_stats_format('xml')
+    Traceback (most recent call last):
+    ...
+    InvalidArgument: stats must be one of json, text: 'xml'
+    """
+    if arg not in STATS_FORMATS:
+        raise InvalidArgument("stats must be one of %s: '%s'" % (
+            ', '.join(STATS_FORMATS), arg))
+    return arg
+
+
 def validate_skip_lines(arg):
     """
     Convert to integer and validate that the value is >= 0
@@ -284,11 +988,19 @@ def validate_skip_lines(arg):
 
 def usage():
     text = (
-        "\nUsage: %s -v -i <file.csv>\n\n"
+        "\nUsage: %s -v -i <file.csv>\n"
+        "       %s -v -i '<shard-*.csv>' -o <prefix>\n"
+        "       %s -v -i <feed.csv> -o <prefix> -G <days>\n\n"
         "  -i, --infile=FILENAME            "
-        "open the CSV given by FILENAME\n"
+        "open the CSV(s) given by FILENAME or glob (may be compressed)\n"
+        "  -l, --file-list=FILENAME         "
+        "also open the CSVs listed one per line in FILENAME\n"
+        "  -o, --output=PREFIX              "
+        "index all inputs together into PREFIX.N.bfindex\n"
         "  -f, --fields=field1,field2       "
         "fields/columns to index, eg 1,2,5 [default all]\n"
+        "  -c, --composite=GROUPS           "
+        "also index fields together as one key, eg 1+3,2+4\n"
         "  -s, --skip-lines=NUMBER          "
         "skip NUMBER rows of header data from the top of the CSV file\n"
         "  -e, --false-positive-rate=RATE   "
@@ -297,12 +1009,47 @@ def usage():
         "CSV delimiter character (may need escaping) [default %s]\n"
         "  -r, --index-domains-recursively  "
         "expand domains to subdomain components [default %s].\n"
+        "  -S, --streaming                  "
+        "two-pass build that never holds column values in memory\n"
+        "  -E, --engine=NAME                "
+        "filter engine, one of %s [default %s]\n"
+        "  -t, --filter-type=NAME           "
+        "filter type, one of %s [default %s]\n"
+        "  -j, --jobs=NUMBER                "
+        "build with NUMBER worker processes [default %d]\n"
+        "  -a, --append                     "
+        "add new values to existing indexes rather than replacing them\n"
+        "  -I, --incremental                "
+        "only index lines added since the last incremental run\n"
+        "  -C, --container                  "
+        "write all columns into one file, FILENAME.bfpack\n"
+        "  -N, --shards=NUMBER              "
+        "split each index into NUMBER shards by value hash [default %d]\n"
+        "      --shard=K[,K...]             "
+        "only build these shards, numbered from 0 [default all]\n"
+        "      --normalize=STEPS            "
+        "normalize values first: all or some of %s\n"
+        "  -G, --generations=NUMBER         "
+        "index into time buckets, keeping the NUMBER newest\n"
+        "      --bucket=DURATION            "
+        "length of a time bucket, eg 3600, 30m, 6h [default 1d]\n"
+        "  -P, --parser=NAME                "
+        "row parser, one of %s [default %s]\n"
+        "      --stats=FORMAT               "
+        "write build metrics as %s (json to stdout, text to stderr)\n"
+        "      --plan                       "
+        "predict filter sizes, memory and time without building\n"
         "  -v, --verbose                    "
         "produce output to stderr\n"
         "  -h, --help                       "
         "display this message.\n\n" % (
-            sys.argv[0], DEFAULT_FALSE_POSITIVE_RATE, DEFAULT_DELIMITER,
-            DEFAULT_INDEX_DOMAINS_RECURSIVELY))
+            sys.argv[0], sys.argv[0], sys.argv[0],
+            DEFAULT_FALSE_POSITIVE_RATE, DEFAULT_DELIMITER,
+            DEFAULT_INDEX_DOMAINS_RECURSIVELY, ', '.join(ENGINES),
+            DEFAULT_ENGINE, ', '.join(FILTER_TYPES), DEFAULT_FILTER_TYPE,
+            DEFAULT_JOBS, DEFAULT_SHARDS, ','.join(NORMALIZATIONS),
+            ', '.join(PARSERS), DEFAULT_PARSER,
+            ' or '.join(STATS_FORMATS)))
     sys.stderr.write(text)
 
 
@@ -313,41 +1060,964 @@ def debug(text):
 
 
 def create_index(infile, csvfile, error_rate, skip_lines, limit_fields,
-                 delimiter, recursive_domains):
+                 delimiter, recursive_domains, engine=DEFAULT_ENGINE,
+                 append=DEFAULT_APPEND, stats=None, parser=DEFAULT_PARSER,
+                 filter_type=DEFAULT_FILTER_TYPE, container=DEFAULT_CONTAINER,
+                 sharding=None, normalize=DEFAULT_NORMALIZE):
     """
     Parse the file-like object given by csvfile using the csv module. Add each
     unique entry in each field/column (specified by limit_fields) to a bloom
     filter and save with a filename derived from the input filenamd and field.
+    With append, values are added to any existing index file instead.
+    Metrics are recorded in stats, a build_stats.BuildStats, if given.
+    The parser is one of PARSERS and the filter_type one of FILTER_TYPES.
+    With container, the filters are saved in one file (see
+    open_index_writer). With sharding, a shards.Sharding, each column is
+    split into shards, only the shards it keeps are built, and a manifest of
+    the shards is written (see write_shard_manifest). Values are first
+    normalized by the steps in normalize (see new_normalizer).
     """
+    stats = stats or NULL_STATS
 
-    column_values_map = parse_csv_file(
-        csvfile, delimiter, recursive_domains, limit_fields, skip_lines)
+    with stats.timer('parse'):
+        column_values_map = parse_csv_file(
+            csvfile, delimiter, recursive_domains, limit_fields, skip_lines,
+            stats=stats, parser=parser, sharding=sharding,
+            normalize=normalize)
 
     index_stats = {}
-    for (column_number, values) in column_values_map.items():
-        (bloom, num_added) = create_bloom_filter(values, error_rate=error_rate)
-
-        out_fn = out_filename(infile, column_number)
-        index_stats[out_fn] = num_added
-
-        write_bloom_filter(bloom, out_fn)
+    with open_index_writer(infile, column_values_map, container,
+                           stats) as writer:
+        for (column_number, values) in column_values_map.items():
+            stats.record_values(column_number, values)
+
+            out_fn = out_filename(infile, column_number)
+            with stats.timer('dedup'):
+                values = distinct_values(values)
+            with stats.timer('insert'):
+                if append and os.path.isfile(out_fn):
+                    bloom = append_to_bloom_filter(
+                        load_filter(out_fn), values, error_rate)
+                    num_added = bloom.count
+                else:
+                    (bloom, num_added) = create_bloom_filter(
+                        values, error_rate=error_rate, engine=engine,
+                        filter_type=filter_type)
+
+            with stats.timer('write'):
+                out_fn = writer.write(column_number, bloom)
+            index_stats[out_fn] = num_added
+            stats.record_filter(column_number, out_fn, bloom)
+
+    if sharding is not None:
+        write_shard_manifest(infile, sharding)
 
     return index_stats
 
 
 def parse_csv_file(csvfile, delimiter, recursive_domains, limit_fields,
-                   skip_lines):
+                   skip_lines, stats=NULL_STATS, parser=DEFAULT_PARSER,
+                   sharding=None, normalize=DEFAULT_NORMALIZE):
     """
     Opens the file-like-object with the CSV reader module and advances past
     the specified number of header lines. Uses another function to process
-    the values into a list-per-column format.
+    the values into a list-per-column format, and then normalizes them by
+    the steps in normalize. With sharding, the lists are of the shards it
+    keeps instead, one for each shard of each column.
     """
 
-    debug("Opening CSV with delimiter %s\n" % delimiter)
-    csv_reader = csv.reader(csvfile, delimiter=delimiter, quotechar='|')
-    skip_header_lines(csv_reader, skip_lines)
+    if sharding is not None:
+        data = defaultdict(list)
+        for (label, value) in sharding.route(iter_csv_values(
+                csvfile, delimiter, recursive_domains, limit_fields,
+                skip_lines, stats=stats, parser=parser,
+                normalize=normalize)):
+            data[label].append(value)
+        return dict((label, data[label]) for label in sharding.labels())
+
+    if parser == 'fast':
+        data = defaultdict(list)
+        for (column_number, values) in iter_delimited_columns(
+                csvfile, delimiter, recursive_domains, limit_fields,
+                skip_lines, stats=stats):
+            data[column_number].extend(values)
+        data = dict(data)
+    else:
+        debug("Opening CSV with delimiter %s\n" % delimiter)
+        csv_reader = csv.reader(csvfile, delimiter=delimiter,
+                                quotechar=_QUOTECHAR)
+        skip_header_lines(csv_reader, skip_lines)
+        data = get_values_by_column(csv_reader, limit_fields,
+                                    recursive_domains, stats=stats)
+
+    if normalize:
+        values_of = new_normalizer(normalize, recursive_domains).values
+        for (column_number, values) in data.items():
+            data[column_number] = list(chain.from_iterable(
+                imap(values_of, values)))
+    return data
+
+
+def create_streaming_index(infile, csvfile, error_rate, skip_lines,
+                           limit_fields, delimiter, recursive_domains,
+                           engine=DEFAULT_ENGINE, append=DEFAULT_APPEND,
+                           stats=None, parser=DEFAULT_PARSER,
+                           filter_type=DEFAULT_FILTER_TYPE,
+                           container=DEFAULT_CONTAINER, sharding=None,
+                           normalize=DEFAULT_NORMALIZE):
+    """
+    Build the same indexes as create_index without ever holding the column
+    values in memory. A first pass over csvfile estimates the cardinality of
+    each column with a HyperLogLog sketch; csvfile is then rewound and each
+    value is added to a filter sized from that estimate as it streams past.
+    Memory use is bounded by the size of the filters plus the sketches.
+
+    With append, existing index files are loaded first and only values they
+    do not already hold are counted towards the extra capacity needed.
+
+    Rows and values are counted into stats during the second pass only.
+    With sharding, only the filters of the shards it keeps are built, so
+    memory use is bounded by their size.
+    """
+    stats = stats or NULL_STATS
+
+    existing = {}
+    sketches = defaultdict(HyperLogLog)
+    with stats.timer('sketch'):
+        column_values = iter_csv_values(
+            csvfile, delimiter, recursive_domains, limit_fields, skip_lines,
+            parser=parser, normalize=normalize)
+        if sharding is not None:
+            column_values = sharding.route(column_values)
+        for (column_number, value) in column_values:
+            sketch = sketches[column_number]
+            if append and column_number not in existing:
+                out_fn = out_filename(infile, column_number)
+                existing[column_number] = (
+                    load_filter(out_fn) if os.path.isfile(out_fn) else None)
+            bloom = existing.get(column_number)
+            if value and not (bloom is not None and value in bloom):
+                sketch.add(value)
+        if sharding is not None:
+            for label in sharding.labels():
+                if label not in sketches:
+                    sketches[label] = HyperLogLog()
+                    out_fn = out_filename(infile, label)
+                    if append and os.path.isfile(out_fn):
+                        existing[label] = load_filter(out_fn)
+
+    blooms = {}
+    for (column_number, sketch) in sketches.items():
+        capacity = streaming_capacity(sketch)
+        bloom = existing.get(column_number)
+        if bloom is not None:
+            if sketch.cardinality():
+                debug("Reserving capacity=%d in existing filter for column "
+                      "%s\n" % (capacity, column_number))
+                bloom = reserve_capacity(bloom, capacity, error_rate)
+            blooms[column_number] = bloom
+            continue
+
+        debug("Creating bloom filter for column %s, estimated capacity=%d, "
+              "error_rate=%f\n" % (column_number, capacity, error_rate))
+        blooms[column_number] = new_bloom_filter(capacity, error_rate, engine,
+                                                 filter_type)
+
+    csvfile.seek(0)
+    column_values = iter_csv_values(
+        csvfile, delimiter, recursive_domains, limit_fields, skip_lines,
+        stats=stats, parser=parser, normalize=normalize)
+    if sharding is not None:
+        column_values = sharding.route(column_values)
+    if stats.enabled:
+        column_values = stats.counted_values(column_values)
+    with stats.timer('insert'):
+        add_column_values(blooms, column_values)
 
-    return get_values_by_column(csv_reader, limit_fields, recursive_domains)
+    index_stats = {}
+    with open_index_writer(infile, blooms, container, stats) as writer:
+        for (column_number, bloom) in blooms.items():
+            with stats.timer('write'):
+                out_fn = writer.write(column_number, bloom)
+            index_stats[out_fn] = bloom.count
+            stats.record_filter(column_number, out_fn, bloom)
+
+    if sharding is not None:
+        write_shard_manifest(infile, sharding)
+
+    return index_stats
+
+
+def create_generation_index(infiles, out_prefix, error_rate, skip_lines,
+                            limit_fields, delimiter, recursive_domains,
+                            generations, engine=DEFAULT_ENGINE,
+                            filter_type=DEFAULT_FILTER_TYPE,
+                            streaming=DEFAULT_STREAMING, stats=None,
+                            parser=DEFAULT_PARSER,
+                            normalize=DEFAULT_NORMALIZE):
+    """
+    Add the values of each file named in infiles to the indexes of the
+    current generation of generations, a generations.Generations, with
+    filenames derived from out_prefix and the generation. Builds in the same
+    time bucket append to its indexes, as create_index does with append, so
+    that a feed can be indexed a file at a time. The generation manifest
+    named from out_prefix is then updated, and the indexes of generations
+    which have left the window are deleted.
+    """
+    prefix = generations.prefix(out_prefix)
+    if streaming:
+        create = create_streaming_index
+    else:
+        create = create_index
+
+    index_stats = {}
+    for infile in infiles:
+        try:
+            csvfile = open_input(infile)
+        except UnsupportedCompression, e:
+            raise InvalidArgument(e)
+
+        with csvfile:
+            index_stats.update(create(
+                prefix, csvfile, error_rate, skip_lines, limit_fields,
+                delimiter, recursive_domains, engine=engine,
+                filter_type=filter_type, append=True, stats=stats,
+                parser=parser, normalize=normalize))
+
+    # Index files are named out_filename(prefix, column_number).
+    files = dict((out_fn[len(prefix) + 1:-len('.bfindex')], out_fn)
+                 for out_fn in index_stats)
+    for out_fn in generations.update_manifest(
+            generation_manifest_filename(out_prefix), files):
+        debug("Expired %s\n" % out_fn)
+    return index_stats
+
+
+def streaming_capacity(sketch):
+    """
+    Return a filter capacity for the cardinality estimated by sketch, padded
+    so that an underestimate does not overflow the filter.
+
+    >>> sketch = HyperLogLog()
+    >>> sketch.add('apple')
+    >>> streaming_capacity(sketch)
+    2
+    """
+    return padded_capacity(sketch.cardinality(), sketch.standard_error())
+
+
+def padded_capacity(cardinality, standard_error):
+    """
+    Return a filter capacity for an estimated cardinality with the given
+    relative standard error, as streaming_capacity does.
+
+    >>> padded_capacity(1000, 0.01)
+    1051
+    """
+    padding = 1 + _STREAMING_CAPACITY_SIGMAS * standard_error
+    return max(1, int(cardinality * padding) + 1)
+
+
+def create_incremental_index(infile, error_rate, skip_lines, limit_fields,
+                             delimiter, recursive_domains,
+                             engine=DEFAULT_ENGINE, streaming=DEFAULT_STREAMING,
+                             stats=None, parser=DEFAULT_PARSER,
+                             filter_type=DEFAULT_FILTER_TYPE,
+                             normalize=DEFAULT_NORMALIZE):
+    """
+    Index only the part of the file named by infile which was added since
+    the last incremental run, appending it to the existing indexes. A
+    checkpoint stored beside the indexes records how far the file has been
+    read; if it is missing, was made with other settings (including the
+    engine and filter type), an index file it names is gone, or the file
+    has been truncated or rewritten since, the indexes are rebuilt from
+    scratch. A partially written last line is left for the next run.
+    """
+
+    settings = {
+        Conf.Fields: limit_fields,
+        Conf.Delimiter: delimiter,
+        Conf.SkipLines: skip_lines,
+        Conf.IndexDomainsRecursively: recursive_domains,
+        Conf.Engine: engine,
+        Conf.FilterType: filter_type,
+    }
+    if normalize:
+        settings[Conf.Normalize] = normalize
+    if streaming:
+        create = create_streaming_index
+    else:
+        create = create_index
+
+    with open(infile, 'rb') as f:
+        end = last_line_end(f)
+        start = resume_offset(read_checkpoint(infile), f, settings)
+        if start is None:
+            debug("No usable checkpoint for %s, rebuilding\n" % infile)
+            (start, skip, append) = (0, skip_lines, False)
+        else:
+            debug("Resuming %s from byte %d\n" % (infile, start))
+            (skip, append) = (0, True)
+
+        result = create(infile, ByteRangeFile(f, start, end), error_rate,
+                        skip, limit_fields, delimiter, recursive_domains,
+                        engine=engine, append=append, stats=stats,
+                        parser=parser, filter_type=filter_type,
+                        normalize=normalize)
+
+        write_checkpoint(infile, f, end, settings, result.keys())
+
+    return result
+
+
+class ByteRangeFile(object):
+    """
+    A read-only, line-iterable view of the bytes [start, end) of a file
+    object, which can be rewound with seek(0) and read in blocks.
+    """
+
+    def __init__(self, f, start, end):
+        self.f = f
+        self.start = start
+        self.end = end
+        self.seek(0)
+
+    def seek(self, offset):
+        self.f.seek(self.start + offset)
+
+    def read(self, size=-1):
+        remaining = max(0, self.end - self.f.tell())
+        if size < 0 or size > remaining:
+            size = remaining
+        return self.f.read(size)
+
+    def __iter__(self):
+        f = self.f
+        while f.tell() < self.end:
+            line = f.readline()
+            if not line:
+                break
+            yield line
+
+
+def create_parallel_index(infile, error_rate, skip_lines, limit_fields,
+                          delimiter, recursive_domains, jobs,
+                          engine=DEFAULT_ENGINE, stats=None,
+                          parser=DEFAULT_PARSER,
+                          filter_type=DEFAULT_FILTER_TYPE,
+                          container=DEFAULT_CONTAINER,
+                          normalize=DEFAULT_NORMALIZE):
+    """
+    Build the same indexes as create_streaming_index using a pool of jobs
+    worker processes, as create_multi_file_index does for a single file.
+    """
+    return create_multi_file_index(
+        [infile], infile, error_rate, skip_lines, limit_fields, delimiter,
+        recursive_domains, jobs, engine=engine, stats=stats, parser=parser,
+        filter_type=filter_type, container=container, normalize=normalize)
+
+
+def create_multi_file_index(infiles, out_prefix, error_rate, skip_lines,
+                            limit_fields, delimiter, recursive_domains,
+                            jobs=DEFAULT_JOBS, engine=DEFAULT_ENGINE,
+                            stats=None, parser=DEFAULT_PARSER,
+                            filter_type=DEFAULT_FILTER_TYPE,
+                            container=DEFAULT_CONTAINER,
+                            normalize=DEFAULT_NORMALIZE):
+    """
+    Build one index per column over the union of the files named in
+    infiles, with filenames derived from out_prefix. Each file is split into
+    newline-aligned byte ranges after its header lines (compressed files are
+    read whole), and the ranges are shared out between jobs worker
+    processes. Workers first sketch the cardinality of their ranges; the
+    sketches are merged across all files, so that every worker can then
+    build partial filters with identical parameters, sized for the union,
+    which are OR-merged into the final index.
+
+    Records must not contain quoted newlines, since a range boundary could
+    fall inside one.
+
+    Stage timings and the state of the final filters are recorded in stats.
+    As for create_streaming_index, rows and values are counted during the
+    second pass only, by each worker, and the counts are merged into stats.
+    """
+    stats = stats or NULL_STATS
+
+    ranges = []
+    ranges_per_file = max(1, jobs // len(infiles))
+    for infile in infiles:
+        if detect_compression(infile):
+            ranges.append((infile, 0, None, skip_lines))
+        else:
+            ranges.extend((infile, start, end, 0) for (start, end) in
+                          split_byte_ranges(infile, skip_lines,
+                                            ranges_per_file))
+
+    num_workers = max(1, min(jobs, len(ranges)))
+    tasks = [(ranges[i::num_workers], delimiter, recursive_domains,
+              limit_fields, parser, normalize) for i in xrange(num_workers)]
+
+    if num_workers > 1:
+        pool = multiprocessing.Pool(num_workers)
+        map_tasks = pool.map
+    else:
+        pool = None
+        map_tasks = map
+    try:
+        sketches = {}
+        with stats.timer('sketch'):
+            for sketch_map in map_tasks(_sketch_byte_ranges, tasks):
+                for (column_number, sketch) in sketch_map.items():
+                    if column_number in sketches:
+                        sketches[column_number].merge(sketch)
+                    else:
+                        sketches[column_number] = sketch
+
+        capacities = dict((column_number, streaming_capacity(sketch))
+                          for (column_number, sketch) in sketches.items())
+        blooms = {}
+        with stats.timer('insert'):
+            for (bloom_map, counters) in map_tasks(
+                    _index_byte_ranges,
+                    [task + (capacities, error_rate, engine, filter_type,
+                             stats.enabled)
+                     for task in tasks]):
+                if counters is not None:
+                    stats.merge_counters(counters)
+                for (column_number, bloom) in bloom_map.items():
+                    if column_number in blooms:
+                        blooms[column_number] = blooms[column_number] | bloom
+                    else:
+                        blooms[column_number] = bloom
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    index_stats = {}
+    with open_index_writer(out_prefix, blooms, container,
+                           stats) as writer:
+        for (column_number, bloom) in blooms.items():
+            # Merged Bloom filters cannot know how many distinct values they
+            # hold, so record the sketch's estimate.
+            if not getattr(bloom, 'exact_count', False):
+                bloom.count = min(bloom.capacity,
+                                  sketches[column_number].cardinality())
+
+            with stats.timer('write'):
+                out_fn = writer.write(column_number, bloom)
+            index_stats[out_fn] = bloom.count
+            stats.record_filter(column_number, out_fn, bloom)
+
+    return index_stats
+
+
+def plan_index(infiles, out_prefix, error_rate, skip_lines, limit_fields,
+               delimiter, recursive_domains, jobs=DEFAULT_JOBS,
+               engine=DEFAULT_ENGINE, filter_type=DEFAULT_FILTER_TYPE,
+               streaming=DEFAULT_STREAMING, parser=DEFAULT_PARSER,
+               normalize=DEFAULT_NORMALIZE,
+               sample_bytes=DEFAULT_SAMPLE_BYTES, container=DEFAULT_CONTAINER):
+    """
+    Predict what building the indexes for infiles would take, without
+    building them. About sample_bytes spread over the input (see
+    planner.read_sample) are parsed, with domains expanded, as the build
+    would parse them; alternate blocks of each file are parsed together, so
+    that domain suffix caches fill much as in a build. Each column's
+    cardinality is extrapolated from HyperLogLog sketches of the sample
+    (see planner.ColumnSample), and the time taken to parse the sample, and
+    to insert some of it into a filter of the chosen type, is scaled up to
+    the whole input. Returns the plan as a dictionary for
+    planner.write_plan; out_prefix names the index files as for
+    create_multi_file_index, or is empty, and container says whether they
+    are to be saved in one container.
+    """
+    base_bytes = current_memory()
+
+    num_ranges = sum(1 if detect_compression(infile) else
+                     max(1, jobs // len(infiles)) for infile in infiles)
+    num_workers = max(1, min(jobs, num_ranges))
+    if len(infiles) > 1 or out_prefix or jobs > 1:
+        mode = 'parallel' if num_workers > 1 else 'streaming'
+    else:
+        mode = 'streaming' if streaming else 'memory'
+
+    columns = defaultdict(ColumnSample)
+    calibration = defaultdict(set)
+    (parse_seconds, sketch_seconds) = (0.0, 0.0)
+    (input_bytes, sampled_bytes) = (0, 0)
+    for (infile, budget) in zip(infiles, sample_budgets(infiles,
+                                                        sample_bytes)):
+        (blocks, data_bytes) = read_sample(infile, skip_lines, budget)
+        sample_size = sum(len(block) for block in blocks)
+        scale = float(data_bytes) / max(1, sample_size)
+        input_bytes += data_bytes
+        sampled_bytes += sample_size
+
+        for (first_half, group) in ((True, blocks[0::2]),
+                                    (False, blocks[1::2])):
+            start = time.time()
+            column_values = list(iter_csv_values(
+                StringIO(''.join(group)), delimiter, recursive_domains,
+                limit_fields, 0, parser=parser, normalize=normalize))
+            parse_seconds += (time.time() - start) * scale
+
+            start = time.time()
+            for (column_number, value) in column_values:
+                columns[column_number].add(value, scale, first_half)
+                sample = calibration[column_number]
+                if value and len(sample) < _PLAN_CALIBRATION_VALUES:
+                    sample.add(value)
+            sketch_seconds += (time.time() - start) * scale
+
+    plan_columns = {}
+    models = []
+    insert_seconds = 0.0
+    for (column_number, column) in columns.items():
+        distinct = column.estimated_distinct_values()
+        if mode == 'memory':
+            capacity = max(1, distinct)
+            inserted = distinct
+        else:
+            capacity = padded_capacity(distinct,
+                                       column.sketch.standard_error())
+            inserted = column.estimated_values
+        filter_bytes = filter_file_bytes(capacity, distinct, error_rate,
+                                         engine, filter_type)
+        insert_seconds += inserted * _insert_seconds_per_value(
+            calibration[column_number], capacity, error_rate, engine,
+            filter_type)
+
+        non_empty = int(column.estimated_values + 0.5)
+        models.append({
+            'values': int(column.estimated_values + column.empty_values +
+                          0.5),
+            'non_empty_values': non_empty,
+            'distinct_values': distinct,
+            'mean_value_bytes': column.mean_value_bytes(),
+            'filter_bytes': filter_bytes,
+        })
+        if container:
+            out_fn = container_member(
+                container_filename(out_prefix or infiles[0]), column_number)
+        else:
+            out_fn = out_filename(out_prefix or infiles[0], column_number)
+        plan_columns[column_number] = {
+            'file': out_fn,
+            'sampled_values': column.sampled_values,
+            'estimated_values': non_empty,
+            'estimated_distinct_values': distinct,
+            'capacity': capacity,
+            'filter_bytes': filter_bytes,
+        }
+
+    if mode == 'memory':
+        stages = {'parse': parse_seconds, 'insert': insert_seconds}
+    else:
+        # A sketching pass and an inserting pass, shared between workers.
+        stages = {'sketch': (parse_seconds + sketch_seconds) / num_workers,
+                  'insert': (parse_seconds + insert_seconds) / num_workers}
+
+    return {
+        'mode': mode,
+        'workers': num_workers,
+        'input_bytes': input_bytes,
+        'sampled_bytes': sampled_bytes,
+        'columns': plan_columns,
+        'peak_memory_bytes': int(estimate_peak_memory(
+            mode, models, filter_type, num_workers, base_bytes,
+            _STREAMING_BATCH_SIZE)),
+        'stages': stages,
+        'build_seconds': sum(stages.values()),
+    }
+
+
+def _insert_seconds_per_value(values, capacity, error_rate, engine,
+                              filter_type):
+    """
+    Return the time per value taken to add the set values to a new filter
+    of about capacity and serialise it, or 0 if values is empty.
+    """
+    if not values:
+        return 0.0
+    capacity = max(len(values), min(capacity, _PLAN_CALIBRATION_CAPACITY))
+    start = time.time()
+    bloom = new_bloom_filter(capacity, error_rate, engine, filter_type)
+    add_values(bloom, values)
+    bloom.tofile(StringIO())
+    return (time.time() - start) / len(values)
+
+
+def split_byte_ranges(infile, skip_lines, num_ranges):
+    """
+    Return a list of up to num_ranges (start, end) byte offsets which cover
+    the file named by infile after its first skip_lines lines. Each range
+    starts at the beginning of a line.
+    """
+
+    with open(infile, 'rb') as f:
+        for i in xrange(skip_lines):
+            debug("Skipping %s" % f.readline())
+        first = f.tell()
+        size = os.fstat(f.fileno()).st_size
+
+        boundaries = [first]
+        step = max(1, (size - first) // num_ranges)
+        for i in xrange(1, num_ranges):
+            f.seek(max(first + i * step, boundaries[-1]))
+            f.readline()
+            if f.tell() >= size:
+                break
+            if f.tell() > boundaries[-1]:
+                boundaries.append(f.tell())
+        boundaries.append(size)
+
+    return [(start, end) for (start, end) in zip(boundaries, boundaries[1:])
+            if start < end]
+
+
+def _iter_byte_ranges(ranges, delimiter, recursive_domains, limit_fields,
+                      parser, normalize, stats=NULL_STATS):
+    """
+    Yield (column_number, value) pairs for the lines in each of a list of
+    (infile, start, end, skip_lines) byte ranges. An end of None stands for
+    the whole of a possibly compressed file. Rows and values are counted
+    into stats.
+    """
+    for (infile, start, end, skip_lines) in ranges:
+        if end is None:
+            csvfile = open_input(infile)
+        else:
+            csvfile = open(infile, 'rb')
+        with csvfile:
+            if end is not None:
+                csvfile = ByteRangeFile(csvfile, start, end)
+            column_values = iter_csv_values(
+                csvfile, delimiter, recursive_domains, limit_fields,
+                skip_lines, stats=stats, parser=parser, normalize=normalize)
+            if stats.enabled:
+                column_values = stats.counted_values(column_values)
+            for pair in column_values:
+                yield pair
+
+
+def _sketch_byte_ranges(task):
+    """Worker: return a HyperLogLog sketch per column of some byte ranges."""
+    sketches = defaultdict(HyperLogLog)
+    for (column_number, value) in _iter_byte_ranges(*task):
+        sketch = sketches[column_number]
+        if value:
+            sketch.add(value)
+    return dict(sketches)
+
+
+def _index_byte_ranges(task):
+    """
+    Worker: return a partial filter per column of some byte ranges, and the
+    counters of a BuildStats (see BuildStats.counters) if stats are enabled.
+    """
+    (capacities, error_rate, engine, filter_type, count) = task[-5:]
+    blooms = dict((column_number, new_bloom_filter(capacity, error_rate,
+                                                   engine, filter_type))
+                  for (column_number, capacity) in capacities.items())
+    stats = BuildStats() if count else NULL_STATS
+    add_column_values(blooms, _iter_byte_ranges(*task[:-5], stats=stats))
+    return (blooms, stats.counters() if count else None)
+
+
+def iter_csv_values(csvfile, delimiter, recursive_domains, limit_fields,
+                    skip_lines, stats=NULL_STATS, parser=DEFAULT_PARSER,
+                    normalize=DEFAULT_NORMALIZE):
+    """
+    Like parse_csv_file, but yield (column_number, value) pairs one at a time
+    rather than collecting them into lists.
+    """
+
+    if parser == 'fast':
+        column_values = _iter_column_chunk_values(iter_delimited_columns(
+            csvfile, delimiter, recursive_domains, limit_fields, skip_lines,
+            stats=stats))
+    else:
+        debug("Opening CSV with delimiter %s\n" % delimiter)
+        csv_reader = csv.reader(csvfile, delimiter=delimiter,
+                                quotechar=_QUOTECHAR)
+        skip_header_lines(csv_reader, skip_lines)
+        column_values = iter_column_values(csv_reader, limit_fields,
+                                           recursive_domains, stats=stats)
+
+    if normalize:
+        return normalize_column_values(
+            column_values, new_normalizer(normalize, recursive_domains))
+    return column_values
+
+
+def new_normalizer(normalize, recursive_domains):
+    """
+    Return a normalize.Normalizer for the steps in normalize. With
+    recursive_domains, a value which only normalization made into a domain
+    is followed by its sub-parts, as the parser would have expanded it.
+
+    >>> normalizer = new_normalizer(['dot'], True)
+    >>> normalizer.values('www.google.com.')
+    ('www.google.com', 'google.com', 'com')
+    >>> normalizer.values('Www.Google.com')
+    ('Www.Google.com',)
+    """
+    if recursive_domains:
+        return Normalizer(normalize, expand=_normalized_domain_parts)
+    return Normalizer(normalize)
+
+
+def _normalized_domain_parts(value, normalized):
+    """
+    Return the sub-parts of normalized, after itself, if it is a domain and
+    value, from which the parser has already produced sub-parts, is not.
+    """
+    if is_domain(normalized) and not is_domain(value):
+        return recurse_domain(normalized)[1:]
+    return []
+
+
+def normalize_column_values(column_values, normalizer):
+    """
+    Yield the (column_number, value) pairs of column_values with each value
+    replaced by those normalizer, a normalize.Normalizer, gives for it.
+
+    >>> list(normalize_column_values([(1, ' A '), (1, 'b')],
+    ...                              new_normalizer(['space', 'case'], False)))
+    [(1, 'a'), (1, 'b')]
+    """
+    values_of = normalizer.values
+    for (column_number, value) in column_values:
+        for normalized in values_of(value):
+            yield (column_number, normalized)
+
+
+def _iter_column_chunk_values(column_chunks):
+    """Flatten (column_number, values) pairs into (column_number, value)."""
+    for (column_number, values) in column_chunks:
+        for value in values:
+            yield (column_number, value)
+
+
+def iter_delimited_columns(csvfile, delimiter, recursive_domains,
+                           limit_fields, skip_lines, stats=NULL_STATS,
+                           buffer_size=_FAST_PARSE_BUFFER_SIZE):
+    """
+    Yield (column_number, values) pairs holding the same values as
+    iter_csv_values, but parse csvfile a block of lines at a time. Field
+    numbers are checked once per block. A block whose rows all have the same
+    number of fields is split in one go and each column taken as a slice;
+    otherwise rows are only split as far as the highest field in
+    limit_fields. A block which fails the check or has empty rows is handed
+    to iter_column_values row by row, so that errors match the csv parser.
+
+    The fast parser knows nothing of quoting, so if the quote character
+    appears, the rest of csvfile from that block on is read with csv.
+
+    >>> from cStringIO import StringIO
+    >>> text = 'h1;h2\\na;b.com\\nc;d\\n'
+    >>> list(iter_delimited_columns(StringIO(text), ';', True, [2], 1))
+    [(2, ['b.com', 'com', 'd'])]
+    >>> text = 'h1;h2\\na;b\\n|c;1|;d\\n'
+    >>> list(iter_delimited_columns(StringIO(text), ';', False, [1], 1))
+    [(1, ['a', 'c;1'])]
+    """
+
+    debug("Opening delimited file with delimiter %s\n" % delimiter)
+    with BackgroundIterator(_iter_line_chunks(csvfile, buffer_size),
+                            batch_items=1) as chunks:
+        for column_chunk in _iter_delimited_chunk_columns(
+                chunks, delimiter, recursive_domains, limit_fields,
+                skip_lines, stats, buffer_size):
+            yield column_chunk
+
+
+def _iter_delimited_chunk_columns(chunks, delimiter, recursive_domains,
+                                  limit_fields, skip_lines, stats,
+                                  buffer_size):
+    """
+    The body of iter_delimited_columns, over chunks, an iterable of blocks
+    of lines read from the file on a background thread.
+    """
+    width = max(field_numbers(limit_fields) or [0])
+    groups = composite_groups(limit_fields)
+    column_numbers = sorted(set(limit_fields) - set(dict(groups)))
+    expanders = new_domain_expanders(stats)
+    count_delimiters = methodcaller('count', delimiter)
+
+    chunks = iter(chunks)
+    for chunk in chunks:
+        while skip_lines and chunk:
+            end = chunk.find('\n') + 1 or len(chunk)
+            debug("Skipping %s\n" % chunk[:end])
+            chunk = chunk[end:]
+            skip_lines -= 1
+        if not chunk:
+            continue
+
+        if '\r' in chunk:
+            chunk = chunk.replace('\r\n', '\n')
+        if _QUOTECHAR in chunk or '\r' in chunk:
+            debug("Quoting found, continuing with the csv parser\n")
+            csv_reader = csv.reader(
+                _iter_chunk_lines(chain([chunk], chunks)),
+                delimiter=delimiter, quotechar=_QUOTECHAR)
+            for column_chunk in _group_column_values(iter_column_values(
+                    csv_reader, limit_fields, recursive_domains, stats=stats,
+                    expanders=expanders), buffer_size):
+                yield column_chunk
+            return
+
+        if chunk.endswith('\n'):
+            chunk = chunk[:-1]
+        rows = chunk.split('\n')
+        if stats.enabled:
+            stats.rows_read += len(rows)
+
+        column = None
+        numbers = column_numbers
+        if '' not in rows:
+            num_fields = set(map(count_delimiters, rows))
+            if len(num_fields) == 1 and num_fields.pop() + 1 >= width:
+                # Every row has the same number of fields, so split the block
+                # as if it were one row and take every num_fields'th value.
+                num_fields = rows[0].count(delimiter) + 1
+                fields = chunk.replace('\n', delimiter).split(delimiter)
+                column = lambda number: fields[number - 1::num_fields]
+                if not limit_fields:
+                    numbers = range(1, num_fields + 1)
+            elif limit_fields:
+                split_rows = [row.split(delimiter, width) for row in rows]
+                if min(map(len, split_rows)) >= width:
+                    column = lambda number: map(itemgetter(number - 1),
+                                                split_rows)
+
+        if column is None:
+            split_rows = [row.split(delimiter) if row else [] for row in rows]
+            for column_chunk in _group_column_values(iter_column_values(
+                    split_rows, limit_fields, recursive_domains,
+                    expanders=expanders), len(rows) + 1):
+                yield column_chunk
+            continue
+
+        for column_number in numbers:
+            values = column(column_number)
+            if recursive_domains:
+                values = _expand_domain_values(expanders[column_number],
+                                               values)
+            yield (column_number, values)
+
+        for (label, group_fields) in groups:
+            yield (label, map(composite_key, izip(*map(column,
+                                                       group_fields))))
+
+
+def _iter_line_chunks(f, size):
+    """
+    Yield the text of the file-like object f in blocks of about size bytes,
+    each ending at the end of a line except perhaps the last.
+    """
+    pending = ''
+    while True:
+        data = f.read(size)
+        if not data:
+            break
+        text = pending + data
+        end = text.rfind('\n') + 1
+        if end:
+            yield text[:end]
+            pending = text[end:]
+        else:
+            pending = text
+    if pending:
+        yield pending
+
+
+def _iter_chunk_lines(chunks):
+    """Yield each line, with its line ending, of blocks of whole lines."""
+    for chunk in chunks:
+        lines = chunk.split('\n')
+        for line in lines[:-1]:
+            yield line + '\n'
+        if lines[-1]:
+            yield lines[-1]
+
+
+def _group_column_values(column_values, size):
+    """
+    Collect (column_number, value) pairs into (column_number, values) pairs,
+    holding at most size values at a time.
+    """
+    pending = defaultdict(list)
+    num_pending = 0
+    for (column_number, value) in column_values:
+        pending[column_number].append(value)
+        num_pending += 1
+        if num_pending >= size:
+            for column_chunk in sorted(pending.items()):
+                yield column_chunk
+            pending = defaultdict(list)
+            num_pending = 0
+
+    for column_chunk in sorted(pending.items()):
+        yield column_chunk
+
+
+def _expand_domain_values(expander, values):
+    """Return values with each domain replaced by its new sub-parts."""
+    expanded = []
+    for (value, value_is_domain) in izip(values, is_domain_many(values)):
+        if value_is_domain:
+            expanded.extend(expander.expand(value))
+        else:
+            expanded.append(value)
+    return expanded
+
+
+def composite_groups(limit_fields):
+    """
+    Return a (label, field_numbers) pair for each composite group label in
+    limit_fields.
+
+    >>> composite_groups([2, '1+3'])
+    [('1+3', [1, 3])]
+    """
+    return [(label, map(int, label.split(COMPOSITE_JOINER)))
+            for label in limit_fields if isinstance(label, basestring)]
+
+
+def field_numbers(limit_fields):
+    """
+    Return the field numbers in limit_fields, including those in its
+    composite groups.
+
+    >>> field_numbers([2, '1+3'])
+    [2, 1, 3]
+    """
+    numbers = []
+    for field in limit_fields:
+        if isinstance(field, basestring):
+            numbers.extend(map(int, field.split(COMPOSITE_JOINER)))
+        else:
+            numbers.append(field)
+    return numbers
+
+
+def composite_key(values):
+    """
+    Return the key indexed for the values of a composite group's fields in
+    one row. It is empty, so is not indexed, if all of the values are.
+
+    >>> composite_key(['alice', 'example.com'])
+    'alice\\x1fexample.com'
+    >>> composite_key(['', ''])
+    ''
+    """
+    key = COMPOSITE_SEPARATOR.join(values)
+    if len(key) == len(values) - 1:
+        return ''
+    return key
 
 
 def check_field_numbers_all_in_row(row, limit_fields):
@@ -363,7 +2033,7 @@ def check_field_numbers_all_in_row(row, limit_fields):
     InvalidArgument: Field 4 invalid for 3-field CSV file.
     """
 
-    for field_number in limit_fields:
+    for field_number in field_numbers(limit_fields):
         try:
             row[field_number - 1]
         except IndexError:
@@ -371,7 +2041,8 @@ def check_field_numbers_all_in_row(row, limit_fields):
                 field_number, len(row)))
 
 
-def get_values_by_column(csv_reader, limit_fields, expand_domains=False):
+def get_values_by_column(csv_reader, limit_fields, expand_domains=False,
+                         stats=NULL_STATS):
     """
     From a CSV reader object, returns a dictionary where the column number
     (1-indexed) maps to a list of values for that column. If a value is a valid
@@ -386,6 +2057,36 @@ def get_values_by_column(csv_reader, limit_fields, expand_domains=False):
     """
 
     data = defaultdict(list)
+    for (column_number, value) in iter_column_values(
+            csv_reader, limit_fields, expand_domains, stats=stats):
+        data[column_number].append(value)
+
+    return dict(data)
+
+
+def iter_column_values(csv_reader, limit_fields, expand_domains=False,
+                       stats=NULL_STATS, expanders=None):
+    """
+    Yield a (column_number, value) pair for each value in each row of the CSV
+    reader object, expanding domains as for get_values_by_column. Domain
+    suffixes already produced for a column are not produced again, since the
+    consumer is building a set of values anyway.
+
+    Rows read and domains expanded are counted into stats when it is enabled.
+    The DomainExpander per column may be passed in as expanders, as returned
+    by new_domain_expanders.
+
+    >>> rows = [['Red', 'www.apple.com'], ['Blue', 'web.apple.com']]
+    >>> list(iter_column_values(rows, [2], True))
+    [(2, 'www.apple.com'), (2, 'apple.com'), (2, 'com'), (2, 'web.apple.com')]
+    """
+
+    if stats.enabled:
+        csv_reader = stats.counted_rows(csv_reader)
+    if expanders is None:
+        expanders = new_domain_expanders(stats)
+    groups = composite_groups(limit_fields)
+
     for row in csv_reader:
         check_field_numbers_all_in_row(row, limit_fields)  # raises
         for (column_number, value) in enumerate(row, start=1):
@@ -393,11 +2094,27 @@ def get_values_by_column(csv_reader, limit_fields, expand_domains=False):
                 continue
 
             if expand_domains and is_domain(value):
-                data[column_number].extend(recurse_domain(value))
+                for sub_part in expanders[column_number].expand(value):
+                    yield (column_number, sub_part)
             else:
-                data[column_number].append(value)
+                yield (column_number, value)
 
-    return dict(data)
+        for (label, group_fields) in groups:
+            yield (label, composite_key([row[field_number - 1]
+                                         for field_number in group_fields]))
+
+
+def new_domain_expanders(stats=NULL_STATS):
+    """
+    Return a dictionary which creates a DomainExpander for each column on
+    demand, counting and timing their work into stats when it is enabled.
+    """
+    if not stats.enabled:
+        return defaultdict(DomainExpander)
+
+    expanders = defaultdict(partial(CountingDomainExpander, stats=stats))
+    stats.expanders.append(expanders)
+    return expanders
 
 
 def skip_header_lines(csv_reader, num_lines):
@@ -423,45 +2140,308 @@ def recurse_domain(domain):
     return sub_parts
 
 
+class DomainExpander(object):
+    """
+    Expands domains into their sub-parts as recurse_domain does, but skips
+    any sub-part it has produced recently. A sub-part is only ever produced
+    together with all of its own sub-parts, so expansion stops at the first
+    one that has been seen before. That makes repeated domains and shared
+    suffixes such as 'com' or 'co.uk' cost a single lookup each.
+
+    Memory is bounded by keeping two generations of at most max_size
+    sub-parts: when the newer one fills it replaces the older, and sub-parts
+    found in the older generation are moved forward.
+
+    >>> expander = DomainExpander()
+    >>> expander.expand('www.google.co.uk')
+    ['www.google.co.uk', 'google.co.uk', 'co.uk', 'uk']
+    >>> expander.expand('mail.google.co.uk')
+    ['mail.google.co.uk']
+    >>> expander.expand('mail.google.co.uk')
+    []
+    """
+
+    def __init__(self, max_size=_DOMAIN_SUFFIX_CACHE_SIZE):
+        self.max_size = max_size
+        self._recent = set()
+        self._older = set()
+
+    def expand(self, domain):
+        """Return the sub-parts of domain not produced recently."""
+        recent = self._recent
+        if domain in recent:
+            return []
+
+        sub_parts = []
+        start = 0
+        while True:
+            sub_part = domain[start:]
+            if sub_part in recent:
+                break
+            recent.add(sub_part)
+            if sub_part in self._older:
+                break
+            sub_parts.append(sub_part)
+            start = domain.find('.', start) + 1
+            if not start:
+                break
+
+        if len(recent) >= self.max_size:
+            self._older = recent
+            self._recent = set()
+        return sub_parts
+
+
+class CountingDomainExpander(DomainExpander):
+    """
+    A DomainExpander which counts the domains it expands and the sub-parts
+    it skips, for build metrics. The time spent expanding is added to the
+    'expand' stage of stats.
+
+    >>> expander = CountingDomainExpander()
+    >>> expander.expand('www.google.com')
+    ['www.google.com', 'google.com', 'com']
+    >>> expander.expand('mail.google.com')
+    ['mail.google.com']
+    >>> (expander.domains, expander.sub_parts_skipped)
+    (2, 2)
+    """
+
+    def __init__(self, max_size=_DOMAIN_SUFFIX_CACHE_SIZE, stats=NULL_STATS):
+        super(CountingDomainExpander, self).__init__(max_size)
+        self.stats = stats
+        self.domains = 0
+        self.sub_parts_skipped = 0
+
+    def expand(self, domain):
+        start = time.time()
+        sub_parts = super(CountingDomainExpander, self).expand(domain)
+        self.stats.add_time('expand', time.time() - start)
+        self.domains += 1
+        self.sub_parts_skipped += domain.count('.') + 1 - len(sub_parts)
+        return sub_parts
+
+
 def out_filename(infile, column_number):
     """
-    Return the output filename for this input filename and column.
+    Return the output filename for this input filename and column, which
+    may be the label of a composite group.
     >>> out_filename('test.csv', 1)
     'test.csv.1.bfindex'
+    >>> out_filename('test.csv', '1+3')
+    'test.csv.1+3.bfindex'
+    """
+    return "%s.%s.bfindex" % (infile, column_number)
+
+
+def write_shard_manifest(infile, sharding):
+    """
+    Write the manifest of the shards of the indexes of infile, named by
+    shards.manifest_filename, listing every shard of every column whether
+    or not sharding kept it, so that builds of separate shards agree.
+    """
+    sharding.write_manifest(manifest_filename(infile),
+                            lambda label: out_filename(infile, label))
+
+
+def open_index_writer(out_prefix, column_numbers, container=DEFAULT_CONTAINER,
+                      stats=NULL_STATS):
+    """
+    Return a context manager whose write(column_number, bloom_filter) method
+    saves a column's filter and returns the name it is saved under. Each
+    column is saved to the file out_filename names, in the background, or
+    with container, all of column_numbers are saved in one index_container
+    named by container_filename. Either way, every filter is in place once
+    the writer is closed. Closing it, which waits for the background writes
+    or finishes the container, is timed into the 'write' stage of stats, so
+    that with the calls to write the stage covers all the time spent
+    waiting on writes.
+    """
+    if container:
+        writer = ContainerWriter(container_filename(out_prefix),
+                                 column_numbers)
+    else:
+        writer = _ColumnFileWriter(out_prefix)
+    return _TimedClose(writer, stats)
+
+
+class _TimedClose(object):
+    """
+    Wraps a writer for open_index_writer, timing its closing into the
+    'write' stage of stats.
+    """
+
+    def __init__(self, writer, stats):
+        self.writer = writer
+        self.stats = stats
+
+    def __enter__(self):
+        return self.writer.__enter__()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        with self.stats.timer('write'):
+            return self.writer.__exit__(exc_type, exc_value, traceback)
+
+
+class _ColumnFileWriter(object):
+    """
+    Saves each column's filter to its own file, for open_index_writer. The
+    files are written by a pipeline.BackgroundWriter, so that the next
+    column's filter is built while the last one is written, and are only
+    all in place once the writer is closed.
     """
-    return "%s.%d.bfindex" % (infile, column_number)
+
+    def __init__(self, out_prefix):
+        self.out_prefix = out_prefix
+        self._writer = BackgroundWriter()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return self._writer.__exit__(exc_type, exc_value, traceback)
+
+    def write(self, column_number, bloom_filter):
+        out_fn = out_filename(self.out_prefix, column_number)
+        self._writer.write(bloom_filter, out_fn)
+        return out_fn
 
 
-def create_bloom_filter(values, error_rate):
+def create_bloom_filter(values, error_rate, engine=DEFAULT_ENGINE,
+                        filter_type=DEFAULT_FILTER_TYPE):
     """
     Create a BloomFilter object with the given error rate and a capacity
     given by the number of unique items in values. Add each value in values
     to the BloomFilter and return.
     """
-    value_set = set(filter(lambda x: len(x), values))
+    value_set = distinct_values(values)
 
     debug("Creating bloom filter, capacity=%d, error_rate=%f (%.4f%%)\n" % (
         len(value_set), error_rate, 100 * error_rate))
-    b = BloomFilter(capacity=len(value_set), error_rate=error_rate)
-    for value in value_set:
-        debug("Adding '%s'\n" % value)
-        b.add(value)
+    if _VERBOSE:
+        for value in value_set:
+            debug("Adding '%s'\n" % value)
+
+    b = new_bloom_filter(max(1, len(value_set)), error_rate, engine,
+                         filter_type)
+    add_values(b, value_set)
 
     return (b, len(value_set))
 
 
+def distinct_values(values):
+    """
+    Return the set of the non-empty values in values.
+
+    >>> sorted(distinct_values(['b', '', 'a', 'b']))
+    ['a', 'b']
+    """
+    value_set = set(values)
+    value_set.discard('')
+    return value_set
+
+
+def new_bloom_filter(capacity, error_rate, engine=DEFAULT_ENGINE,
+                     filter_type=DEFAULT_FILTER_TYPE):
+    """
+    Return an empty filter of the given filter type, built by the given
+    engine if it is a Bloom filter. All of them share the interface
+    create_index relies on: add/add_many, membership tests, count, capacity
+    and tofile.
+    """
+    if filter_type == 'cuckoo':
+        return CuckooFilter(capacity, error_rate)
+    elif filter_type == 'xor':
+        return XorFilter(capacity, error_rate)
+    elif filter_type == 'binary-fuse':
+        return BinaryFuseFilter(capacity, error_rate)
+    elif engine == 'numpy':
+        return NumpyBloomFilter(capacity, error_rate, scheme=SCHEME_DOUBLE)
+    elif engine == 'numpy-compat':
+        return NumpyBloomFilter(capacity, error_rate, scheme=SCHEME_PYBLOOM)
+    elif engine == 'blocked':
+        return BlockedBloomFilter(capacity, error_rate)
+    return BloomFilter(capacity=capacity, error_rate=error_rate)
+
+
+def add_column_values(blooms, column_values):
+    """
+    Add each non-empty value from an iterable of (column_number, value) pairs
+    to the filter for its column in the dictionary blooms, buffering at most
+    _STREAMING_BATCH_SIZE values per column between batch inserts.
+
+    column_values is iterated, and so read and parsed, on a background
+    thread (a pipeline.BackgroundIterator) which hands over whole batches,
+    so that it overlaps the inserts.
+    """
+    with BackgroundIterator(_iter_value_batches(column_values,
+                                                _STREAMING_BATCH_SIZE),
+                            batch_items=1) as batches:
+        for (column_number, batch) in batches:
+            add_values(blooms[column_number], batch)
+
+
+def _iter_value_batches(column_values, size):
+    """
+    Collect the non-empty values of (column_number, value) pairs into
+    (column_number, values) pairs of size values per column, and then what
+    is left of each column.
+
+    >>> list(_iter_value_batches([(1, 'a'), (2, 'b'), (1, ''), (1, 'c')], 2))
+    [(1, ['a', 'c']), (2, ['b'])]
+    """
+    pending = defaultdict(list)
+    for (column_number, value) in column_values:
+        if value:
+            batch = pending[column_number]
+            batch.append(value)
+            if len(batch) >= size:
+                yield (column_number, batch)
+                pending[column_number] = []
+
+    for (column_number, batch) in pending.items():
+        if batch:
+            yield (column_number, batch)
+
+
+def append_to_bloom_filter(bloom_filter, values, error_rate):
+    """
+    Add each unique value in values which is not already present to
+    bloom_filter. If bloom_filter lacks the capacity for them, a layer is
+    added so the false positive rate stays within error_rate. Returns the
+    filter to be written, which may not be bloom_filter itself.
+    """
+    value_set = list(distinct_values(values))
+    new_values = [value for (value, found) in
+                  zip(value_set, probe_many(bloom_filter, value_set))
+                  if not found]
+
+    debug("Appending %d new values to filter with count=%d, capacity=%d\n" % (
+        len(new_values), bloom_filter.count, bloom_filter.capacity))
+    try:
+        bloom_filter = reserve_capacity(bloom_filter, len(new_values),
+                                        error_rate)
+    except ValueError as e:
+        raise InvalidArgument("Cannot append %d values: %s" % (
+            len(new_values), e))
+    add_values(bloom_filter, new_values)
+
+    return bloom_filter
+
+
 def write_bloom_filter(bloom_filter, out_filename):
-    """Write a BloomFilter instance to the given filename."""
-    with open(out_filename, 'wb') as out_file:
-        bloom_filter.tofile(out_file)
+    """
+    Write a BloomFilter instance to the given filename, replacing it in one
+    step (see pipeline.write_atomically).
+    """
+    write_atomically(out_filename, bloom_filter.tofile)
 
 
 if __name__ == '__main__':
-    try:
-        from pybloom import BloomFilter
-    except ImportError, e:
+    if BloomFilter is None:
         sys.stderr.write("\nError: Failed to import pybloom: %s\n"
-                         "Have you installed 'python-bloomfilter'?\n\n" % e)
+                         "Have you installed 'python-bloomfilter'?\n\n" %
+                         _PYBLOOM_IMPORT_ERROR)
         usage()
         sys.exit(_EXITCODE_IMPORT_ERROR)
     else:
@@ -0,0 +1,471 @@
+#!/usr/bin/python
+
+# Copyright (c) 2013, Paul Michael Furley <paul@paulfurley.com>
+# All rights reserved.
+
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+
+# - Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+# - Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# - Neither the name of the <ORGANIZATION> nor the names of its contributors
+#   may be used to endorse or promote products derived from this software
+#   without specific prior written permission.
+
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+DEFAULT_KEYS = '-'     # '-' means read keys from stdin
+DEFAULT_BATCH_SIZE = 65536
+DEFAULT_INDEX_DOMAINS_RECURSIVELY = False
+DEFAULT_HITS_ONLY = False
+DEFAULT_MISSES_ONLY = False
+DEFAULT_COMPOSITE = False
+DEFAULT_COLUMNS = []   # Empty list means every column of each index
+DEFAULT_NORMALIZE = []  # Empty list means keys are probed as they are
+
+_VERBOSE = False       # switched by the --verbose argument
+
+_EXITCODE_OK = 0
+_EXITCODE_IMPORT_ERROR = 1
+_EXITCODE_INVALID_ARG = 2
+_EXITCODE_MISSING_ARG = 3
+
+import os
+import sys
+import time
+import getopt
+from isdomain import is_domain
+from bfindex import load_filter, probe_many
+from index_container import IndexContainer, is_container, container_member
+from shards import (ShardedIndex, MissingShard, is_shard_manifest,
+                    read_manifest)
+from generations import (GenerationalIndex, is_generation_manifest,
+                         read_manifest as read_generation_manifest)
+from normalize import Normalizer
+from bloom_indexer import (InvalidArgument, MissingArgument, recurse_domain,
+                           composite_key, validate_normalize)
+
+try:
+    from numpy_bloom import NumpyBloomFilter
+except ImportError:
+    NumpyBloomFilter = None
+
+try:
+    from pybloom import BloomFilter
+except ImportError, e:
+    BloomFilter = None
+    _PYBLOOM_IMPORT_ERROR = e
+
+
+class Conf:
+    """Provides the keys to the config dictionary."""
+    Indexes = 'indexes'
+    Keys = 'keys'
+    BatchSize = 'batch-size'
+    IndexDomainsRecursively = 'index-domains-recursively'
+    HitsOnly = 'hits-only'
+    MissesOnly = 'misses-only'
+    Composite = 'composite'
+    Columns = 'columns'
+    Normalize = 'normalize'
+
+
+def main():
+    try:
+        config = parse_arguments(sys.argv)
+        if not config:
+            sys.exit(_EXITCODE_OK)
+
+        blooms = load_indexes(config[Conf.Indexes], config[Conf.Columns])
+
+        if config[Conf.Keys] == '-':
+            key_file = sys.stdin
+        else:
+            key_file = open(config[Conf.Keys], 'rU')
+
+        start = time.time()
+        try:
+            (num_keys, num_hits) = query_indexes(
+                blooms,
+                key_file,
+                sys.stdout,
+                config[Conf.BatchSize],
+                config[Conf.IndexDomainsRecursively],
+                config[Conf.HitsOnly],
+                config[Conf.MissesOnly],
+                config[Conf.Composite],
+                config[Conf.Normalize])
+        except MissingShard, e:
+            raise InvalidArgument(e)
+        elapsed = max(time.time() - start, 1e-9)
+
+        sys.stderr.write("%d keys probed, %d hits in %.3fs (%.0f keys/s)\n" % (
+            num_keys, num_hits, elapsed, num_keys / elapsed))
+
+    except InvalidArgument, e:
+        sys.stderr.write("\nInvalid argument: %s\n" % e)
+        usage()
+        sys.exit(_EXITCODE_INVALID_ARG)
+
+    except MissingArgument, e:
+        sys.stderr.write("\nMissing required argument(s): %s\n" % e)
+        usage()
+        sys.exit(_EXITCODE_MISSING_ARG)
+
+
+def parse_arguments(argv):
+    """
+    Parse out whatever arguments are available on the command line and call the
+    approriate validate function on them. Throw InvalidArgument or
+    MissingArgument.
+    """
+    try:
+        (opts, args) = getopt.getopt(
+            argv[1:],
+            "b:k:n:rHMchv",
+            ['index=', 'keys=', 'batch-size=', 'index-domains-recursively',
+             'hits-only', 'misses-only', 'composite', 'column=', 'normalize=',
+             'help', 'verbose'])
+    except getopt.GetoptError as err:
+        raise InvalidArgument(err)
+
+    if args:
+        raise InvalidArgument(' '.join(args))
+
+    config = {
+        Conf.Indexes: [],
+        Conf.Keys: DEFAULT_KEYS,
+        Conf.BatchSize: DEFAULT_BATCH_SIZE,
+        Conf.IndexDomainsRecursively: DEFAULT_INDEX_DOMAINS_RECURSIVELY,
+        Conf.HitsOnly: DEFAULT_HITS_ONLY,
+        Conf.MissesOnly: DEFAULT_MISSES_ONLY,
+        Conf.Composite: DEFAULT_COMPOSITE,
+        Conf.Columns: list(DEFAULT_COLUMNS),
+        Conf.Normalize: DEFAULT_NORMALIZE,
+    }
+
+    for (opt, arg) in opts:
+        if opt in ('-b', '--index'):
+            config[Conf.Indexes].append(validate_index_file(arg))
+
+        elif opt in ('-k', '--keys'):
+            config[Conf.Keys] = validate_keys(arg)
+
+        elif opt in ('-n', '--batch-size'):
+            config[Conf.BatchSize] = validate_batch_size(arg)
+
+        elif opt in ('-r', '--index-domains-recursively'):
+            config[Conf.IndexDomainsRecursively] = True
+
+        elif opt in ('-H', '--hits-only'):
+            config[Conf.HitsOnly] = True
+
+        elif opt in ('-M', '--misses-only'):
+            config[Conf.MissesOnly] = True
+
+        elif opt in ('-c', '--composite'):
+            config[Conf.Composite] = True
+
+        elif opt == '--column':
+            config[Conf.Columns].append(arg)
+
+        elif opt == '--normalize':
+            config[Conf.Normalize] = validate_normalize(arg)
+
+        elif opt in ('-v', '--verbose'):
+            global _VERBOSE
+            _VERBOSE = True
+
+        elif opt in ('-h', '--help'):
+            usage()
+            return None
+
+    if not config[Conf.Indexes]:
+        raise MissingArgument(Conf.Indexes)
+
+    if config[Conf.HitsOnly] and config[Conf.MissesOnly]:
+        raise InvalidArgument("hits-only and misses-only are exclusive")
+
+    if config[Conf.Composite] and config[Conf.IndexDomainsRecursively]:
+        raise InvalidArgument("composite cannot be combined with "
+                              "index-domains-recursively")
+
+    return config
+
+
+def validate_index_file(arg):
+    """
+    Validate that the index filename is a valid file.
+
+    >>> validate_index_file('/non/existent/file')
+    Traceback (most recent call last):
+    ...
+    InvalidArgument: index is not a file: '/non/existent/file'
+    """
+    if not os.path.isfile(arg):
+        raise InvalidArgument("index is not a file: '%s'" % arg)
+    return arg
+
+
+def validate_keys(arg):
+    """
+    Validate that the keys filename is '-' (stdin) or a valid file.
+
+    >>> validate_keys('-')
+    '-'
+    """
+    if arg != '-' and not os.path.isfile(arg):
+        raise InvalidArgument("keys is not a file: '%s'" % arg)
+    return arg
+
+
+def validate_batch_size(arg):
+    """
+    Convert to integer and validate that the value is >= 1
+    >>> validate_batch_size('1000')
+    1000
+
+    >>> validate_batch_size('0')
+    Traceback (most recent call last):
+    ...
+    InvalidArgument: batch-size must be at least 1: '0'
+    """
+    try:
+        size = int(arg)
+    except ValueError:
+        raise InvalidArgument("batch-size not an integer: '%s'" % arg)
+
+    if size < 1:
+        raise InvalidArgument("batch-size must be at least 1: '%s'" % arg)
+
+    return size
+
+
+def usage():
+    text = (
+        "\nUsage: %s -b <file.bfindex> [-k <keys.txt>]\n\n"
+        "  -b, --index=FILENAME             "
+        "probe the index, container or manifest FILENAME (repeatable)\n"
+        "      --column=LABEL               "
+        "only load column LABEL of containers and manifests (repeatable)\n"
+        "  -k, --keys=FILENAME              "
+        "read keys, one per line, from FILENAME [default stdin]\n"
+        "  -n, --batch-size=NUMBER          "
+        "probe NUMBER keys at a time [default %d]\n"
+        "  -r, --index-domains-recursively  "
+        "expand domains to subdomain components [default %s].\n"
+        "  -H, --hits-only                  "
+        "only output keys which were found\n"
+        "  -M, --misses-only                "
+        "only output keys which were not found\n"
+        "  -c, --composite                  "
+        "keys are tab-separated values for a --composite index\n"
+        "      --normalize=STEPS            "
+        "normalize keys with the steps the indexes were built with\n"
+        "  -v, --verbose                    "
+        "produce output to stderr\n"
+        "  -h, --help                       "
+        "display this message.\n\n"
+        "Each key is written to stdout as 'hit<TAB>key<TAB>indexes' or\n"
+        "'miss<TAB>key', where indexes lists the files containing the key.\n"
+        "The values of a composite key are written separated by the ASCII\n"
+        "unit separator, as they are indexed.\n"
+        "\n" % (sys.argv[0], DEFAULT_BATCH_SIZE,
+                DEFAULT_INDEX_DOMAINS_RECURSIVELY))
+    sys.stderr.write(text)
+
+
+def debug(text):
+    """Print text to stderr if _VERBOSE has been set."""
+    if _VERBOSE:
+        sys.stderr.write(text)
+
+
+def load_bloom_filter(path, use_mmap=True):
+    """
+    Load the filter in the file named by path. Files are memory mapped when
+    NumPy is available, unless use_mmap is False, so they open without
+    copying and probe a batch of keys at once.
+    """
+    debug("Loading %s\n" % path)
+    return load_filter(path, use_mmap=use_mmap)
+
+
+def load_indexes(paths, columns=DEFAULT_COLUMNS, use_mmap=True):
+    """
+    Return a (name, filter) pair for each index file named in paths, loaded
+    as load_bloom_filter does. An index container stands for the filters of
+    its columns, named by container_member; only the columns whose labels
+    are in columns are loaded, unless it is empty. A shard manifest stands
+    for the columns it lists in the same way, each a shards.ShardedIndex
+    which loads a shard only once a key is routed to it, and so does a
+    generation manifest, each column a generations.GenerationalIndex of its
+    unexpired generations.
+    """
+    blooms = []
+    for path in paths:
+        if is_generation_manifest(path):
+            manifest = read_generation_manifest(path)
+            generation_files = dict(manifest)
+            for label in (columns or [label for (label, _) in manifest]):
+                if label not in generation_files:
+                    raise InvalidArgument("no column %s in generation "
+                                          "manifest '%s'" % (label, path))
+                debug("Loading generations of column %s of %s\n" % (label,
+                                                                   path))
+                blooms.append((container_member(path, label),
+                               GenerationalIndex(generation_files[label],
+                                                 use_mmap)))
+            continue
+
+        if is_shard_manifest(path):
+            manifest = read_manifest(path)
+            shard_files = dict(manifest)
+            for label in (columns or [label for (label, _) in manifest]):
+                if label not in shard_files:
+                    raise InvalidArgument("no column %s in shard manifest "
+                                          "'%s'" % (label, path))
+                blooms.append((container_member(path, label),
+                               ShardedIndex(shard_files[label], use_mmap)))
+            continue
+
+        if not is_container(path):
+            blooms.append((path, load_bloom_filter(path, use_mmap)))
+            continue
+
+        with IndexContainer(path, use_mmap=use_mmap) as container:
+            for label in (columns or container.labels):
+                if label not in container:
+                    raise InvalidArgument("no column %s in container '%s'" %
+                                          (label, path))
+                debug("Loading column %s of %s\n" % (label, path))
+                blooms.append((container_member(path, label),
+                               container.load(label)))
+    return blooms
+
+
+def query_indexes(blooms, key_file, out_file, batch_size=DEFAULT_BATCH_SIZE,
+                  recursive_domains=DEFAULT_INDEX_DOMAINS_RECURSIVELY,
+                  hits_only=DEFAULT_HITS_ONLY,
+                  misses_only=DEFAULT_MISSES_ONLY,
+                  composite=DEFAULT_COMPOSITE, normalize=DEFAULT_NORMALIZE):
+    """
+    Read keys, one per line, from key_file and probe them in batches of
+    batch_size against each of blooms, a list of (name, filter) pairs.
+    Results are written to out_file as each batch completes. Domains are
+    expanded with recurse_domain when recursive_domains is set, so that each
+    of the values the indexer would have added is probed. With composite,
+    each line holds the tab-separated values of a composite group. Keys
+    are normalized by the steps in normalize, which must be those the
+    indexes were built with. Returns a tuple of (keys probed, keys found).
+    """
+    num_keys = 0
+    num_hits = 0
+    normalizer = Normalizer(normalize) if normalize else None
+    for batch in iter_key_batches(key_file, batch_size, recursive_domains,
+                                  composite, normalizer):
+        (lines, batch_hits) = format_results(blooms, batch, hits_only,
+                                             misses_only)
+        out_file.write(''.join(lines))
+        out_file.flush()
+        num_hits += batch_hits
+        num_keys += len(batch)
+        debug("%d keys probed\n" % num_keys)
+
+    return (num_keys, num_hits)
+
+
+def format_results(blooms, batch, hits_only=DEFAULT_HITS_ONLY,
+                   misses_only=DEFAULT_MISSES_ONLY):
+    """
+    Probe the keys in batch against each of blooms, a list of (name, filter)
+    pairs. Returns (lines, hits): the output line for each key, which is
+    empty when hits_only or misses_only leaves the key out, and the number
+    of keys found.
+    """
+    found = [probe_many(bloom, batch) for (_, bloom) in blooms]
+    lines = []
+    num_hits = 0
+    for (i, key) in enumerate(batch):
+        hit_names = [name for ((name, _), hits) in zip(blooms, found)
+                     if hits[i]]
+        if hit_names:
+            num_hits += 1
+            if misses_only:
+                lines.append('')
+            else:
+                lines.append("hit\t%s\t%s\n" % (key, ','.join(hit_names)))
+        elif hits_only:
+            lines.append('')
+        else:
+            lines.append("miss\t%s\n" % key)
+    return (lines, num_hits)
+
+
+def iter_key_batches(key_file, batch_size, recursive_domains=False,
+                     composite=False, normalizer=None):
+    """
+    Yield lists of at most batch_size keys read one per line from key_file,
+    skipping blank lines. With composite, the tab-separated values on each
+    line are joined into the key indexed for a composite group. Keys are
+    normalized by normalizer, a normalize.Normalizer, if given, before
+    domains are expanded, as the indexer does.
+
+    >>> list(iter_key_batches(['a\\n', '\\n', 'www.b.com\\n'], 2, True))
+    [['a', 'www.b.com'], ['b.com', 'com']]
+    >>> list(iter_key_batches(['a\\tb.com\\n'], 2, composite=True))
+    [['a\\x1fb.com']]
+    >>> list(iter_key_batches(['WWW.B.com.\\n', ' \\n'], 4, True,
+    ...                       normalizer=Normalizer(['space', 'case', 'dot'])))
+    [['www.b.com', 'b.com', 'com']]
+    """
+    batch = []
+    for line in key_file:
+        key = line.rstrip('\r\n')
+        if not key:
+            continue
+
+        if composite:
+            key = composite_key(key.split('\t'))
+        if normalizer is not None:
+            key = normalizer.normalize(key)
+            if not key:
+                continue
+
+        if composite:
+            batch.append(key)
+        elif recursive_domains and is_domain(key):
+            batch.extend(recurse_domain(key))
+        else:
+            batch.append(key)
+
+        while len(batch) >= batch_size:
+            yield batch[:batch_size]
+            batch = batch[batch_size:]
+
+    if batch:
+        yield batch
+
+
+if __name__ == '__main__':
+    if BloomFilter is None and NumpyBloomFilter is None:
+        sys.stderr.write("\nError: Failed to import pybloom: %s\n"
+                         "Have you installed 'python-bloomfilter'?\n\n" %
+                         _PYBLOOM_IMPORT_ERROR)
+        usage()
+        sys.exit(_EXITCODE_IMPORT_ERROR)
+    else:
+        main()
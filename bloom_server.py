@@ -0,0 +1,550 @@
+#!/usr/bin/python
+
+# Copyright (c) 2013, Paul Michael Furley <paul@paulfurley.com>
+# All rights reserved.
+
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+
+# - Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+# - Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# - Neither the name of the <ORGANIZATION> nor the names of its contributors
+#   may be used to endorse or promote products derived from this software
+#   without specific prior written permission.
+
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+DEFAULT_SOCKET = ''    # '' means listen on --port instead
+DEFAULT_PORT = 0
+DEFAULT_RELOAD_INTERVAL = 1.0
+DEFAULT_INDEX_DOMAINS_RECURSIVELY = False
+DEFAULT_HITS_ONLY = False
+DEFAULT_MISSES_ONLY = False
+DEFAULT_COLUMNS = []   # Empty list means every column of each index
+DEFAULT_NORMALIZE = []  # Empty list means keys are probed as they are
+
+LOCALHOST = '127.0.0.1'
+
+_VERBOSE = False       # switched by the --verbose argument
+
+_EXITCODE_OK = 0
+_EXITCODE_IMPORT_ERROR = 1
+_EXITCODE_INVALID_ARG = 2
+_EXITCODE_MISSING_ARG = 3
+
+_RECV_SIZE = 65536
+
+import os
+import sys
+import stat
+import errno
+import getopt
+import signal
+import struct
+import threading
+import SocketServer
+from isdomain import is_domain
+from normalize import Normalizer
+from bloom_indexer import (InvalidArgument, MissingArgument, recurse_domain,
+                           validate_normalize)
+from bloom_query import (validate_index_file, format_results, load_indexes,
+                         BloomFilter, NumpyBloomFilter)
+from shards import MissingShard
+
+
+class Conf:
+    """Provides the keys to the config dictionary."""
+    Indexes = 'indexes'
+    Socket = 'socket'
+    Port = 'port'
+    ReloadInterval = 'reload-interval'
+    Columns = 'columns'
+    IndexDomainsRecursively = 'index-domains-recursively'
+    HitsOnly = 'hits-only'
+    MissesOnly = 'misses-only'
+    Normalize = 'normalize'
+
+
+def main():
+    try:
+        config = parse_arguments(sys.argv)
+        if not config:
+            sys.exit(_EXITCODE_OK)
+
+        indexes = IndexSet(config[Conf.Indexes], config[Conf.Columns])
+        server = create_server(
+            indexes,
+            config[Conf.Socket],
+            config[Conf.Port],
+            config[Conf.IndexDomainsRecursively],
+            config[Conf.HitsOnly],
+            config[Conf.MissesOnly],
+            config[Conf.Normalize])
+
+        stop = threading.Event()
+        watcher = threading.Thread(
+            target=watch_indexes,
+            args=(indexes, config[Conf.ReloadInterval], stop))
+        watcher.daemon = True
+        watcher.start()
+
+        signal.signal(signal.SIGTERM, _terminate)
+        debug("Serving %d indexes on %s\n" % (
+            len(indexes.blooms), config[Conf.Socket] or config[Conf.Port]))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            stop.set()
+            server.server_close()
+            if config[Conf.Socket]:
+                os.unlink(config[Conf.Socket])
+
+    except InvalidArgument, e:
+        sys.stderr.write("\nInvalid argument: %s\n" % e)
+        usage()
+        sys.exit(_EXITCODE_INVALID_ARG)
+
+    except MissingArgument, e:
+        sys.stderr.write("\nMissing required argument(s): %s\n" % e)
+        usage()
+        sys.exit(_EXITCODE_MISSING_ARG)
+
+
+def parse_arguments(argv):
+    """
+    Parse out whatever arguments are available on the command line and call the
+    approriate validate function on them. Throw InvalidArgument or
+    MissingArgument.
+    """
+    try:
+        (opts, args) = getopt.getopt(
+            argv[1:],
+            "b:u:p:R:rHMhv",
+            ['index=', 'column=', 'socket=', 'port=', 'reload-interval=',
+             'index-domains-recursively', 'hits-only', 'misses-only',
+             'normalize=', 'help', 'verbose'])
+    except getopt.GetoptError as err:
+        raise InvalidArgument(err)
+
+    if args:
+        raise InvalidArgument(' '.join(args))
+
+    config = {
+        Conf.Indexes: [],
+        Conf.Socket: DEFAULT_SOCKET,
+        Conf.Port: DEFAULT_PORT,
+        Conf.ReloadInterval: DEFAULT_RELOAD_INTERVAL,
+        Conf.Columns: list(DEFAULT_COLUMNS),
+        Conf.IndexDomainsRecursively: DEFAULT_INDEX_DOMAINS_RECURSIVELY,
+        Conf.HitsOnly: DEFAULT_HITS_ONLY,
+        Conf.MissesOnly: DEFAULT_MISSES_ONLY,
+        Conf.Normalize: DEFAULT_NORMALIZE,
+    }
+
+    for (opt, arg) in opts:
+        if opt in ('-b', '--index'):
+            config[Conf.Indexes].append(validate_index_file(arg))
+
+        elif opt == '--column':
+            config[Conf.Columns].append(arg)
+
+        elif opt in ('-u', '--socket'):
+            config[Conf.Socket] = validate_socket(arg)
+
+        elif opt in ('-p', '--port'):
+            config[Conf.Port] = validate_port(arg)
+
+        elif opt in ('-R', '--reload-interval'):
+            config[Conf.ReloadInterval] = validate_reload_interval(arg)
+
+        elif opt in ('-r', '--index-domains-recursively'):
+            config[Conf.IndexDomainsRecursively] = True
+
+        elif opt in ('-H', '--hits-only'):
+            config[Conf.HitsOnly] = True
+
+        elif opt in ('-M', '--misses-only'):
+            config[Conf.MissesOnly] = True
+
+        elif opt == '--normalize':
+            config[Conf.Normalize] = validate_normalize(arg)
+
+        elif opt in ('-v', '--verbose'):
+            global _VERBOSE
+            _VERBOSE = True
+
+        elif opt in ('-h', '--help'):
+            usage()
+            return None
+
+    if not config[Conf.Indexes]:
+        raise MissingArgument(Conf.Indexes)
+
+    if not config[Conf.Socket] and not config[Conf.Port]:
+        raise MissingArgument("%s or %s" % (Conf.Socket, Conf.Port))
+
+    if config[Conf.Socket] and config[Conf.Port]:
+        raise InvalidArgument("socket and port are exclusive")
+
+    if config[Conf.HitsOnly] and config[Conf.MissesOnly]:
+        raise InvalidArgument("hits-only and misses-only are exclusive")
+
+    return config
+
+
+def validate_socket(arg):
+    """
+    Validate that the socket path is free, or names a socket left behind by
+    an earlier server, and that its directory exists.
+
+    >>> validate_socket('/etc/passwd')
+    Traceback (most recent call last):
+    ...
+    InvalidArgument: socket exists and is not a socket: '/etc/passwd'
+    """
+    if os.path.exists(arg) and not stat.S_ISSOCK(os.stat(arg).st_mode):
+        raise InvalidArgument("socket exists and is not a socket: '%s'" % arg)
+
+    if not os.path.isdir(os.path.dirname(os.path.abspath(arg))):
+        raise InvalidArgument("socket directory does not exist: '%s'" % arg)
+
+    return arg
+
+
+def validate_port(arg):
+    """
+    Convert to integer and validate that the value is a TCP port number.
+
+    >>> validate_port('8015')
+    8015
+
+    >>> validate_port('0')
+    Traceback (most recent call last):
+    ...
+    InvalidArgument: port must be between 1 and 65535: '0'
+    """
+    try:
+        port = int(arg)
+    except ValueError:
+        raise InvalidArgument("port not an integer: '%s'" % arg)
+
+    if not 1 <= port <= 65535:
+        raise InvalidArgument("port must be between 1 and 65535: '%s'" % arg)
+
+    return port
+
+
+def validate_reload_interval(arg):
+    """
+    Convert to float and validate that the value is > 0
+
+    >>> validate_reload_interval('0.5')
+    0.5
+
+    >>> validate_reload_interval('0')
+    Traceback (most recent call last):
+    ...
+    InvalidArgument: reload-interval must be greater than 0: '0'
+    """
+    try:
+        interval = float(arg)
+    except ValueError:
+        raise InvalidArgument("reload-interval not a number: '%s'" % arg)
+
+    if interval <= 0:
+        raise InvalidArgument("reload-interval must be greater than 0: '%s'"
+                              % arg)
+
+    return interval
+
+
+def usage():
+    text = (
+        "\nUsage: %s -b <file.bfindex> (-u <socket> | -p <port>)\n\n"
+        "  -b, --index=FILENAME             "
+        "serve the index, container or manifest FILENAME (repeatable)\n"
+        "      --column=LABEL               "
+        "only load column LABEL of containers and manifests (repeatable)\n"
+        "  -u, --socket=FILENAME            "
+        "listen on the Unix socket FILENAME\n"
+        "  -p, --port=NUMBER                "
+        "listen on TCP port NUMBER of %s\n"
+        "  -R, --reload-interval=SECONDS    "
+        "check for rebuilt indexes every SECONDS [default %s]\n"
+        "  -r, --index-domains-recursively  "
+        "expand domains to subdomain components [default %s].\n"
+        "  -H, --hits-only                  "
+        "only answer with keys which were found\n"
+        "  -M, --misses-only                "
+        "only answer with keys which were not found\n"
+        "      --normalize=STEPS            "
+        "normalize keys with the steps the indexes were built with\n"
+        "  -v, --verbose                    "
+        "produce output to stderr\n"
+        "  -h, --help                       "
+        "display this message.\n\n"
+        "Clients send keys one per line, ending each batch with an empty\n"
+        "line, and may send more batches before reading the answers. Each\n"
+        "batch is answered as bloom_query.py answers it, followed by an\n"
+        "empty line. An index file which is replaced or rewritten is loaded\n"
+        "again once it has stayed unchanged for one reload interval.\n"
+        "\n" % (sys.argv[0], LOCALHOST, DEFAULT_RELOAD_INTERVAL,
+                DEFAULT_INDEX_DOMAINS_RECURSIVELY))
+    sys.stderr.write(text)
+
+
+def _terminate(signum, frame):
+    """Stop serving on SIGTERM as on an interrupt, removing the socket."""
+    raise KeyboardInterrupt
+
+
+def debug(text):
+    """Print text to stderr if _VERBOSE has been set."""
+    if _VERBOSE:
+        sys.stderr.write(text)
+
+
+class IndexSet(object):
+    """
+    The filters being served, as a tuple of (name, filter) pairs in blooms,
+    loaded from the index files named in paths by
+    bloom_query.load_indexes; columns selects the columns loaded from
+    containers and manifests. Filters are read into memory rather than
+    memory mapped, so that an index file rewritten in place cannot change
+    under a query. The shards of a shard manifest are read as keys are
+    routed to them, and reloaded when the manifest changes. The generations
+    of a generation manifest are reloaded when a build rewrites it, and
+    each is dropped as soon as it leaves the window.
+    Reloading replaces blooms with a new tuple, leaving queries which hold
+    the old one to finish with it.
+    """
+
+    def __init__(self, paths, columns=DEFAULT_COLUMNS):
+        self._lock = threading.Lock()
+        self._loaded = {}
+        self._changed = {}
+        self.columns = list(columns)
+        self._groups = []
+        for path in paths:
+            self._loaded[path] = file_signature(path)
+            self._groups.append((path, self._load(path)))
+        self.blooms = self._flatten()
+
+    def _load(self, path):
+        """Return the (name, filter) pairs loaded from one index file."""
+        return load_indexes([path], self.columns, use_mmap=False)
+
+    def _flatten(self):
+        return tuple(pair for (_, pairs) in self._groups for pair in pairs)
+
+    def reload_changed(self):
+        """
+        Load again each index whose file has changed since it was loaded,
+        and had already changed in the same way at the previous call, so
+        that a file still being written is left alone. A file which fails
+        to load keeps its old filter until it changes again. Returns the
+        paths reloaded.
+        """
+        with self._lock:
+            reloaded = []
+            for (i, (path, _)) in enumerate(self._groups):
+                signature = file_signature(path)
+                if signature is None or signature == self._loaded[path]:
+                    self._changed.pop(path, None)
+                    continue
+
+                if self._changed.get(path) != signature:
+                    self._changed[path] = signature
+                    continue
+
+                try:
+                    pairs = self._load(path)
+                except (IOError, OSError, EOFError, ValueError, KeyError,
+                        InvalidArgument, struct.error), e:
+                    debug("Failed to reload %s: %s\n" % (path, e))
+                    self._loaded[path] = signature
+                    continue
+
+                if file_signature(path) != signature:
+                    continue  # changed while loading; try again next time
+
+                debug("Reloaded %s\n" % path)
+                self._groups[i] = (path, pairs)
+                self._loaded[path] = signature
+                del self._changed[path]
+                reloaded.append(path)
+
+            if reloaded:
+                self.blooms = self._flatten()
+            return reloaded
+
+
+def file_signature(path):
+    """
+    Return a tuple which changes when the file named by path is replaced or
+    rewritten, or None if there is no such file.
+
+    >>> file_signature('/non/existent/file') is None
+    True
+    """
+    try:
+        info = os.stat(path)
+    except OSError, e:
+        if e.errno == errno.ENOENT:
+            return None
+        raise
+    return (info.st_dev, info.st_ino, info.st_size, info.st_mtime)
+
+
+def watch_indexes(indexes, interval, stop):
+    """
+    Reload the changed files of indexes, an IndexSet, every interval
+    seconds until the threading.Event stop is set.
+    """
+    while not stop.wait(interval):
+        indexes.reload_changed()
+
+
+def answer_lines(blooms, lines, recursive_domains=False, hits_only=False,
+                 misses_only=False, normalizer=None):
+    """
+    Probe the keys in lines against each of blooms, a list of (name, filter)
+    pairs, in one batch, and return the answer to send: bloom_query's output
+    line for each key, and an empty line for each empty line, which ends a
+    client's batch. Keys are normalized by normalizer, a
+    normalize.Normalizer, if given, and those left blank are skipped; then
+    domains are expanded with recurse_domain when recursive_domains is set.
+
+    >>> answer_lines([], ['apple', '', 'www.b.com\\r', ''], True)
+    'miss\\tapple\\n\\nmiss\\twww.b.com\\nmiss\\tb.com\\nmiss\\tcom\\n\\n'
+    >>> answer_lines([], ['Apple', ''], normalizer=Normalizer(['case']))
+    'miss\\tapple\\n\\n'
+    """
+    keys = []
+    ends = []
+    for line in lines:
+        key = line.rstrip('\r')
+        if not key:
+            ends.append(len(keys))
+            continue
+
+        if normalizer is not None:
+            key = normalizer.normalize(key)
+            if not key:
+                continue  # blank once normalized, as bloom_query skips it
+        if recursive_domains and is_domain(key):
+            keys.extend(recurse_domain(key))
+        else:
+            keys.append(key)
+
+    (results, _) = format_results(blooms, keys, hits_only, misses_only)
+    answer = []
+    start = 0
+    for end in ends + [len(keys)]:
+        answer.extend(results[start:end])
+        answer.append('\n')
+        start = end
+    answer.pop()
+    return ''.join(answer)
+
+
+class QueryHandler(SocketServer.BaseRequestHandler):
+    """
+    Answer the batches of keys sent on a connection. All of the lines which
+    arrive together are probed at once, so a client which pipelines small
+    batches has them answered together. A batch is probed against the
+    filters that were being served when it began, even if they are
+    reloaded before it ends. If a key is routed to a shard whose file is
+    missing, the error is logged and the connection closed.
+    """
+
+    def handle(self):
+        blooms = None
+        pending = ''
+        while True:
+            data = self.request.recv(_RECV_SIZE)
+            if not data:
+                break
+
+            lines = (pending + data).split('\n')
+            pending = lines.pop()
+            if not lines:
+                continue
+
+            if blooms is None:
+                blooms = self.server.indexes.blooms
+            try:
+                answer = answer_lines(
+                    blooms, lines, self.server.recursive_domains,
+                    self.server.hits_only, self.server.misses_only,
+                    self.server.normalizer)
+            except MissingShard, e:
+                sys.stderr.write("Error: %s\n" % e)
+                return
+            self.request.sendall(answer)
+            if not lines[-1].rstrip('\r'):
+                blooms = None
+
+
+class UnixQueryServer(SocketServer.ThreadingMixIn,
+                      SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+
+class TCPQueryServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def create_server(indexes, socket_path, port,
+                  recursive_domains=DEFAULT_INDEX_DOMAINS_RECURSIVELY,
+                  hits_only=DEFAULT_HITS_ONLY,
+                  misses_only=DEFAULT_MISSES_ONLY,
+                  normalize=DEFAULT_NORMALIZE):
+    """
+    Return a server answering queries against indexes, an IndexSet, on the
+    Unix socket named by socket_path, or if that is empty on port of
+    LOCALHOST, with keys normalized by the steps in normalize. Each
+    connection is handled on its own thread; call serve_forever to start
+    serving.
+    """
+    if socket_path:
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)  # left behind by an earlier server
+        server = UnixQueryServer(socket_path, QueryHandler)
+    else:
+        server = TCPQueryServer((LOCALHOST, port), QueryHandler)
+
+    server.indexes = indexes
+    server.recursive_domains = recursive_domains
+    server.hits_only = hits_only
+    server.misses_only = misses_only
+    # Shared by the connections' threads: its memo is only a cache, so a
+    # result lost in a race is merely normalized again.
+    server.normalizer = Normalizer(normalize) if normalize else None
+    return server
+
+
+if __name__ == '__main__':
+    if BloomFilter is None and NumpyBloomFilter is None:
+        sys.stderr.write("\nError: Failed to import pybloom or numpy.\n"
+                         "Have you installed 'python-bloomfilter'?\n\n")
+        usage()
+        sys.exit(_EXITCODE_IMPORT_ERROR)
+    else:
+        main()
@@ -0,0 +1,251 @@
+#!/usr/bin/python
+
+# Copyright (c) 2013, Paul Michael Furley <paul@paulfurley.com>
+# All rights reserved.
+
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+
+# - Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+# - Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# - Neither the name of the <ORGANIZATION> nor the names of its contributors
+#   may be used to endorse or promote products derived from this software
+#   without specific prior written permission.
+
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Optional build metrics: per-stage timers and per-column counters, collected
+when the indexer is run with --stats. When stats are disabled the builders
+are handed NULL_STATS, whose methods do nothing, and none of the per-row or
+per-value counting wrappers below are put in the pipeline at all.
+"""
+
+import sys
+import json
+import time
+import threading
+from collections import defaultdict
+
+from bfindex import bit_counts, estimated_error_rate
+
+STATS_FORMATS = ('json', 'text')
+
+
+class _NullTimer(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+class NullStats(object):
+    """Stands in for BuildStats when stats are disabled."""
+
+    enabled = False
+
+    _timer = _NullTimer()
+
+    def timer(self, stage):
+        return self._timer
+
+    def add_time(self, stage, seconds):
+        pass
+
+    def merge_counters(self, counters):
+        pass
+
+    def record_values(self, column_number, values):
+        pass
+
+    def record_filter(self, column_number, out_fn, bloom_filter):
+        pass
+
+
+NULL_STATS = NullStats()
+
+
+class _Timer(object):
+    def __init__(self, stats, stage):
+        self.stats = stats
+        self.stage = stage
+
+    def __enter__(self):
+        self.stats._running.append(self)
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        seconds = time.time() - self.start
+        self.stats._running.remove(self)
+        self.stats.add_time(self.stage, seconds)
+        return False
+
+
+class BuildStats(object):
+    """
+    Collects timings and counters for one run of the indexer. Each stage's
+    time excludes that of any stage timed within it, so the stages add up to
+    no more than the elapsed time.
+
+    >>> stats = BuildStats()
+    >>> rows = list(stats.counted_rows([['a'], ['b']]))
+    >>> stats.record_values(1, ['a', 'b', 'a', ''])
+    >>> stats.as_dict()['columns'][1]['duplicates_dropped']
+    1
+    """
+
+    enabled = True
+
+    def __init__(self):
+        self.start = time.time()
+        self.stages = defaultdict(float)
+        self.rows_read = 0
+        self.columns = defaultdict(lambda: defaultdict(int))
+        self.filters = {}
+        self.expanders = []
+        self._running = []
+        self._lock = threading.Lock()
+
+    def timer(self, stage):
+        """Return a context manager adding its duration to stage."""
+        return _Timer(self, stage)
+
+    def add_time(self, stage, seconds):
+        """
+        Add seconds to stage, taking them from the stage being timed, if any.
+        The seconds may have been spent on another thread, such as the
+        pipeline's parsing thread.
+        """
+        with self._lock:
+            self.stages[stage] += seconds
+            if self._running:
+                self.stages[self._running[-1].stage] -= seconds
+
+    def counted_rows(self, rows):
+        """Yield each of rows, counting them."""
+        for row in rows:
+            self.rows_read += 1
+            yield row
+
+    def counted_values(self, column_values):
+        """
+        Yield each (column_number, value) pair of column_values, counting
+        the values and empty values of each column.
+        """
+        columns = self.columns
+        for (column_number, value) in column_values:
+            counters = columns[column_number]
+            counters['values'] += 1
+            if not value:
+                counters['empty_values'] += 1
+            yield (column_number, value)
+
+    def record_values(self, column_number, values):
+        """Count a column's list of values and how many are distinct."""
+        distinct = set(values)
+        distinct.discard('')
+        counters = self.columns[column_number]
+        counters['values'] += len(values)
+        counters['empty_values'] += values.count('')
+        counters['distinct_values'] += len(distinct)
+
+    def record_filter(self, column_number, out_fn, bloom_filter):
+        """Record the state of the filter written for a column."""
+        (bits_set, num_bits) = bit_counts(bloom_filter)
+        self.filters[column_number] = {
+            'file': out_fn,
+            'entries': bloom_filter.count,
+            'capacity': bloom_filter.capacity,
+            'bits': num_bits,
+            'bits_set': bits_set,
+            'fill_ratio': float(bits_set) / num_bits if num_bits else 0.0,
+            'estimated_false_positive_rate':
+                estimated_error_rate(bloom_filter),
+        }
+
+    def counters(self):
+        """
+        Return the rows read and the counters of each column as a picklable
+        dictionary, for merge_counters in another process.
+
+        >>> stats = BuildStats()
+        >>> stats.record_values(1, ['a', 'b', 'a', ''])
+        >>> other = BuildStats()
+        >>> other.merge_counters(stats.counters())
+        >>> other.as_dict()['columns'][1]['values']
+        4
+        """
+        columns = {}
+        column_numbers = set(self.columns)
+        for expanders in self.expanders:
+            column_numbers.update(expanders)
+        for column_number in column_numbers:
+            column = dict(self.columns.get(column_number, {}))
+            for expanders in self.expanders:
+                if column_number in expanders:
+                    expander = expanders[column_number]
+                    column['domains_expanded'] = (
+                        column.get('domains_expanded', 0) + expander.domains)
+                    column['sub_parts_skipped'] = (
+                        column.get('sub_parts_skipped', 0) +
+                        expander.sub_parts_skipped)
+            columns[column_number] = column
+        return {'rows_read': self.rows_read, 'columns': columns}
+
+    def merge_counters(self, counters):
+        """Add the rows read and column counters returned by counters."""
+        self.rows_read += counters['rows_read']
+        for (column_number, column) in counters['columns'].items():
+            totals = self.columns[column_number]
+            for (name, count) in column.items():
+                totals[name] += count
+
+    def as_dict(self):
+        """Return the collected metrics as a JSON-serialisable dictionary."""
+        columns = self.counters()['columns']
+        for column_number in set(columns) | set(self.filters):
+            column = columns.setdefault(column_number, {})
+            if 'values' in column and 'distinct_values' in column:
+                column['duplicates_dropped'] = (
+                    column['values'] - column.get('empty_values', 0) -
+                    column['distinct_values'])
+            column.update(self.filters.get(column_number, {}))
+
+        return {
+            'elapsed': time.time() - self.start,
+            'rows_read': self.rows_read,
+            'stages': dict(self.stages),
+            'columns': columns,
+        }
+
+    def write(self, stats_format, out_file=sys.stdout):
+        """Write the metrics to out_file as 'json' or 'text'."""
+        metrics = self.as_dict()
+        if stats_format == 'json':
+            json.dump(metrics, out_file, indent=2, sort_keys=True)
+            out_file.write('\n')
+            return
+
+        out_file.write("elapsed: %.3fs\nrows_read: %d\n" % (
+            metrics['elapsed'], metrics['rows_read']))
+        for (stage, seconds) in sorted(metrics['stages'].items()):
+            out_file.write("stage.%s: %.3fs\n" % (stage, seconds))
+        for (column_number, column) in sorted(metrics['columns'].items()):
+            for (name, value) in sorted(column.items()):
+                out_file.write("column.%s.%s: %s\n" % (
+                    column_number, name, value))
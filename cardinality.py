@@ -0,0 +1,101 @@
+#!/usr/bin/python
+
+# Copyright (c) 2013, Paul Michael Furley <paul@paulfurley.com>
+# All rights reserved.
+
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+
+# - Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+# - Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# - Neither the name of the <ORGANIZATION> nor the names of its contributors
+#   may be used to endorse or promote products derived from this software
+#   without specific prior written permission.
+
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+import math
+import hashlib
+from struct import unpack
+
+DEFAULT_PRECISION = 14
+
+
+class HyperLogLog(object):
+    """
+    Estimates the number of distinct values added to it using a fixed amount
+    of memory (2 ** precision bytes), regardless of how many values are seen.
+
+    >>> sketch = HyperLogLog()
+    >>> for value in ['apple', 'banana', 'apple', 'cherry']:
+    ...     sketch.add(value)
+    >>> sketch.cardinality()
+    3
+    """
+
+    def __init__(self, precision=DEFAULT_PRECISION):
+        if not 4 <= precision <= 18:
+            raise ValueError("precision must be between 4 and 18")
+        self.precision = precision
+        self.num_registers = 1 << precision
+        self.registers = bytearray(self.num_registers)
+        self._rank_bits = 64 - precision
+        self._rank_mask = (1 << self._rank_bits) - 1
+
+    def add(self, value):
+        """Add a value (str or unicode) to the sketch."""
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        (x,) = unpack('<Q', hashlib.md5(value).digest()[:8])
+        index = x >> self._rank_bits
+        rank = self._rank_bits - (x & self._rank_mask).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other):
+        """Fold another sketch of the same precision into this one."""
+        if other.precision != self.precision:
+            raise ValueError("Cannot merge sketches of differing precision")
+        registers = self.registers
+        for (index, rank) in enumerate(other.registers):
+            if rank > registers[index]:
+                registers[index] = rank
+
+    def cardinality(self):
+        """Return the estimated number of distinct values added."""
+        m = self.num_registers
+        estimate = (_alpha(m) * m * m /
+                    sum(2.0 ** -rank for rank in self.registers))
+        if estimate <= 2.5 * m:
+            zeros = self.registers.count(b'\x00')
+            if zeros:
+                estimate = m * math.log(float(m) / zeros)
+        return int(round(estimate))
+
+    def standard_error(self):
+        """Return the relative standard error of cardinality()."""
+        return 1.04 / math.sqrt(self.num_registers)
+
+
+def _alpha(num_registers):
+    """Bias correction constant from the HyperLogLog paper."""
+    if num_registers == 16:
+        return 0.673
+    elif num_registers == 32:
+        return 0.697
+    elif num_registers == 64:
+        return 0.709
+    return 0.7213 / (1 + 1.079 / num_registers)
@@ -0,0 +1,158 @@
+#!/usr/bin/python
+
+# Copyright (c) 2013, Paul Michael Furley <paul@paulfurley.com>
+# All rights reserved.
+
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+
+# - Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+# - Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# - Neither the name of the <ORGANIZATION> nor the names of its contributors
+#   may be used to endorse or promote products derived from this software
+#   without specific prior written permission.
+
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Sidecar checkpoints recording how much of a growing input file has already
+been indexed, so that a later run can ingest only the new tail.
+"""
+
+import os
+import json
+import hashlib
+
+CHECKPOINT_VERSION = 3
+
+# Files are read this many bytes at a time to find their last line.
+READ_SIZE = 1024 * 1024
+
+# Length of each of the blocks of a file which are hashed to fingerprint it.
+SAMPLE_SIZE = 64 * 1024
+
+
+def checkpoint_filename(infile):
+    """
+    Return the checkpoint filename for this input filename.
+    >>> checkpoint_filename('test.csv')
+    'test.csv.bfcheckpoint'
+    """
+    return "%s.bfcheckpoint" % infile
+
+
+def fingerprint(f, offset):
+    """
+    Return a hash identifying the first offset bytes of the file object f
+    by a sample of them: their length, the first SAMPLE_SIZE bytes and the
+    SAMPLE_SIZE bytes just before offset. Checking a checkpoint therefore
+    costs the same however large the file grows. resume_offset compares
+    sizes and modification times as well, to notice rewrites in between.
+    """
+    digest = hashlib.sha1(str(offset))
+    f.seek(0)
+    digest.update(f.read(min(SAMPLE_SIZE, offset)))
+    start = max(SAMPLE_SIZE, offset - SAMPLE_SIZE)
+    f.seek(start)
+    digest.update(f.read(max(0, offset - start)))
+    return digest.hexdigest()
+
+
+def last_line_end(f):
+    """
+    Return the offset just past the last newline in the file object f, so
+    that a partially written final line is left for the next run.
+    """
+    f.seek(0, os.SEEK_END)
+    position = f.tell()
+    while position > 0:
+        step = min(READ_SIZE, position)
+        f.seek(position - step)
+        newline = f.read(step).rfind('\n')
+        if newline >= 0:
+            return position - step + newline + 1
+        position -= step
+    return 0
+
+
+def read_checkpoint(infile):
+    """Return the checkpoint stored for infile, or None if there is none."""
+    try:
+        with open(checkpoint_filename(infile), 'rb') as f:
+            checkpoint = json.load(f)
+    except (IOError, ValueError):
+        return None
+
+    if checkpoint.get('version') != CHECKPOINT_VERSION:
+        return None
+    return checkpoint
+
+
+def write_checkpoint(infile, f, offset, settings, outputs):
+    """
+    Atomically record that the first offset bytes of infile, open as file
+    object f, have been indexed with the given settings into the index
+    files named in outputs.
+    """
+    stat = os.fstat(f.fileno())
+    checkpoint = {
+        'version': CHECKPOINT_VERSION,
+        'offset': offset,
+        'inode': stat.st_ino,
+        'device': stat.st_dev,
+        'size': stat.st_size,
+        'mtime': stat.st_mtime,
+        'fingerprint': fingerprint(f, offset),
+        'settings': settings,
+        'outputs': sorted(outputs),
+    }
+    path = checkpoint_filename(infile)
+    with open(path + '.tmp', 'wb') as out:
+        json.dump(checkpoint, out, sort_keys=True)
+        out.flush()
+        os.fsync(out.fileno())
+    os.rename(path + '.tmp', path)
+
+
+def resume_offset(checkpoint, f, settings):
+    """
+    Return the offset at which to resume indexing the file object f, or
+    None if the checkpoint cannot be trusted: it is missing, was made with
+    different settings, one of the index files it was made for is gone, or
+    the file has since been replaced, truncated or rewritten. A file which
+    is only ever appended to grows whenever it changes, so one which was
+    modified without growing has been rewritten. A rewrite which also grows
+    the file is only noticed if it touches the blocks sampled by
+    fingerprint.
+    """
+    if checkpoint is None or checkpoint['settings'] != settings:
+        return None
+    if not all(os.path.isfile(path) for path in checkpoint['outputs']):
+        return None
+
+    stat = os.fstat(f.fileno())
+    offset = checkpoint['offset']
+    if (stat.st_ino, stat.st_dev) != (checkpoint['inode'],
+                                      checkpoint['device']):
+        return None
+    if stat.st_size < checkpoint['size']:
+        return None
+    if (stat.st_size == checkpoint['size'] and
+            stat.st_mtime != checkpoint['mtime']):
+        return None
+    if fingerprint(f, offset) != checkpoint['fingerprint']:
+        return None
+    return offset
@@ -0,0 +1,225 @@
+#!/usr/bin/python
+
+# Copyright (c) 2013, Paul Michael Furley <paul@paulfurley.com>
+# All rights reserved.
+
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+
+# - Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+# - Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# - Neither the name of the <ORGANIZATION> nor the names of its contributors
+#   may be used to endorse or promote products derived from this software
+#   without specific prior written permission.
+
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Transparent reading of gzip, bzip2 and xz compressed input files, which are
+recognised by their magic bytes. Decompression runs on a background thread
+which hands blocks of text to the reader through a bounded queue, so the
+decompressor (which releases the GIL) and the parser overlap.
+"""
+
+import bz2
+import gzip
+import Queue
+import threading
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+# Leading bytes of each supported format, longest first.
+MAGIC_NUMBERS = (
+    ('\xfd7zXZ\x00', 'xz'),
+    ('\x1f\x8b', 'gzip'),
+    ('BZh', 'bz2'),
+)
+
+# Size of the decompressed blocks passed to the reader.
+DEFAULT_BLOCK_SIZE = 1024 * 1024
+
+# Number of decompressed blocks the background thread may get ahead by.
+DEFAULT_QUEUE_BLOCKS = 8
+
+# How often a blocked background thread checks whether it should stop.
+_STOP_POLL_SECONDS = 0.1
+
+_EOF = object()
+
+
+class UnsupportedCompression(IOError):
+    pass
+
+
+def detect_compression(path):
+    """
+    Return the name of the compression format of the file named by path, or
+    None if it is not compressed in a supported format.
+    """
+    with open(path, 'rb') as f:
+        head = f.read(max(len(magic) for (magic, name) in MAGIC_NUMBERS))
+    for (magic, name) in MAGIC_NUMBERS:
+        if head.startswith(magic):
+            return name
+    return None
+
+
+def open_decompressed(path, compression):
+    """Return a file object reading decompressed bytes from path."""
+    if compression == 'gzip':
+        return gzip.GzipFile(path, 'rb')
+    elif compression == 'bz2':
+        return bz2.BZ2File(path, 'rb')
+    elif compression == 'xz':
+        if lzma is None:
+            raise UnsupportedCompression(
+                "reading xz input needs the lzma module (backports.lzma on "
+                "Python 2): '%s'" % path)
+        return lzma.LZMAFile(path, 'rb')
+    raise UnsupportedCompression("unknown compression %s: '%s'" % (
+        compression, path))
+
+
+def open_input(path):
+    """
+    Open the file named by path for reading, decompressing it on a
+    background thread if it is compressed.
+    """
+    compression = detect_compression(path)
+    if compression is None:
+        return open(path, 'rU')
+    return DecompressingReader(path, compression)
+
+
+class DecompressingReader(object):
+    """
+    A read-only file-like object over the decompressed contents of a file.
+    It supports read, line iteration and seek(0), which restarts the
+    decompression, and should be closed to stop the background thread. As
+    with files, read and iteration should not be mixed.
+    """
+
+    def __init__(self, path, compression, block_size=DEFAULT_BLOCK_SIZE,
+                 queue_blocks=DEFAULT_QUEUE_BLOCKS):
+        self.name = path
+        self.compression = compression
+        self.block_size = block_size
+        self.queue_blocks = queue_blocks
+        self._thread = None
+        open_decompressed(path, compression).close()  # raises
+        self.seek(0)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
+    def seek(self, offset):
+        if offset != 0:
+            raise IOError("compressed input can only be rewound")
+        self.close()
+        self._buffer = ''
+        self._eof = False
+        self._queue = Queue.Queue(self.queue_blocks)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(
+            target=self._decompress,
+            args=(self._queue, self._stop))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def close(self):
+        """Stop the background thread, discarding anything it has queued."""
+        if self._thread is None:
+            return
+        self._stop.set()
+        while self._thread.is_alive():
+            try:
+                self._queue.get(timeout=_STOP_POLL_SECONDS)
+            except Queue.Empty:
+                pass
+        self._thread = None
+
+    def _decompress(self, queue, stop):
+        """Background thread: put decompressed blocks on queue."""
+        try:
+            with open_decompressed(self.name, self.compression) as f:
+                while not stop.is_set():
+                    block = f.read(self.block_size)
+                    if not _put(queue, stop, block or _EOF) or not block:
+                        return
+        except Exception, e:
+            _put(queue, stop, e)
+
+    def _next_block(self):
+        """Return the next decompressed block, or '' at the end."""
+        if self._eof:
+            return ''
+        block = self._queue.get()
+        if block is _EOF:
+            self._eof = True
+            return ''
+        if isinstance(block, Exception):
+            self._eof = True
+            raise block
+        return block
+
+    def read(self, size=-1):
+        buf = self._buffer
+        while size < 0 or len(buf) < size:
+            block = self._next_block()
+            if not block:
+                break
+            buf += block
+        if size < 0:
+            size = len(buf)
+        self._buffer = buf[size:]
+        return buf[:size]
+
+    def __iter__(self):
+        (pending, self._buffer) = (self._buffer, '')
+        while True:
+            block = self._next_block()
+            if not block:
+                break
+            lines = (pending + block).split('\n')
+            pending = lines.pop()
+            for line in lines:
+                yield line + '\n'
+        if pending:
+            yield pending
+
+
+def _put(queue, stop, item):
+    """
+    Put item on queue unless stop is set while waiting for room. Return
+    whether the item was put.
+    """
+    while not stop.is_set():
+        try:
+            queue.put(item, timeout=_STOP_POLL_SECONDS)
+            return True
+        except Queue.Full:
+            pass
+    return False
@@ -0,0 +1,130 @@
+#!/usr/bin/python
+
+# Copyright (c) 2013, Paul Michael Furley <paul@paulfurley.com>
+# All rights reserved.
+
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+
+# - Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+# - Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# - Neither the name of the <ORGANIZATION> nor the names of its contributors
+#   may be used to endorse or promote products derived from this software
+#   without specific prior written permission.
+
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""
+The typed .bfindex file format, for filters other than the classic Bloom
+filter layouts: blocked Bloom, cuckoo, xor and binary fuse filters. A file
+is a fixed header naming the filter type, followed by the type's parameters
+and then its payload:
+
+    magic 'BFTY', format version, filter type, parameter length, CRC-32
+
+The CRC-32 covers the parameters and the payload. The parameters are padded
+so that the payload starts on a 64-byte boundary, keeping the blocks of a
+memory mapped filter aligned with cache lines.
+"""
+
+import zlib
+from struct import pack, unpack, calcsize
+
+MAGIC = 'BFTY'
+VERSION = 1
+HEADER_FMT = '<4sBBHI'
+
+TYPE_BLOCKED_BLOOM = 1
+TYPE_CUCKOO = 2
+TYPE_XOR = 3
+TYPE_BINARY_FUSE = 4
+
+FILTER_TYPE_NAMES = {
+    TYPE_BLOCKED_BLOOM: 'blocked-bloom',
+    TYPE_CUCKOO: 'cuckoo',
+    TYPE_XOR: 'xor',
+    TYPE_BINARY_FUSE: 'binary-fuse',
+}
+
+PAYLOAD_ALIGNMENT = 64
+
+
+def is_typed_filter(magic):
+    """
+    Return whether the leading bytes magic start a typed filter file.
+
+    >>> is_typed_filter('BFTY')
+    True
+    >>> is_typed_filter('BFLY')
+    False
+    """
+    return magic == MAGIC
+
+
+def checksum(params, payload):
+    """Return the CRC-32 of a filter's parameters and payload."""
+    return zlib.crc32(payload, zlib.crc32(params)) & 0xffffffff
+
+
+def write_typed_filter(f, filter_type, params, payload):
+    """
+    Write a filter of filter_type to file object f, given its packed
+    parameters and its payload as a string or buffer.
+    """
+    padding = -(calcsize(HEADER_FMT) + len(params)) % PAYLOAD_ALIGNMENT
+    params += '\0' * padding
+    f.write(pack(HEADER_FMT, MAGIC, VERSION, filter_type, len(params),
+                 checksum(params, payload)))
+    f.write(params)
+    f.write(payload)
+
+
+def read_typed_header(f, expected_type):
+    """
+    Read the header and parameters of a typed filter from file object f,
+    leaving it at the start of the payload. Returns the (padded) parameters
+    and the checksum; raises ValueError unless the filter is of
+    expected_type.
+    """
+    (magic, version, filter_type, params_length, crc) = unpack(
+        HEADER_FMT, f.read(calcsize(HEADER_FMT)))
+    if magic != MAGIC:
+        raise ValueError("Not a typed filter file")
+    if version != VERSION:
+        raise ValueError("Unsupported typed filter version %d" % version)
+    if filter_type != expected_type:
+        raise ValueError("Expected a %s filter, found %s" % (
+            FILTER_TYPE_NAMES[expected_type],
+            FILTER_TYPE_NAMES.get(filter_type, 'type %d' % filter_type)))
+    return (f.read(params_length), crc)
+
+
+def read_filter_type(f):
+    """
+    Return the filter type of the typed filter at the current position of
+    file object f, without moving it.
+    """
+    start = f.tell()
+    (magic, version, filter_type, params_length, crc) = unpack(
+        HEADER_FMT, f.read(calcsize(HEADER_FMT)))
+    f.seek(start)
+    return filter_type
+
+
+def verify_checksum(params, payload, crc):
+    """Raise ValueError if params and payload do not match crc."""
+    if checksum(params, payload) != crc:
+        raise ValueError("Filter checksum mismatch, the file is corrupt")
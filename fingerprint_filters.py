@@ -0,0 +1,988 @@
+#!/usr/bin/python
+
+# Copyright (c) 2013, Paul Michael Furley <paul@paulfurley.com>
+# All rights reserved.
+
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+
+# - Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+# - Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# - Neither the name of the <ORGANIZATION> nor the names of its contributors
+#   may be used to endorse or promote products derived from this software
+#   without specific prior written permission.
+
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Fingerprint filters, which store a short hash (fingerprint) of each key
+rather than setting bits as a Bloom filter does.
+
+CuckooFilter
+    Fingerprints held in a table of four-slot buckets, each key having two
+    candidate buckets. Unlike a Bloom filter, keys can be removed again.
+XorFilter, BinaryFuseFilter
+    Static filters, solved for the whole key set at once so that a key's
+    fingerprint is the xor of three table entries. They need about 1.23
+    (xor) and 1.125 (binary fuse) times the log2(1 / error_rate) bits per
+    key of the theoretical minimum, where a Bloom filter needs 1.44 times,
+    and a lookup reads three entries where a Bloom filter reads one per hash
+    function.
+
+A static filter holds the 64-bit hashes of the keys added to it until it is
+built, which tofile does; it takes no more keys after that. Filters are
+written in the typed filter format of filter_file.
+"""
+
+import math
+import mmap
+import random
+from struct import pack, unpack, calcsize
+
+import numpy as np
+
+from numpy_bloom import _chunks, _key_array, _fnv1a64, _splitmix64
+from filter_file import (TYPE_CUCKOO, TYPE_XOR, TYPE_BINARY_FUSE,
+                         write_typed_filter, read_typed_header,
+                         verify_checksum)
+
+DEFAULT_CHUNK_SIZE = 65536
+
+BUCKET_SIZE = 4
+CUCKOO_MAX_LOAD = 0.95
+CUCKOO_MAX_KICKS = 500
+
+# Static filters are rebuilt with a new seed if peeling fails.
+BUILD_ATTEMPTS = 100
+
+_CUCKOO_PARAMS_FMT = '<dQQQBIQ'
+_STATIC_PARAMS_FMT = '<dQQQBQQ'
+
+_FINGERPRINT_DTYPES = ((8, np.uint8), (16, np.uint16), (32, np.uint32))
+
+_MAX_STATIC_FINGERPRINT_BITS = 56
+
+# Values are packed this many at a time, a multiple of 8 so that each run
+# of packed values ends on a byte boundary.
+_PACK_CHUNK_SIZE = 65536
+
+_MASK64 = (1 << 64) - 1
+_SHIFT32 = np.uint64(32)
+
+
+class CuckooFilter(object):
+    """
+    A cuckoo filter with batch add_many, contains_many and remove_many
+    operations.
+
+    >>> c = CuckooFilter(capacity=100, error_rate=0.001)
+    >>> c.add_many(['apple', 'banana', 'apple'])
+    2
+    >>> list(c.contains_many(['apple', 'cherry']))
+    [True, False]
+    >>> c.remove('apple')
+    True
+    >>> ('apple' in c, len(c))
+    (False, 1)
+    """
+
+    # union() keeps count exact, as it does not for Bloom filters.
+    exact_count = True
+
+    def __init__(self, capacity, error_rate=0.001):
+        if not (0 < error_rate < 1):
+            raise ValueError("Error_Rate must be between 0 and 1.")
+        if not capacity > 0:
+            raise ValueError("Capacity must be > 0")
+        num_buckets = cuckoo_num_buckets(capacity)
+        self._setup(error_rate, capacity, 0, num_buckets,
+                    cuckoo_fingerprint_bits(error_rate), 0, 0)
+        self.table = np.zeros((num_buckets, BUCKET_SIZE),
+                              dtype=self._dtype)
+
+    def _setup(self, error_rate, capacity, count, num_buckets,
+               fingerprint_bits, victim, victim_bucket):
+        self.error_rate = error_rate
+        self.capacity = capacity
+        self.count = count
+        self.num_buckets = num_buckets
+        self.fingerprint_bits = fingerprint_bits
+        self.num_bits = num_buckets * BUCKET_SIZE * fingerprint_bits
+        # A fingerprint which could not be placed when the table filled up;
+        # it is kept so that its key is still found.
+        self.victim = victim
+        self.victim_bucket = victim_bucket
+        self._dtype = dict(_FINGERPRINT_DTYPES)[fingerprint_bits]
+        # Fingerprints run from 1 upwards, 0 marking an empty slot.
+        self._fingerprint_range = (1 << fingerprint_bits) - 1
+
+    def __len__(self):
+        """Return the number of keys stored by this filter."""
+        return self.count
+
+    def __contains__(self, key):
+        return bool(self.contains_many([key])[0])
+
+    def add(self, key):
+        """
+        Add a single key. Returns True if the key was (probably) already
+        present, as pybloom.BloomFilter.add does.
+        """
+        return self.add_many([key]) == 0
+
+    def add_many(self, values, chunk_size=DEFAULT_CHUNK_SIZE):
+        """
+        Add every value in the iterable values, working through it in chunks
+        of chunk_size keys. Return the number of keys which were not already
+        present. Raises IndexError when the filter is full.
+        """
+        self._check_writeable()
+        added = 0
+        for chunk in _chunks(values, chunk_size):
+            (fingerprints, buckets) = self._fingerprints(
+                np.unique(_key_hashes(chunk)))
+            new = ~self._test(fingerprints, buckets)
+            num_new = int(new.sum())
+            if self.victim or self.count + num_new > self.capacity:
+                raise IndexError("CuckooFilter is at capacity")
+            self._insert(fingerprints[new], buckets[new])
+            added += num_new
+        return added
+
+    def remove(self, key):
+        """Remove a single key, returning whether it was found."""
+        return self.remove_many([key]) == 1
+
+    def remove_many(self, values, chunk_size=DEFAULT_CHUNK_SIZE):
+        """
+        Remove one copy of the fingerprint of each value in the iterable
+        values and return how many were found. Only keys which were added
+        should be removed: removing any other key which (falsely) matches
+        would remove the fingerprint of the key it collides with.
+        """
+        self._check_writeable()
+        removed = 0
+        for chunk in _chunks(values, chunk_size):
+            (fingerprints, buckets) = self._fingerprints(_key_hashes(chunk))
+            alternates = self._alternate(fingerprints, buckets)
+            for (fingerprint, first, second) in zip(fingerprints.tolist(),
+                                                    buckets.tolist(),
+                                                    alternates.tolist()):
+                removed += self._remove_one(fingerprint, first, second)
+        return removed
+
+    def _remove_one(self, fingerprint, first, second):
+        """Remove fingerprint from either bucket; return 1 if it was there."""
+        for bucket in (first, second):
+            slots = np.flatnonzero(self.table[bucket] == fingerprint)
+            if len(slots):
+                self.table[bucket, slots[0]] = 0
+                break
+        else:
+            if (self.victim != fingerprint or
+                    self.victim_bucket not in (first, second)):
+                return 0
+            self.victim = 0
+        self.count -= 1
+
+        if self.victim:
+            # There is room again, so the victim can be placed.
+            (victim, bucket) = (self.victim, self.victim_bucket)
+            self.victim = 0
+            self.count -= 1
+            self._insert(np.array([victim], dtype=np.uint64),
+                         np.array([bucket], dtype=np.uint64))
+        return 1
+
+    def contains_many(self, values, chunk_size=DEFAULT_CHUNK_SIZE):
+        """
+        Return a boolean NumPy array saying whether each value in the
+        iterable values is (probably) present.
+        """
+        results = [self._test(*self._fingerprints(_key_hashes(chunk)))
+                   for chunk in _chunks(values, chunk_size)]
+        if not results:
+            return np.zeros(0, dtype=bool)
+        return np.concatenate(results)
+
+    def _fingerprints(self, hashes):
+        """
+        Return (fingerprints, buckets), the fingerprint and first bucket
+        for each of an array of key hashes.
+        """
+        fingerprints = ((hashes >> _SHIFT32) %
+                        np.uint64(self._fingerprint_range) + np.uint64(1))
+        return (fingerprints, hashes % np.uint64(self.num_buckets))
+
+    def _alternate(self, fingerprints, buckets):
+        """
+        Return the other bucket for each fingerprint in buckets. The two
+        buckets of a fingerprint sum to its hash modulo num_buckets, so this
+        maps each of them to the other, whatever the number of buckets.
+        """
+        num_buckets = np.uint64(self.num_buckets)
+        return ((_splitmix64(fingerprints) % num_buckets + num_buckets -
+                 buckets) % num_buckets)
+
+    def _alternate_one(self, fingerprint, bucket):
+        """_alternate for a single fingerprint and bucket."""
+        return (_splitmix64_int(fingerprint) % self.num_buckets +
+                self.num_buckets - bucket) % self.num_buckets
+
+    def _test(self, fingerprints, buckets):
+        """Return which fingerprints are held in either of their buckets."""
+        column = fingerprints[:, None]
+        found = ((self.table[buckets] == column).any(axis=1) |
+                 (self.table[self._alternate(fingerprints, buckets)] ==
+                  column).any(axis=1))
+        if self.victim:
+            alternates = self._alternate(fingerprints, buckets)
+            found |= ((fingerprints == self.victim) &
+                      ((buckets == self.victim_bucket) |
+                       (alternates == self.victim_bucket)))
+        return found
+
+    def _insert(self, fingerprints, buckets):
+        """
+        Store each of fingerprints in its bucket or the alternate. Entries
+        are placed in bulk into free slots; those whose buckets are both
+        full evict an entry from one of them, a round at a time, and the
+        evicted entries are placed in their alternate buckets in turn.
+        Anything still unplaced after CUCKOO_MAX_KICKS rounds is kicked one
+        at a time.
+        """
+        table = self.table
+        (fingerprints, buckets) = (fingerprints.copy(), buckets.copy())
+        remaining = np.arange(len(fingerprints))
+        for kick in xrange(CUCKOO_MAX_KICKS):
+            remaining = self._place(fingerprints, buckets, remaining)
+            if not len(remaining):
+                return
+            (chosen, first) = np.unique(buckets[remaining], return_index=True)
+            kicked = remaining[first]
+            slots = np.random.randint(BUCKET_SIZE, size=len(chosen))
+            evicted = table[chosen, slots].astype(np.uint64)
+            table[chosen, slots] = fingerprints[kicked]
+            fingerprints[kicked] = evicted
+            buckets[kicked] = self._alternate(evicted, chosen)
+
+        for i in remaining.tolist():
+            self._kick(int(fingerprints[i]), int(buckets[i]))
+
+    def _place(self, fingerprints, buckets, remaining):
+        """
+        Put the fingerprints indexed by remaining into free slots of either
+        of their buckets, at most one per bucket per round so that two are
+        never given the same slot, until no more fit. Return the indexes of
+        those left over.
+        """
+        table = self.table
+        progress = True
+        while len(remaining) and progress:
+            progress = False
+            for choice in (buckets[remaining],
+                           self._alternate(fingerprints[remaining],
+                                           buckets[remaining])):
+                (chosen, first) = np.unique(choice, return_index=True)
+                free = table[chosen] == 0
+                has_free = free.any(axis=1)
+                if not has_free.any():
+                    continue
+                placed = first[has_free]
+                table[chosen[has_free], free[has_free].argmax(axis=1)] = (
+                    fingerprints[remaining[placed]])
+                self.count += len(placed)
+                remaining = np.delete(remaining, placed)
+                progress = True
+                break
+        return remaining
+
+    def _kick(self, fingerprint, bucket):
+        """
+        Place fingerprint by evicting a random entry of its bucket and
+        moving that entry to its own alternate bucket, and so on. Raises
+        IndexError, keeping the last evicted entry as the victim, if that
+        takes more than CUCKOO_MAX_KICKS moves.
+        """
+        table = self.table
+        for kick in xrange(CUCKOO_MAX_KICKS):
+            free = np.flatnonzero(table[bucket] == 0)
+            if len(free):
+                table[bucket, free[0]] = fingerprint
+                self.count += 1
+                return
+            slot = random.randrange(BUCKET_SIZE)
+            (fingerprint, table[bucket, slot]) = (int(table[bucket, slot]),
+                                                  fingerprint)
+            bucket = self._alternate_one(fingerprint, bucket)
+
+        (self.victim, self.victim_bucket) = (fingerprint, bucket)
+        self.count += 1
+        raise IndexError("CuckooFilter is at capacity")
+
+    def _check_writeable(self):
+        if not self.table.flags.writeable:
+            raise ValueError("Cannot change a read-only (memory mapped) "
+                             "filter")
+
+    def fill_ratio(self):
+        """Return the fraction of slots which are occupied."""
+        return float(np.count_nonzero(self.table)) / self.table.size
+
+    def estimated_error_rate(self):
+        """
+        Return the false positive rate implied by the slots currently
+        occupied: a lookup compares the key's fingerprint with both of its
+        buckets, and each occupied slot matches with chance
+        1 / (2 ** fingerprint_bits - 1).
+        """
+        compared = 2 * BUCKET_SIZE * self.fill_ratio()
+        return 1 - (1 - 1.0 / self._fingerprint_range) ** compared
+
+    def copy(self):
+        """Return a copy of this filter."""
+        cuckoo = self.__class__.__new__(self.__class__)
+        cuckoo._setup(self.error_rate, self.capacity, self.count,
+                      self.num_buckets, self.fingerprint_bits, self.victim,
+                      self.victim_bucket)
+        cuckoo.table = self.table.copy()
+        return cuckoo
+
+    def union(self, other):
+        """
+        Return a new filter holding the entries of this filter and other,
+        which must have been created with the same parameters. Entries of
+        other already matched by this filter are counted once.
+        """
+        if ((self.num_buckets, self.fingerprint_bits) !=
+                (other.num_buckets, other.fingerprint_bits)):
+            raise ValueError("Filters must have the same size and "
+                             "fingerprint length to be combined")
+        cuckoo = self.copy()
+        (buckets, slots) = np.nonzero(other.table)
+        fingerprints = other.table[buckets, slots].astype(np.uint64)
+        buckets = buckets.astype(np.uint64)
+        if other.victim:
+            fingerprints = np.append(fingerprints, np.uint64(other.victim))
+            buckets = np.append(buckets, np.uint64(other.victim_bucket))
+        new = ~cuckoo._test(fingerprints, buckets)
+        cuckoo._insert(fingerprints[new], buckets[new])
+        return cuckoo
+
+    def __or__(self, other):
+        return self.union(other)
+
+    def __getstate__(self):
+        d = self.__dict__.copy()
+        d.pop('_mmap', None)
+        return d
+
+    def __setstate__(self, d):
+        self.__dict__.update(d)
+
+    def _params(self):
+        return pack(_CUCKOO_PARAMS_FMT, self.error_rate, self.capacity,
+                    self.count, self.num_buckets, self.fingerprint_bits,
+                    self.victim, self.victim_bucket)
+
+    def tofile(self, f):
+        """Write the filter to file object f in the typed filter format."""
+        write_typed_filter(f, TYPE_CUCKOO, self._params(),
+                           buffer(self.table))
+
+    @classmethod
+    def _from_params(cls, params):
+        cuckoo = cls.__new__(cls)
+        cuckoo._setup(*unpack(_CUCKOO_PARAMS_FMT,
+                              params[:calcsize(_CUCKOO_PARAMS_FMT)]))
+        return cuckoo
+
+    def _table_bytes(self):
+        return self.num_buckets * BUCKET_SIZE * self.fingerprint_bits // 8
+
+    @classmethod
+    def fromfile(cls, f, n=-1):
+        """
+        Read a filter written by tofile from file object f, checking its
+        checksum. If n > 0 read only so many bytes.
+        """
+        start = f.tell()
+        (params, crc) = read_typed_header(f, TYPE_CUCKOO)
+        cuckoo = cls._from_params(params)
+        if n > 0:
+            data = f.read(n - (f.tell() - start))
+        else:
+            data = f.read()
+        if len(data) != cuckoo._table_bytes():
+            raise ValueError("Table length mismatch!")
+        verify_checksum(params, data, crc)
+        cuckoo.table = np.fromstring(data, dtype=cuckoo._dtype).reshape(
+            cuckoo.num_buckets, BUCKET_SIZE)
+        return cuckoo
+
+    @classmethod
+    def mmapfile(cls, path, offset=0, length=None, verify=False):
+        """
+        Open the filter in the file named by path with its table as a
+        read-only view onto a shared memory map, as
+        BlockedBloomFilter.mmapfile does.
+        """
+        (cuckoo, mapped, payload_offset) = _mmap_typed(
+            cls, TYPE_CUCKOO, path, offset, length, verify,
+            lambda cuckoo: cuckoo._table_bytes())
+        cuckoo.table = np.frombuffer(
+            mapped, dtype=cuckoo._dtype,
+            count=cuckoo.num_buckets * BUCKET_SIZE,
+            offset=payload_offset).reshape(cuckoo.num_buckets, BUCKET_SIZE)
+        return cuckoo
+
+
+class _StaticFilter(object):
+    """
+    The common part of XorFilter and BinaryFuseFilter, which differ only in
+    the size of their table and in how a key's three entries are chosen
+    (see _geometry and _positions).
+    """
+
+    FILTER_TYPE = None
+
+    exact_count = True
+
+    def __init__(self, capacity, error_rate=0.001):
+        if not (0 < error_rate < 1):
+            raise ValueError("Error_Rate must be between 0 and 1.")
+        if not capacity > 0:
+            raise ValueError("Capacity must be > 0")
+        self._setup(error_rate, capacity, 0, 0,
+                    static_fingerprint_bits(error_rate), 0, 0)
+        self.fingerprints = None
+        self._keys = np.zeros(0, dtype=np.uint64)
+        self._pending = []
+        self._num_pending = 0
+
+    def _setup(self, error_rate, capacity, count, seed, fingerprint_bits,
+               array_length, segment_length):
+        self.error_rate = error_rate
+        self.capacity = capacity
+        self._count = count
+        self.seed = seed
+        self.fingerprint_bits = fingerprint_bits
+        self.array_length = array_length
+        self.segment_length = segment_length
+        self.num_bits = array_length * fingerprint_bits
+
+    @property
+    def built(self):
+        """Whether the filter has been solved, after which it is fixed."""
+        return self.fingerprints is not None
+
+    @property
+    def count(self):
+        if not self.built:
+            self._consolidate()
+            return len(self._keys)
+        return self._count
+
+    def __len__(self):
+        """Return the number of keys stored by this filter."""
+        return self.count
+
+    def __contains__(self, key):
+        return bool(self.contains_many([key])[0])
+
+    def add(self, key):
+        """
+        Add a single key. Returns True if the key was (probably) already
+        present, as pybloom.BloomFilter.add does.
+        """
+        found = key in self
+        self.add_many([key])
+        return found
+
+    def add_many(self, values, chunk_size=DEFAULT_CHUNK_SIZE):
+        """
+        Add every value in the iterable values, which are only hashed until
+        the filter is built. Raises ValueError once it has been built.
+        """
+        for chunk in _chunks(values, chunk_size):
+            if self.built:
+                raise ValueError("Cannot add to a %s once it is built" %
+                                 self.__class__.__name__)
+            hashes = _key_hashes(chunk)
+            self._pending.append(hashes)
+            self._num_pending += len(hashes)
+            # Drop duplicates whenever the pending hashes outnumber those
+            # already kept, which bounds memory at twice the distinct keys.
+            if self._num_pending > max(len(self._keys), chunk_size):
+                self._consolidate()
+
+    def _consolidate(self):
+        """Merge the pending hashes into the sorted, distinct _keys."""
+        if self._pending:
+            self._keys = np.unique(np.concatenate([self._keys] +
+                                                  self._pending))
+            self._pending = []
+            self._num_pending = 0
+
+    def contains_many(self, values, chunk_size=DEFAULT_CHUNK_SIZE):
+        """
+        Return a boolean NumPy array saying whether each value in the
+        iterable values is (probably) present. Before the filter is built
+        the answer is exact, up to 64-bit hash collisions.
+        """
+        if not self.built:
+            self._consolidate()
+        results = [self._lookup(_key_hashes(chunk))
+                   for chunk in _chunks(values, chunk_size)]
+        if not results:
+            return np.zeros(0, dtype=bool)
+        return np.concatenate(results)
+
+    def _lookup(self, hashes):
+        """Return which of an array of key hashes are present."""
+        if not self.built:
+            keys = self._keys
+            if not len(keys):
+                return np.zeros(len(hashes), dtype=bool)
+            found = np.searchsorted(keys, hashes)
+            return keys[np.minimum(found, len(keys) - 1)] == hashes
+        if not self.array_length:
+            return np.zeros(len(hashes), dtype=bool)
+
+        hashes = _splitmix64(hashes ^ np.uint64(self.seed))
+        positions = self._positions(hashes)
+        bits = self.fingerprint_bits
+        found = _fingerprint(hashes, bits)
+        for column in xrange(3):
+            found ^= _unpack_fingerprints(self.fingerprints,
+                                          positions[:, column], bits)
+        return found == 0
+
+    def build(self):
+        """
+        Solve the filter for the keys added so far, retrying with another
+        seed if peeling fails. Called by tofile; the filter takes no more
+        keys afterwards.
+        """
+        if self.built:
+            return
+        self._consolidate()
+        keys = self._keys
+        bits = self.fingerprint_bits
+        (array_length, segment_length) = (0, 0)
+        if len(keys):
+            (array_length, segment_length) = self._geometry(len(keys))
+        table = np.zeros(array_length, dtype=np.uint64)
+        self._setup(self.error_rate, len(keys), len(keys), 0, bits,
+                    array_length, segment_length)
+
+        for attempt in xrange(BUILD_ATTEMPTS if len(keys) else 0):
+            self.seed = _splitmix64_int(attempt + 1)
+            hashes = _splitmix64(keys ^ np.uint64(self.seed))
+            positions = self._positions(hashes)
+            rounds = _peel(positions, array_length)
+            if rounds is not None:
+                break
+        else:
+            if len(keys):
+                raise ValueError("Could not build a %s for %d keys" % (
+                    self.__class__.__name__, len(keys)))
+            rounds = []
+
+        if rounds:
+            fingerprints = _fingerprint(hashes, bits)
+            # Each round's entries are independent of one another, and only
+            # depend on those of rounds peeled after them.
+            for (peeled, slots) in reversed(rounds):
+                entries = positions[peeled]
+                table[slots] = (fingerprints[peeled] ^ table[entries[:, 0]] ^
+                                table[entries[:, 1]] ^ table[entries[:, 2]])
+
+        self.fingerprints = _pack_fingerprints(table, bits)
+        self._keys = None
+        self._pending = []
+        self._num_pending = 0
+
+    def _geometry(self, num_keys):
+        """Return (array_length, segment_length) for num_keys keys."""
+        raise NotImplementedError
+
+    def _positions(self, hashes):
+        """Return the (N, 3) table entries of N seeded key hashes."""
+        raise NotImplementedError
+
+    def fill_ratio(self):
+        """Return the number of keys per table entry."""
+        if not self.array_length:
+            return 0.0
+        return float(self.count) / self.array_length
+
+    def estimated_error_rate(self):
+        """
+        Return the false positive rate: the chance that the fingerprint of
+        an absent key equals the xor of its three entries.
+        """
+        if not self.count:
+            return 0.0
+        return 2.0 ** -self.fingerprint_bits
+
+    def copy(self):
+        """Return a copy of this filter."""
+        other = self.__class__.__new__(self.__class__)
+        other._setup(self.error_rate, self.capacity, self._count, self.seed,
+                     self.fingerprint_bits, self.array_length,
+                     self.segment_length)
+        other.fingerprints = self.fingerprints
+        if self.built:
+            other.fingerprints = self.fingerprints.copy()
+            (other._keys, other._pending) = (None, [])
+        else:
+            (other._keys, other._pending) = (self._keys, list(self._pending))
+        other._num_pending = self._num_pending
+        return other
+
+    def union(self, other):
+        """
+        Return a new filter holding the keys of this filter and other,
+        neither of which may have been built yet.
+        """
+        if self.built or other.built:
+            raise ValueError("Built %ss cannot be combined" %
+                             self.__class__.__name__)
+        combined = self.copy()
+        combined._pending.extend([other._keys] + other._pending)
+        combined._num_pending += len(other._keys) + other._num_pending
+        combined._consolidate()
+        return combined
+
+    def __or__(self, other):
+        return self.union(other)
+
+    def __getstate__(self):
+        if not self.built:
+            self._consolidate()
+        d = self.__dict__.copy()
+        d.pop('_mmap', None)
+        return d
+
+    def __setstate__(self, d):
+        self.__dict__.update(d)
+
+    def _params(self):
+        return pack(_STATIC_PARAMS_FMT, self.error_rate, self.capacity,
+                    self._count, self.seed, self.fingerprint_bits,
+                    self.array_length, self.segment_length)
+
+    def tofile(self, f):
+        """
+        Build the filter if need be, then write it to file object f in the
+        typed filter format.
+        """
+        self.build()
+        write_typed_filter(f, self.FILTER_TYPE, self._params(),
+                           buffer(self.fingerprints))
+
+    @classmethod
+    def _from_params(cls, params):
+        static = cls.__new__(cls)
+        static._setup(*unpack(_STATIC_PARAMS_FMT,
+                              params[:calcsize(_STATIC_PARAMS_FMT)]))
+        (static._keys, static._pending, static._num_pending) = (None, [], 0)
+        return static
+
+    def _payload_bytes(self):
+        return _packed_length(self.array_length, self.fingerprint_bits)
+
+    @classmethod
+    def fromfile(cls, f, n=-1):
+        """
+        Read a filter written by tofile from file object f, checking its
+        checksum. If n > 0 read only so many bytes.
+        """
+        start = f.tell()
+        (params, crc) = read_typed_header(f, cls.FILTER_TYPE)
+        static = cls._from_params(params)
+        if n > 0:
+            data = f.read(n - (f.tell() - start))
+        else:
+            data = f.read()
+        if len(data) != static._payload_bytes():
+            raise ValueError("Table length mismatch!")
+        verify_checksum(params, data, crc)
+        static.fingerprints = np.fromstring(data, dtype=np.uint8)
+        return static
+
+    @classmethod
+    def mmapfile(cls, path, offset=0, length=None, verify=False):
+        """
+        Open the filter in the file named by path with its table as a
+        read-only view onto a shared memory map, as
+        BlockedBloomFilter.mmapfile does.
+        """
+        (static, mapped, payload_offset) = _mmap_typed(
+            cls, cls.FILTER_TYPE, path, offset, length, verify,
+            lambda static: static._payload_bytes())
+        static.fingerprints = np.frombuffer(
+            mapped, dtype=np.uint8, count=static._payload_bytes(),
+            offset=payload_offset)
+        return static
+
+
+class XorFilter(_StaticFilter):
+    """
+    An xor filter: a table of 1.23 entries per key in three equal blocks,
+    a key having one entry in each.
+
+    >>> x = XorFilter(capacity=100, error_rate=0.001)
+    >>> x.add_many(['apple', 'banana', 'apple'])
+    >>> x.build()
+    >>> (list(x.contains_many(['apple', 'banana', 'cherry'])), len(x))
+    ([True, True, False], 2)
+    """
+
+    FILTER_TYPE = TYPE_XOR
+
+    def _geometry(self, num_keys):
+        return xor_geometry(num_keys)
+
+    def _positions(self, hashes):
+        block_length = np.uint64(self.segment_length)
+        positions = np.empty((len(hashes), 3), dtype=np.intp)
+        for (column, rotation) in enumerate((0, 21, 42)):
+            rotated = hashes
+            if rotation:
+                rotated = ((hashes << np.uint64(rotation)) |
+                           (hashes >> np.uint64(64 - rotation)))
+            positions[:, column] = (
+                ((rotated & np.uint64(0xffffffff)) * block_length >>
+                 _SHIFT32) + np.uint64(column) * block_length)
+        return positions
+
+
+class BinaryFuseFilter(_StaticFilter):
+    """
+    A binary fuse filter: the table is split into many small segments and a
+    key's three entries lie in three consecutive segments, which lets
+    peeling succeed with only about 1.125 entries per key on large sets.
+
+    >>> b = BinaryFuseFilter(capacity=100, error_rate=0.001)
+    >>> b.add_many(['apple', 'banana', 'apple'])
+    >>> b.build()
+    >>> (list(b.contains_many(['apple', 'banana', 'cherry'])), len(b))
+    ([True, True, False], 2)
+    """
+
+    FILTER_TYPE = TYPE_BINARY_FUSE
+
+    def _geometry(self, num_keys):
+        return binary_fuse_geometry(num_keys)
+
+    def _positions(self, hashes):
+        segment_length = np.uint64(self.segment_length)
+        mask = segment_length - np.uint64(1)
+        segment_count_length = np.uint64(self.array_length -
+                                         2 * self.segment_length)
+        positions = np.empty((len(hashes), 3), dtype=np.intp)
+        first = (hashes >> _SHIFT32) * segment_count_length >> _SHIFT32
+        positions[:, 0] = first
+        positions[:, 1] = ((first + segment_length) ^
+                           ((hashes >> np.uint64(18)) & mask))
+        positions[:, 2] = ((first + np.uint64(2) * segment_length) ^
+                           (hashes & mask))
+        return positions
+
+
+def cuckoo_num_buckets(capacity):
+    """
+    Return the number of buckets a cuckoo filter needs to hold capacity
+    keys without its load exceeding CUCKOO_MAX_LOAD.
+
+    >>> cuckoo_num_buckets(1000)
+    264
+    """
+    return int(math.ceil(capacity / (BUCKET_SIZE * CUCKOO_MAX_LOAD)))
+
+
+def cuckoo_fingerprint_bits(error_rate):
+    """
+    Return the fingerprint length for a cuckoo filter with error_rate,
+    rounded up to a whole 8, 16 or 32 bit table entry. A lookup compares
+    2 * BUCKET_SIZE fingerprints, so log2(2 * BUCKET_SIZE / error_rate)
+    bits are needed.
+
+    >>> cuckoo_fingerprint_bits(0.01), cuckoo_fingerprint_bits(0.00001)
+    (16, 32)
+    """
+    needed = math.log(2 * BUCKET_SIZE / error_rate, 2)
+    for (bits, dtype) in _FINGERPRINT_DTYPES:
+        if bits >= needed:
+            return bits
+    return bits
+
+
+def static_fingerprint_bits(error_rate):
+    """
+    Return the fingerprint length for an xor or binary fuse filter with
+    error_rate, log2(1 / error_rate) rounded up. Fingerprints are bit
+    packed, so any length is used in full.
+
+    >>> static_fingerprint_bits(0.00001)
+    17
+    """
+    bits = int(math.ceil(math.log(1 / error_rate, 2) - 1e-9))
+    return min(_MAX_STATIC_FINGERPRINT_BITS, max(1, bits))
+
+
+def xor_geometry(num_keys):
+    """
+    Return (array_length, block_length) for an xor filter of num_keys keys:
+    1.23 entries per key plus 32, in three blocks.
+
+    >>> xor_geometry(1000000)
+    (1230033, 410011)
+    """
+    block_length = (32 + int(math.ceil(1.23 * num_keys)) + 2) // 3
+    return (3 * block_length, block_length)
+
+
+def binary_fuse_geometry(num_keys):
+    """
+    Return (array_length, segment_length) for a 3-wise binary fuse filter
+    of num_keys keys, as given by Graf and Lemire. Small sets need
+    proportionally larger tables.
+
+    >>> binary_fuse_geometry(1000000)
+    (1130496, 8192)
+    """
+    num_keys = max(num_keys, 2)
+    segment_length = min(1 << int(math.floor(
+        math.log(num_keys) / math.log(3.33) + 2.25)), 262144)
+    size_factor = max(1.125, 0.875 + 0.25 * math.log(1000000) /
+                      math.log(num_keys))
+    capacity = int(round(num_keys * size_factor))
+    segment_count = max(1, (capacity + segment_length - 1) //
+                        segment_length - 2)
+    return ((segment_count + 2) * segment_length, segment_length)
+
+
+def _peel(positions, array_length):
+    """
+    Peel the hypergraph whose edges are the rows of positions: repeatedly
+    remove each key which is alone in one of its entries. Every entry held
+    by a single key is peeled in the same round, since none of those keys
+    can share another's lone entry. Return a list of (keys, entries) arrays
+    per round, or None if some keys cannot be peeled.
+    """
+    num_keys = len(positions)
+    flat = positions.ravel()
+    counts = np.bincount(flat, minlength=array_length)
+    # The xor of the indexes of the keys in each entry, which is the index
+    # of the key when there is only one.
+    owners = np.zeros(array_length, dtype=np.intp)
+    np.bitwise_xor.at(owners, flat, np.repeat(np.arange(num_keys), 3))
+
+    rounds = []
+    num_peeled = 0
+    lone = np.flatnonzero(counts == 1)
+    while len(lone):
+        (keys, first) = np.unique(owners[lone], return_index=True)
+        rounds.append((keys, lone[first]))
+        num_peeled += len(keys)
+        touched = positions[keys].ravel()
+        np.subtract.at(counts, touched, 1)
+        np.bitwise_xor.at(owners, touched, np.repeat(keys, 3))
+        touched = np.unique(touched)
+        lone = touched[counts[touched] == 1]
+
+    if num_peeled < num_keys:
+        return None
+    return rounds
+
+
+def _fingerprint(hashes, bits):
+    """Return the bits-bit fingerprints of an array of seeded key hashes."""
+    return (hashes ^ (hashes >> _SHIFT32)) & np.uint64((1 << bits) - 1)
+
+
+def _packed_length(num_values, bits):
+    """
+    Return the byte length of num_values packed values, including the
+    padding which _unpack_fingerprints needs.
+    """
+    return (num_values * bits + 7) // 8 + 8
+
+
+def _pack_fingerprints(values, bits):
+    """
+    Pack an array of bits-bit values into a uint8 array, most significant
+    bit first, padded so that any value can be read with one 8-byte load.
+    """
+    shifts = np.arange(bits - 1, -1, -1, dtype=np.uint64)
+    packed = []
+    for start in xrange(0, len(values), _PACK_CHUNK_SIZE):
+        chunk = values[start:start + _PACK_CHUNK_SIZE, None]
+        packed.append(np.packbits(
+            ((chunk >> shifts) & np.uint64(1)).astype(np.uint8).ravel()))
+    packed.append(np.zeros(8, dtype=np.uint8))
+    return np.concatenate(packed)
+
+
+def _unpack_fingerprints(packed, indexes, bits):
+    """Return the values at an array of indexes into packed values."""
+    offsets = indexes.astype(np.uint64) * np.uint64(bits)
+    starts = (offsets >> np.uint64(3)).astype(np.intp)
+    words = packed[starts[:, None] + np.arange(8)].view('>u8').ravel()
+    shifts = np.uint64(64 - bits) - (offsets & np.uint64(7))
+    return (words.astype(np.uint64) >> shifts) & np.uint64((1 << bits) - 1)
+
+
+def _mmap_typed(cls, filter_type, path, offset, length, verify,
+                payload_bytes):
+    """
+    Memory map the typed filter of filter_type at offset in the file named
+    by path. Returns (filter, map, payload offset), the filter having only
+    its parameters set; payload_bytes gives the payload length it expects.
+    """
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        (params, crc) = read_typed_header(f, filter_type)
+        payload_offset = f.tell()
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    if length is None:
+        length = len(mapped) - offset
+    filtr = cls._from_params(params)
+    num_bytes = payload_bytes(filtr)
+    if offset + length - payload_offset != num_bytes:
+        mapped.close()
+        raise ValueError("Table length mismatch!")
+    if verify:
+        verify_checksum(params, buffer(mapped, payload_offset, num_bytes),
+                        crc)
+    filtr._mmap = mapped
+    return (filtr, mapped, payload_offset)
+
+
+def _key_hashes(values):
+    """Return the 64-bit hash of each of a list of keys."""
+    return _splitmix64(_fnv1a64(_key_array(values)))
+
+
+def _splitmix64_int(x):
+    """The splitmix64 finalizer for a single Python integer."""
+    x = ((x ^ (x >> 30)) * 0xbf58476d1ce4e5b9) & _MASK64
+    x = ((x ^ (x >> 27)) * 0x94d049bb133111eb) & _MASK64
+    return x ^ (x >> 31)
@@ -0,0 +1,263 @@
+#!/usr/bin/python
+
+# Copyright (c) 2013, Paul Michael Furley <paul@paulfurley.com>
+# All rights reserved.
+
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+
+# - Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+# - Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# - Neither the name of the <ORGANIZATION> nor the names of its contributors
+#   may be used to endorse or promote products derived from this software
+#   without specific prior written permission.
+
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+
+"""
+Time-windowed indexes for rolling feeds, where only the last few time
+buckets (days, say) matter. Each build adds its values to the generation of
+the bucket it runs in, and the generations which have left the window of
+the newest window buckets are deleted. A manifest lists the generations
+left, newest first:
+
+    {"bfgenerations": 1, "bucket_seconds": 86400, "window": 7,
+     "generations": [{"label": "20261017T000000Z", "start": 1760659200,
+                      "files": {"1": "feed.gen20261017T000000Z.1.bfindex",
+                                ...}}, ...]}
+
+Filenames are relative to the manifest's directory. A reader probes the
+generations newest first, and only the keys missing from one go on to the
+next, so memory and probes stay proportional to the window.
+"""
+
+import os
+import json
+import time
+import errno
+
+from bfindex import load_filter, probe_many
+from pipeline import write_atomically
+
+_MANIFEST_VERSION = 1
+_MANIFEST_PREFIX = '{\n  "bfgenerations": '
+
+
+def bucket_start(now, bucket_seconds):
+    """
+    Return the start, in seconds since the epoch, of the bucket holding
+    now. Buckets are aligned to the epoch, so daily buckets are UTC days.
+
+    >>> bucket_start(1760700000.5, 86400)
+    1760659200
+    """
+    now = int(now)
+    return now - now % bucket_seconds
+
+
+def generation_label(start):
+    """
+    Return the label of the generation whose bucket starts at start.
+
+    >>> generation_label(1760659200)
+    '20251017T000000Z'
+    """
+    return time.strftime('%Y%m%dT%H%M%SZ', time.gmtime(start))
+
+
+def manifest_filename(out_prefix):
+    """
+    Return the generation manifest filename for this output prefix.
+    >>> manifest_filename('feed.csv')
+    'feed.csv.bfgenerations'
+    """
+    return "%s.bfgenerations" % out_prefix
+
+
+class Generations(object):
+    """
+    The generation a build at time now (by default, the current time) adds
+    its values to: that of the bucket of bucket_seconds holding now. Only
+    the window most recent generations are kept.
+    """
+
+    def __init__(self, window, bucket_seconds, now=None):
+        self.window = window
+        self.bucket_seconds = bucket_seconds
+        self.start = bucket_start(time.time() if now is None else now,
+                                  bucket_seconds)
+        self.label = generation_label(self.start)
+
+    def prefix(self, out_prefix):
+        """
+        Return the prefix of the index filenames of this generation.
+
+        >>> Generations(7, 86400, now=1760700000).prefix('feed.csv')
+        'feed.csv.gen20251017T000000Z'
+        """
+        return "%s.gen%s" % (out_prefix, self.label)
+
+    def is_live(self, start):
+        """
+        Return whether the generation whose bucket starts at start is still
+        within the window.
+
+        >>> generations = Generations(2, 86400, now=1760700000)
+        >>> [generations.is_live(1760659200 - days * 86400)
+        ...  for days in (0, 1, 2)]
+        [True, True, False]
+        """
+        return start > self.start - self.window * self.bucket_seconds
+
+    def update_manifest(self, path, files):
+        """
+        Add files, a dictionary of the filename of each column indexed, to
+        this generation in the manifest named by path, and drop the
+        generations which have left the window. The manifest is replaced in
+        one step (see pipeline.write_atomically), and only then are the
+        index files of the dropped generations deleted. Returns their
+        filenames.
+        """
+        directory = os.path.dirname(os.path.abspath(path))
+        generations = {}
+        if os.path.isfile(path):
+            with open(path, 'rb') as f:
+                manifest = _check_manifest(json.load(f), path)
+            for generation in manifest['generations']:
+                generations[generation['start']] = generation
+
+        current = generations.setdefault(self.start, {
+            'label': self.label, 'start': self.start, 'files': {}})
+        for (label, filename) in files.items():
+            current['files'][str(label)] = os.path.relpath(
+                os.path.abspath(filename), directory)
+
+        kept = [generations[start] for start in sorted(generations,
+                                                       reverse=True)
+                if self.is_live(start)]
+        write_atomically(path, lambda f: _write_manifest(f, {
+            'bfgenerations': _MANIFEST_VERSION,
+            'bucket_seconds': self.bucket_seconds,
+            'window': self.window, 'generations': kept}))
+
+        expired = []
+        for (start, generation) in sorted(generations.items()):
+            if self.is_live(start):
+                continue
+            for name in sorted(generation['files'].values()):
+                filename = os.path.join(directory, name)
+                try:
+                    os.unlink(filename)
+                except OSError, e:
+                    if e.errno != errno.ENOENT:
+                        raise
+                expired.append(filename)
+        return expired
+
+
+def _write_manifest(f, manifest):
+    json.dump(manifest, f, indent=2, sort_keys=True, separators=(',', ': '))
+    f.write('\n')
+
+
+def _check_manifest(manifest, path):
+    if manifest.get('bfgenerations') != _MANIFEST_VERSION:
+        raise ValueError("Unsupported generation manifest version %s in %s" %
+                         (manifest.get('bfgenerations'), path))
+    return manifest
+
+
+def is_generation_manifest(path):
+    """
+    Return whether the file named by path is a generation manifest.
+
+    >>> is_generation_manifest('/dev/null')
+    False
+    """
+    with open(path, 'rb') as f:
+        return f.read(len(_MANIFEST_PREFIX)) == _MANIFEST_PREFIX
+
+
+def read_manifest(path):
+    """
+    Read the generation manifest named by path. Returns a list of (label,
+    generations) pairs, one per column, where generations lists an
+    (expires, path) pair for each generation holding the column, newest
+    first: the time at which it leaves the window, and its index file.
+    """
+    with open(path, 'rb') as f:
+        manifest = _check_manifest(json.load(f), path)
+
+    directory = os.path.dirname(os.path.abspath(path))
+    lifetime = manifest['window'] * manifest['bucket_seconds']
+    columns = {}
+    for generation in manifest['generations']:
+        expires = generation['start'] + lifetime
+        for (label, name) in generation['files'].items():
+            columns.setdefault(str(label), []).append((expires, str(
+                os.path.normpath(os.path.join(directory, name)))))
+    return [(label, sorted(columns[label], reverse=True))
+            for label in sorted(columns, key=_column_order)]
+
+
+def _column_order(label):
+    # Columns sort by number, and composite groups after them.
+    return (0, int(label), '') if label.isdigit() else (1, 0, label)
+
+
+class GenerationalIndex(object):
+    """
+    The generations of one column, behaving as a single read-only filter.
+    generations lists (expires, path) pairs newest first, as read_manifest
+    gives them; each file is loaded, memory mapped with use_mmap, unless it
+    has already expired. Keys are probed against the newest generation
+    first, and only those it misses go on to older ones. A generation is
+    skipped once clock() reaches its expiry, so a long-running reader drops
+    old generations without reloading.
+    """
+
+    def __init__(self, generations, use_mmap=True, clock=time.time):
+        now = clock()
+        self.clock = clock
+        self.generations = [(expires, load_filter(path, use_mmap))
+                            for (expires, path) in generations
+                            if expires > now]
+
+    def live(self):
+        """Return the filters of the unexpired generations, newest first."""
+        now = self.clock()
+        return [bloom_filter for (expires, bloom_filter) in self.generations
+                if expires > now]
+
+    def __contains__(self, key):
+        return any(key in bloom_filter for bloom_filter in self.live())
+
+    def contains_many(self, keys):
+        """Return a list saying whether each of keys is in a generation."""
+        keys = list(keys)
+        found = [False] * len(keys)
+        missing = range(len(keys))
+        for bloom_filter in self.live():
+            if not missing:
+                break
+            hits = probe_many(bloom_filter, [keys[i] for i in missing])
+            still_missing = []
+            for (i, hit) in zip(missing, hits):
+                if hit:
+                    found[i] = True
+                else:
+                    still_missing.append(i)
+            missing = still_missing
+        return found
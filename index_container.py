@@ -0,0 +1,282 @@
+#!/usr/bin/python
+
+# Copyright (c) 2013, Paul Michael Furley <paul@paulfurley.com>
+# All rights reserved.
+
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+
+# - Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+# - Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# - Neither the name of the <ORGANIZATION> nor the names of its contributors
+#   may be used to endorse or promote products derived from this software
+#   without specific prior written permission.
+
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Index containers, which hold the filters of several columns in one file
+with a directory at the front, so that a reader can find and load any one
+column without reading the others. A container is laid out as
+
+    magic 'BFCX', format version, number of columns, directory length
+    for each column: its offset, length, item count, capacity, error rate,
+        the CRC-32 of its bytes, its kind of filter and its label
+    each column's filter as its own tofile writes it
+
+Each filter starts on a 64-byte boundary, so that memory mapped filters
+keep their blocks aligned with cache lines. A column's kind is one of the
+names returned by bfindex.filter_kind and its label is its column number,
+or for a composite group the group's label.
+"""
+
+import os
+import zlib
+from struct import pack, unpack, calcsize
+
+from bfindex import read_filter, mmap_filter, filter_kind, NumpyBloomFilter
+from pipeline import sync_directory
+from filter_file import PAYLOAD_ALIGNMENT
+
+_MAGIC = 'BFCX'
+_VERSION = 1
+_HEADER_FMT = '<4sBxxxII'
+_ENTRY_FMT = '<QQQQdI16sH'
+
+# Number of bytes read at a time when checksumming a column.
+_CHECKSUM_BLOCK_SIZE = 1024 * 1024
+
+
+def container_filename(infile):
+    """
+    Return the container filename for this input filename.
+    >>> container_filename('test.csv')
+    'test.csv.bfpack'
+    """
+    return "%s.bfpack" % infile
+
+
+def container_member(path, label):
+    """
+    Return the name of a column in the container named by path, as used in
+    build metrics and query results.
+    >>> container_member('test.csv.bfpack', 3)
+    'test.csv.bfpack#3'
+    """
+    return "%s#%s" % (path, label)
+
+
+def is_container(path):
+    """
+    Return whether the file named by path is an index container.
+
+    >>> is_container('/dev/null')
+    False
+    """
+    with open(path, 'rb') as f:
+        return f.read(len(_MAGIC)) == _MAGIC
+
+
+class ContainerEntry(object):
+    """The directory entry describing one column of a container."""
+
+    def __init__(self, label, kind, offset, length, count, capacity,
+                 error_rate, crc):
+        self.label = label
+        self.kind = kind
+        self.offset = offset
+        self.length = length
+        self.count = count
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.crc = crc
+
+    def pack(self):
+        """Return the entry as it is stored in the directory."""
+        return pack(_ENTRY_FMT, self.offset, self.length, self.count,
+                    self.capacity, self.error_rate, self.crc, self.kind,
+                    len(self.label)) + self.label
+
+
+class ContainerWriter(object):
+    """
+    Writes a container holding a filter for each of labels to the file
+    named by path. Filters may be written in any order with write; close
+    adds the checksums and the directory and renames the container into
+    place, so that readers never see one half written. Used as a context
+    manager, the container is closed unless an exception is raised, in
+    which case it is abandoned.
+    """
+
+    def __init__(self, path, labels):
+        self.path = path
+        self._tmp_path = path + '.tmp'
+        self._file = open(self._tmp_path, 'w+b')
+        self._entries = []
+        directory_bytes = sum(calcsize(_ENTRY_FMT) + len(str(label))
+                              for label in labels)
+        self._file.write('\0' * (calcsize(_HEADER_FMT) + directory_bytes))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def write(self, label, bloom_filter):
+        """
+        Write the filter for the column with label, returning the name the
+        column goes by (see container_member).
+        """
+        f = self._file
+        f.write('\0' * (-f.tell() % PAYLOAD_ALIGNMENT))
+        offset = f.tell()
+        bloom_filter.tofile(f)
+        f.seek(0, os.SEEK_END)
+        self._entries.append(ContainerEntry(
+            str(label), filter_kind(bloom_filter), offset, f.tell() - offset,
+            bloom_filter.count, bloom_filter.capacity,
+            getattr(bloom_filter, 'error_rate', 0.0), 0))
+        return container_member(self.path, label)
+
+    def close(self):
+        """Checksum the columns, write the directory and rename into place."""
+        f = self._file
+        for entry in self._entries:
+            entry.crc = _checksum(f, entry.offset, entry.length)
+
+        f.seek(0)
+        directory = ''.join(entry.pack() for entry in self._entries)
+        f.write(pack(_HEADER_FMT, _MAGIC, _VERSION, len(self._entries),
+                     len(directory)))
+        f.write(directory)
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+        os.rename(self._tmp_path, self.path)
+        sync_directory(os.path.dirname(self.path) or '.')
+
+    def abort(self):
+        """Abandon the container, removing what has been written."""
+        self._file.close()
+        os.unlink(self._tmp_path)
+
+
+class IndexContainer(object):
+    """
+    A container opened for reading. Opening it reads only the header and
+    directory; each column's filter is loaded the first time it is asked
+    for, memory mapped with use_mmap (when NumPy is available) or read
+    otherwise. Columns are checked against their checksums as they are
+    loaded with verify, which reads every page of a memory mapped filter.
+    Labels may be given as column numbers or strings.
+    """
+
+    def __init__(self, path, use_mmap=False, verify=False):
+        self.path = path
+        self.use_mmap = use_mmap
+        self.verify = verify
+        self._file = open(path, 'rb')
+        self.entries = _read_directory(self._file)
+        self._entries = dict((entry.label, entry) for entry in self.entries)
+        self._loaded = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __contains__(self, label):
+        return str(label) in self._entries
+
+    @property
+    def labels(self):
+        """The labels of the columns, in the order they were written."""
+        return [entry.label for entry in self.entries]
+
+    def entry(self, label):
+        """Return the ContainerEntry for the column with label."""
+        try:
+            return self._entries[str(label)]
+        except KeyError:
+            raise KeyError("No column %s in %s" % (label, self.path))
+
+    def load(self, label):
+        """Return the filter for the column with label."""
+        entry = self.entry(label)
+        if entry.label in self._loaded:
+            return self._loaded[entry.label]
+
+        if self.verify and _checksum(self._file, entry.offset,
+                                     entry.length) != entry.crc:
+            raise ValueError("Column %s checksum mismatch, the container is "
+                             "corrupt" % entry.label)
+
+        if self.use_mmap and NumpyBloomFilter is not None:
+            bloom_filter = mmap_filter(self.path, entry.offset, entry.length)
+        else:
+            self._file.seek(entry.offset)
+            bloom_filter = read_filter(self._file, entry.length)
+        self._loaded[entry.label] = bloom_filter
+        return bloom_filter
+
+    def close(self):
+        self._file.close()
+
+
+def _read_directory(f):
+    """Read the header and directory of a container from file object f."""
+    header = f.read(calcsize(_HEADER_FMT))
+    if len(header) < calcsize(_HEADER_FMT):
+        raise ValueError("Not an index container")
+    (magic, version, num_columns, directory_bytes) = unpack(_HEADER_FMT,
+                                                            header)
+    if magic != _MAGIC:
+        raise ValueError("Not an index container")
+    if version != _VERSION:
+        raise ValueError("Unsupported index container version %d" % version)
+
+    directory = f.read(directory_bytes)
+    entries = []
+    position = 0
+    for i in xrange(num_columns):
+        (offset, length, count, capacity, error_rate, crc, kind,
+         label_length) = unpack(_ENTRY_FMT, directory[
+             position:position + calcsize(_ENTRY_FMT)])
+        position += calcsize(_ENTRY_FMT)
+        label = directory[position:position + label_length]
+        position += label_length
+        entries.append(ContainerEntry(label, kind.rstrip('\0'), offset,
+                                      length, count, capacity, error_rate,
+                                      crc))
+    return entries
+
+
+def _checksum(f, offset, length):
+    """Return the CRC-32 of length bytes at offset in file object f."""
+    f.seek(offset)
+    crc = 0
+    while length > 0:
+        block = f.read(min(length, _CHECKSUM_BLOCK_SIZE))
+        if not block:
+            raise ValueError("Index container is truncated")
+        crc = zlib.crc32(block, crc)
+        length -= len(block)
+    return crc & 0xffffffff
@@ -27,40 +27,34 @@
 # ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 # POSSIBILITY OF SUCH DAMAGE.
 
-import re
-
-_TLD_GROUP = (
-        r'(XN--CLCHC0EA0B2G2A9GCD|XN--HGBK6AJ7F53BBA|XN--HLCJ6AYA9ESC7A|'
-        'XN--11B5BS3A9AJ6G|XN--MGBERP4A5D4AR|XN--XKC2DL3A5EE0H|'
-        'XN--80AKHBYKNJ4F|XN--XKC2AL3HYE2A|XN--LGBBAT1AD8J|XN--MGBC0A9AZCG|'
-        'XN--9T4B11YI5A|XN--MGBAAM7A8H|XN--MGBAYH7GPA|XN--MGBBH1A71E|'
-        'XN--FPCRJ9C3D|XN--FZC2C9E2C|XN--YFRO4I67O|XN--YGBI2AMMX|'
-        'XN--3E0B707E|XN--JXALPDLP|XN--KGBECHTV|XN--OGBPF8FL|XN--0ZWM56D|'
-        'XN--45BRJ9C|XN--80AO21A|XN--DEBA0AD|XN--G6W251D|XN--GECRJ9C|'
-        'XN--H2BRJ9C|XN--J6W193G|XN--KPRW13D|XN--KPRY57D|XN--PGBS0DH|'
-        'XN--S9BRJ9C|XN--90A3AC|XN--FIQS8S|XN--FIQZ9S|XN--O3CW4H|'
-        'XN--WGBH1C|XN--WGBL6A|XN--ZCKZAH|XN--P1AI|MUSEUM|TRAVEL|AERO|ARPA|'
-        'ASIA|COOP|INFO|JOBS|MOBI|NAME|BIZ|CAT|COM|EDU|GOV|INT|MIL|NET|ORG|'
-        'PRO|TEL|XXX|AC|AD|AE|AF|AG|AI|AL|AM|AN|AO|AQ|AR|AS|AT|AU|AW|AX|AZ|'
-        'BA|BB|BD|BE|BF|BG|BH|BI|BJ|BM|BN|BO|BR|BS|BT|BV|BW|BY|BZ|CA|CC|CD|'
-        'CF|CG|CH|CI|CK|CL|CM|CN|CO|CR|CU|CV|CW|CX|CY|CZ|DE|DJ|DK|DM|DO|DZ|'
-        'EC|EE|EG|ER|ES|ET|EU|FI|FJ|FK|FM|FO|FR|GA|GB|GD|GE|GF|GG|GH|GI|GL|'
-        'GM|GN|GP|GQ|GR|GS|GT|GU|GW|GY|HK|HM|HN|HR|HT|HU|ID|IE|IL|IM|IN|IO|'
-        'IQ|IR|IS|IT|JE|JM|JO|JP|KE|KG|KH|KI|KM|KN|KP|KR|KW|KY|KZ|LA|LB|LC|'
-        'LI|LK|LR|LS|LT|LU|LV|LY|MA|MC|MD|ME|MG|MH|MK|ML|MM|MN|MO|MP|MQ|MR|'
-        'MS|MT|MU|MV|MW|MX|MY|MZ|NA|NC|NE|NF|NG|NI|NL|NO|NP|NR|NU|NZ|OM|PA|'
-        'PE|PF|PG|PH|PK|PL|PM|PN|PR|PS|PT|PW|PY|QA|RE|RO|RS|RU|RW|SA|SB|SC|'
-        'SD|SE|SG|SH|SI|SJ|SK|SL|SM|SN|SO|SR|ST|SU|SV|SX|SY|SZ|TC|TD|TF|TG|'
-        'TH|TJ|TK|TL|TM|TN|TO|TP|TR|TT|TV|TW|TZ|UA|UG|UK|US|UY|UZ|VA|VC|VE|'
-        'VG|VI|VN|VU|WF|WS|YE|YT|ZA|ZM|ZW)')
-
-_DOMAIN_PATTERN = r'^([A-Z0-9\-\.]+\.' + _TLD_GROUP + r')$'
-
-_DOMAIN_RE = re.compile(_DOMAIN_PATTERN, re.IGNORECASE)
-
-def is_domain(text):
+import os
+import string
+
+TLD_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'tlds.txt')
+
+# Characters allowed before the top-level domain.
+_DOMAIN_CHARS = string.ascii_letters + string.digits + '-.'
+
+
+def load_tld_file(path):
     """
-    Returns true if text is a valid domain name.
+    Return the set of upper-cased top-level domains listed one per line in
+    the file named by path, ignoring blank lines and '#' comments.
+    """
+    with open(path, 'rU') as f:
+        return frozenset(line.strip().upper() for line in f
+                         if line.strip() and not line.startswith('#'))
+
+
+_TLDS = load_tld_file(TLD_FILE)
+
+
+def is_domain(text, tlds=None):
+    """
+    Returns true if text is a valid domain name: one or more letters,
+    digits, hyphens or dots, then a dot and a known top-level domain, which
+    is looked up in tlds (default: those listed in TLD_FILE).
     >>> is_domain('www.google.com')
     True
     >>> is_domain('http://www.google.com')
@@ -69,7 +63,45 @@ def is_domain(text):
     False
     >>> is_domain('www.google.bob')
     False
+    >>> is_domain('WWW.GOOGLE.Co.Uk')
+    True
     """
 
-    return _DOMAIN_RE.match(text) is not None
+    # A top-level domain contains no dots, so it can only be whatever follows
+    # the last one. Looking it up first rejects most non-domains cheaply.
+    if text.endswith('\n'):
+        text = text[:-1]  # as the regex's '$' matched before a final newline
+    (prefix, dot, tld) = text.rpartition('.')
+    if not prefix or tld.upper() not in (_TLDS if tlds is None else tlds):
+        return False
+
+    if isinstance(text, unicode):
+        try:
+            text = text.encode('ascii')
+        except UnicodeError:
+            return False
+    return not text.translate(None, _DOMAIN_CHARS)
 
+
+def is_domain_many(values, tlds=None):
+    """
+    Return a list saying whether each of values is a valid domain name, as
+    for is_domain.
+    >>> is_domain_many(['www.google.com', 'google', 'a.b.uk'])
+    [True, False, True]
+    """
+    if tlds is None:
+        tlds = _TLDS
+    results = []
+    append = results.append
+    for text in values:
+        if text.endswith('\n'):
+            text = text[:-1]
+        (prefix, dot, tld) = text.rpartition('.')
+        if not prefix or tld.upper() not in tlds:
+            append(False)
+        elif isinstance(text, unicode):
+            append(is_domain(text, tlds))
+        else:
+            append(not text.translate(None, _DOMAIN_CHARS))
+    return results
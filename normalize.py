@@ -0,0 +1,175 @@
+#!/usr/bin/python
+
+# Copyright (c) 2013, Paul Michael Furley <paul@paulfurley.com>
+# All rights reserved.
+
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+
+# - Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+# - Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# - Neither the name of the <ORGANIZATION> nor the names of its contributors
+#   may be used to endorse or promote products derived from this software
+#   without specific prior written permission.
+
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Normalization of values before they are indexed or probed, so that variants
+of the same value, such as 'WWW.Google.COM', 'www.google.com.' and
+' www.google.com ', share one entry and do not inflate the filter. The
+indexer and the query tools normalize with the same code, and must be given
+the same steps. Each step is one of NORMALIZATIONS:
+
+    space  trim leading and trailing whitespace
+    case   fold to lower case (UTF-8 text as Unicode, anything else as ASCII)
+    idna   encode a non-ASCII domain in its ASCII (punycode) form
+    dot    remove the trailing dots of a domain
+
+Values holding the ASCII unit separator, as composite keys do, are
+normalized one field at a time.
+"""
+
+import re
+from isdomain import is_domain
+
+# Steps, in the order they are applied.
+NORMALIZATIONS = ('space', 'case', 'idna', 'dot')
+
+# Number of raw values whose normalized form a Normalizer remembers, per
+# generation.
+DEFAULT_CACHE_SIZE = 65536
+
+UNIT_SEPARATOR = '\x1f'
+
+_NON_ASCII = re.compile('[\x80-\xff]')
+
+
+def normalize_value(value, steps):
+    """
+    Return value normalized by each of steps, in the order of NORMALIZATIONS.
+
+    >>> normalize_value('  WWW.Google.COM. ', NORMALIZATIONS)
+    'www.google.com'
+    >>> normalize_value('B\\xc3\\xbcCHER.de', NORMALIZATIONS)
+    'xn--bcher-kva.de'
+    >>> normalize_value('Alice \\x1fExample.COM.', ['space', 'case'])
+    'alice\\x1fexample.com.'
+    >>> normalize_value('etc.', ['dot'])
+    'etc.'
+    """
+    if UNIT_SEPARATOR in value:
+        return UNIT_SEPARATOR.join(normalize_value(part, steps)
+                                   for part in value.split(UNIT_SEPARATOR))
+
+    if 'space' in steps:
+        value = value.strip()
+    if 'case' in steps:
+        value = fold_case(value)
+    if 'idna' in steps and _NON_ASCII.search(value):
+        value = idna_domain(value)
+    if 'dot' in steps and value.endswith('.'):
+        domain = value.rstrip('.')
+        if is_domain(domain):
+            value = domain
+    return value
+
+
+def fold_case(value):
+    """
+    Return value in lower case, as Unicode if it is UTF-8 text.
+
+    >>> fold_case('\\xc3\\x9cBER.com')
+    '\\xc3\\xbcber.com'
+    >>> fold_case('Caf\\xe9')
+    'caf\\xe9'
+    """
+    if not _NON_ASCII.search(value):
+        return value.lower()
+    try:
+        return value.decode('utf-8').lower().encode('utf-8')
+    except UnicodeDecodeError:
+        return value.lower()
+
+
+def idna_domain(value):
+    """
+    Return the ASCII form of the UTF-8 internationalized domain value, or
+    value itself if it is not one.
+
+    >>> idna_domain('m\\xc3\\xbcnchen.de')
+    'xn--mnchen-3ya.de'
+    >>> idna_domain('M\\xc3\\xbcller')
+    'M\\xc3\\xbcller'
+    """
+    try:
+        domain = value.decode('utf-8').encode('idna')
+    except UnicodeError:
+        return value
+    if is_domain(domain.rstrip('.')):
+        return domain
+    return value
+
+
+class Normalizer(object):
+    """
+    Normalizes values by steps with normalize_value, remembering the results
+    for recently seen raw values so that repeated ones are normalized once.
+    If expand is given, expand(value, normalized) returns more values to
+    index for a value which normalization changed, such as the sub-parts of
+    a domain it produced.
+
+    Memory is bounded by keeping two generations of at most max_size raw
+    values: when the newer one fills it replaces the older, and values
+    found in the older generation are moved forward.
+
+    >>> normalizer = Normalizer(['case'])
+    >>> normalizer.normalize('Apple')
+    'apple'
+    >>> normalizer.values('Apple')
+    ('apple',)
+    """
+
+    def __init__(self, steps, expand=None, max_size=DEFAULT_CACHE_SIZE):
+        self.steps = steps
+        self.expand = expand
+        self.max_size = max_size
+        self._recent = {}
+        self._older = {}
+
+    def values(self, value):
+        """Return a tuple of the values to index in place of value."""
+        recent = self._recent
+        normalized = recent.get(value)
+        if normalized is not None:
+            return normalized
+
+        normalized = self._older.get(value)
+        if normalized is None:
+            normal = normalize_value(value, self.steps)
+            normalized = (normal,)
+            if self.expand is not None and normal != value:
+                normalized += tuple(self.expand(value, normal))
+
+        recent[value] = normalized
+        if len(recent) >= self.max_size:
+            self._older = recent
+            self._recent = {}
+        return normalized
+
+    def normalize(self, value):
+        """Return value normalized."""
+        return self.values(value)[0]
@@ -0,0 +1,492 @@
+#!/usr/bin/python
+
+# Copyright (c) 2013, Paul Michael Furley <paul@paulfurley.com>
+# All rights reserved.
+
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+
+# - Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+# - Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# - Neither the name of the <ORGANIZATION> nor the names of its contributors
+#   may be used to endorse or promote products derived from this software
+#   without specific prior written permission.
+
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""
+A Bloom filter engine backed by a NumPy bit array, which hashes and sets
+bits for a whole chunk of keys at once instead of one key at a time.
+
+Two hashing schemes are supported:
+
+SCHEME_DOUBLE
+    Vectorized FNV-1a plus double hashing. This is the fast path; filters
+    are written with a tagged header so they can be told apart from pybloom
+    files.
+SCHEME_PYBLOOM
+    The salted hashlib scheme used by pybloom.BloomFilter. Digests are still
+    computed per key, but unpacking and bit setting are vectorized, and the
+    files written are byte-for-byte readable by BloomFilter.fromfile.
+
+Both schemes use the same geometry as pybloom: num_slices partitions of
+bits_per_slice bits each, one bit set per partition.
+"""
+
+import math
+import mmap
+import hashlib
+from struct import pack, unpack, calcsize
+
+import numpy as np
+
+SCHEME_PYBLOOM = 0
+SCHEME_DOUBLE = 1
+
+DEFAULT_CHUNK_SIZE = 65536
+
+PYBLOOM_FILE_FMT = '<dQQQQ'
+
+_MAGIC = 'BFNP'
+_VERSION = 1
+_FILE_FMT = '<4sBBxxdQQQQ'
+
+_FNV_OFFSET_BASIS = np.uint64(0xcbf29ce484222325)
+_FNV_PRIME = np.uint64(0x100000001b3)
+
+
+class NumpyBloomFilter(object):
+    """
+    A Bloom filter with batch add_many and contains_many operations.
+
+    >>> b = NumpyBloomFilter(capacity=100, error_rate=0.001)
+    >>> b.add_many(['apple', 'banana', 'apple'])
+    2
+    >>> list(b.contains_many(['apple', 'cherry']))
+    [True, False]
+    >>> 'banana' in b
+    True
+    """
+
+    def __init__(self, capacity, error_rate=0.001, scheme=SCHEME_DOUBLE):
+        if not (0 < error_rate < 1):
+            raise ValueError("Error_Rate must be between 0 and 1.")
+        if not capacity > 0:
+            raise ValueError("Capacity must be > 0")
+        # Sized exactly as pybloom.BloomFilter, so that pybloom-scheme filters
+        # are interchangeable with it.
+        num_slices = int(math.ceil(math.log(1 / error_rate, 2)))
+        bits_per_slice = int(math.ceil(
+            (2 * capacity * abs(math.log(error_rate))) /
+            (num_slices * (math.log(2) ** 2))))
+        self._setup(error_rate, num_slices, bits_per_slice, capacity, 0,
+                    scheme)
+        self.bits = np.zeros((self.num_bits + 7) // 8, dtype=np.uint8)
+
+    def _setup(self, error_rate, num_slices, bits_per_slice, capacity, count,
+               scheme):
+        if scheme not in (SCHEME_PYBLOOM, SCHEME_DOUBLE):
+            raise ValueError("Unknown hashing scheme: %r" % scheme)
+        self.error_rate = error_rate
+        self.num_slices = num_slices
+        self.bits_per_slice = bits_per_slice
+        self.capacity = capacity
+        self.num_bits = num_slices * bits_per_slice
+        self.count = count
+        self.scheme = scheme
+        if scheme == SCHEME_PYBLOOM:
+            self._hash_positions = _make_pybloom_hashes(
+                num_slices, bits_per_slice)
+        else:
+            self._hash_positions = _make_double_hashes(
+                num_slices, bits_per_slice)
+
+    def __len__(self):
+        """Return the number of keys stored by this bloom filter."""
+        return self.count
+
+    def __contains__(self, key):
+        return bool(self.contains_many([key])[0])
+
+    def add(self, key):
+        """
+        Add a single key. Returns True if the key was (probably) already
+        present, as pybloom.BloomFilter.add does.
+        """
+        return self.add_many([key]) == 0
+
+    def add_many(self, values, chunk_size=DEFAULT_CHUNK_SIZE):
+        """
+        Add every value in the iterable values, working through it in chunks
+        of chunk_size keys. Return the number of keys which were not already
+        present.
+        """
+        if not self.bits.flags.writeable:
+            raise ValueError("Cannot add to a read-only (memory mapped) "
+                             "filter")
+        added = 0
+        for chunk in _chunks(values, chunk_size):
+            keys = np.unique(_key_array(chunk))
+            positions = self._hash_positions(keys)
+            new = len(keys) - int(self._test_positions(positions).sum())
+            if self.count + new > self.capacity:
+                raise IndexError("BloomFilter is at capacity")
+            positions = positions.ravel()
+            np.bitwise_or.at(
+                self.bits, positions >> np.uint64(3),
+                np.uint8(1) << (positions & np.uint64(7)).astype(np.uint8))
+            self.count += new
+            added += new
+        return added
+
+    def contains_many(self, values, chunk_size=DEFAULT_CHUNK_SIZE):
+        """
+        Return a boolean NumPy array saying whether each value in the
+        iterable values is (probably) present.
+        """
+        results = [self._test_positions(self._hash_positions(
+                   _key_array(chunk))) for chunk in _chunks(values, chunk_size)]
+        if not results:
+            return np.zeros(0, dtype=bool)
+        return np.concatenate(results)
+
+    def _test_positions(self, positions):
+        """Return which rows of the (keys, num_slices) array are all set."""
+        found = (self.bits[positions >> np.uint64(3)] >>
+                 (positions & np.uint64(7)).astype(np.uint8)) & 1
+        return found.all(axis=1)
+
+    def fill_ratio(self):
+        """Return the fraction of bits which are set."""
+        return float(np.unpackbits(self.bits).sum()) / self.num_bits
+
+    def _slice_fills(self):
+        """Return the number of bits set in each slice."""
+        # unpackbits is most-significant-bit first, but bit i of the filter
+        # is the least significant bit of byte i // 8.
+        bits = np.unpackbits(self.bits).reshape(-1, 8)[:, ::-1].ravel()
+        slices = bits[:self.num_bits].reshape(
+            self.num_slices, self.bits_per_slice)
+        return slices.sum(axis=1)
+
+    def estimated_error_rate(self):
+        """
+        Return the false positive rate implied by the bits currently set:
+        the product of the fill ratio of each slice.
+        """
+        fills = self._slice_fills() / float(self.bits_per_slice)
+        return float(np.prod(fills))
+
+    def estimated_cardinality(self):
+        """
+        Return the number of distinct keys implied by the bits currently set.
+        Each key sets one bit in every slice, so a slice with X of its m bits
+        set has seen about ln(1 - X/m) / ln(1 - 1/m) keys; this is the mean
+        over the slices. A slice with every bit set gives infinity.
+
+        >>> b = NumpyBloomFilter(capacity=1000, error_rate=0.01)
+        >>> b.add_many(str(i) for i in xrange(500))
+        500
+        >>> 480 < b.estimated_cardinality() < 520
+        True
+        """
+        fills = self._slice_fills()
+        if (fills >= self.bits_per_slice).any():
+            return float('inf')
+        keys = (np.log1p(-(fills / float(self.bits_per_slice))) /
+                math.log1p(-1.0 / self.bits_per_slice))
+        return float(keys.mean())
+
+    def copy(self):
+        """Return a copy of this bloom filter."""
+        bloom = self.__class__.__new__(self.__class__)
+        bloom._setup(self.error_rate, self.num_slices, self.bits_per_slice,
+                     self.capacity, self.count, self.scheme)
+        bloom.bits = self.bits.copy()
+        return bloom
+
+    def union(self, other):
+        """
+        Return a new filter holding the bitwise OR of this filter and other,
+        which must have been created with the same parameters. As with
+        pybloom, the count of the result is not known and is left at the
+        count of this filter.
+        """
+        return self._combine(np.bitwise_or, other)
+
+    def intersection(self, other):
+        """
+        Return a new filter holding the bitwise AND of this filter and other,
+        which must have been created with the same parameters. The count of
+        the result is left at the count of this filter.
+
+        >>> a = NumpyBloomFilter(capacity=100, error_rate=0.001)
+        >>> b = NumpyBloomFilter(capacity=100, error_rate=0.001)
+        >>> a.add_many(['apple', 'banana'])
+        2
+        >>> b.add_many(['banana', 'cherry'])
+        2
+        >>> list((a & b).contains_many(['apple', 'banana', 'cherry']))
+        [False, True, False]
+        """
+        return self._combine(np.bitwise_and, other)
+
+    def __or__(self, other):
+        return self.union(other)
+
+    def __and__(self, other):
+        return self.intersection(other)
+
+    def _combine(self, function, other):
+        self._check_compatible(other)
+        bloom = self.copy()
+        _apply_to_words(function, bloom.bits, other.bits)
+        return bloom
+
+    def _check_compatible(self, other):
+        if (self.num_slices, self.bits_per_slice, self.scheme) != (
+                other.num_slices, other.bits_per_slice, other.scheme):
+            raise ValueError("Filters must have the same size and hashing "
+                             "scheme to be combined")
+
+    def __getstate__(self):
+        d = self.__dict__.copy()
+        del d['_hash_positions']
+        d.pop('_mmap', None)
+        return d
+
+    def __setstate__(self, d):
+        self.__dict__.update(d)
+        self._setup(self.error_rate, self.num_slices, self.bits_per_slice,
+                    self.capacity, self.count, self.scheme)
+
+    def tofile(self, f):
+        """
+        Write the filter to file object f. pybloom-scheme filters are written
+        in pybloom's own format; double-hashing filters get a tagged header.
+        """
+        if self.scheme == SCHEME_PYBLOOM:
+            f.write(pack(PYBLOOM_FILE_FMT, self.error_rate, self.num_slices,
+                         self.bits_per_slice, self.capacity, self.count))
+        else:
+            f.write(pack(_FILE_FMT, _MAGIC, _VERSION, self.scheme,
+                         self.error_rate, self.num_slices,
+                         self.bits_per_slice, self.capacity, self.count))
+        f.write(self.bits.tostring())
+
+    @classmethod
+    def fromfile(cls, f, n=-1):
+        """
+        Read a filter written by NumpyBloomFilter.tofile or by
+        pybloom.BloomFilter.tofile from file object f. If n > 0 read only
+        so many bytes.
+        """
+        start = f.tell()
+        bloom = cls.__new__(cls)
+        bloom._setup(*_read_header(f))
+        if n > 0:
+            data = f.read(n - (f.tell() - start))
+        else:
+            data = f.read()
+        bloom.bits = np.fromstring(data, dtype=np.uint8)
+        if len(bloom.bits) != (bloom.num_bits + 7) // 8:
+            raise ValueError("Bit length mismatch!")
+        return bloom
+
+    @classmethod
+    def mmapfile(cls, path, offset=0, length=None):
+        """
+        Open the filter in the file named by path without reading its bits.
+        The bit array is a read-only view onto a shared memory map of the
+        file, so lookups are served from the page cache and processes on the
+        same host share one physical copy. Filters opened this way cannot
+        be added to.
+
+        offset and length locate a filter stored inside a larger file; by
+        default the filter is the whole file.
+        """
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            params = _read_header(f)
+            bits_offset = f.tell()
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if length is None:
+            length = len(mapped) - offset
+        bloom = cls.__new__(cls)
+        bloom._setup(*params)
+        num_bytes = (bloom.num_bits + 7) // 8
+        if offset + length - bits_offset != num_bytes:
+            mapped.close()
+            raise ValueError("Bit length mismatch!")
+        bloom._mmap = mapped
+        bloom.bits = np.frombuffer(mapped, dtype=np.uint8, count=num_bytes,
+                                   offset=bits_offset)
+        return bloom
+
+    @classmethod
+    def from_pybloom(cls, bloom_filter):
+        """Return a pybloom-scheme copy of a pybloom.BloomFilter."""
+        bloom = cls.__new__(cls)
+        bloom._setup(bloom_filter.error_rate, bloom_filter.num_slices,
+                     bloom_filter.bits_per_slice, bloom_filter.capacity,
+                     bloom_filter.count, SCHEME_PYBLOOM)
+        bloom.bits = np.fromstring(bloom_filter.bitarray.tobytes(),
+                                   dtype=np.uint8)
+        return bloom
+
+    def to_pybloom(self):
+        """Return a pybloom.BloomFilter with the same contents."""
+        if self.scheme != SCHEME_PYBLOOM:
+            raise ValueError("Only pybloom-scheme filters can be exported "
+                             "to pybloom")
+        from cStringIO import StringIO
+        from pybloom import BloomFilter
+        buf = StringIO()
+        self.tofile(buf)
+        buf.seek(0)
+        return BloomFilter.fromfile(buf)
+
+
+def _read_header(f):
+    """
+    Read the header of a filter file from file object f, returning the
+    arguments for NumpyBloomFilter._setup.
+    """
+    magic = f.read(len(_MAGIC))
+    if magic == _MAGIC:
+        rest = f.read(calcsize(_FILE_FMT) - len(_MAGIC))
+        (_, version, scheme, error_rate, num_slices, bits_per_slice,
+         capacity, count) = unpack(_FILE_FMT, magic + rest)
+        if version != _VERSION:
+            raise ValueError("Unsupported filter version %d" % version)
+    else:
+        rest = f.read(calcsize(PYBLOOM_FILE_FMT) - len(magic))
+        (error_rate, num_slices, bits_per_slice, capacity,
+         count) = unpack(PYBLOOM_FILE_FMT, magic + rest)
+        scheme = SCHEME_PYBLOOM
+    return (error_rate, num_slices, bits_per_slice, capacity, count, scheme)
+
+
+def _apply_to_words(function, out, other):
+    """
+    Apply the NumPy bitwise function to the byte arrays out and other, in
+    place in out, 64 bits at a time except for any bytes left over.
+    """
+    whole = len(out) - len(out) % 8
+    words = out[:whole].view(np.uint64)
+    function(words, other[:whole].view(np.uint64), out=words)
+    function(out[whole:], other[whole:], out=out[whole:])
+
+
+def _chunks(values, chunk_size):
+    """Yield lists of at most chunk_size items from the iterable values."""
+    chunk = []
+    for value in values:
+        chunk.append(value)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _key_array(keys):
+    """Return keys as a fixed-width NumPy byte string array."""
+    return np.array([key.encode('utf-8') if isinstance(key, unicode) else
+                     str(key) for key in keys], dtype=np.string_)
+
+
+def _make_double_hashes(num_slices, bits_per_slice):
+    """
+    Return a function mapping an array of N keys to an (N, num_slices) array
+    of bit positions, using h1 + i * h2 double hashing on a vectorized
+    64-bit FNV-1a hash.
+    """
+    slice_bits = np.uint64(bits_per_slice)
+    offsets = np.arange(num_slices, dtype=np.uint64) * slice_bits
+
+    def hash_positions(keys):
+        h1 = _fnv1a64(keys)
+        h2 = _splitmix64(h1) | np.uint64(1)
+        steps = np.arange(num_slices, dtype=np.uint64)
+        return ((h1[:, None] + steps * h2[:, None]) % slice_bits) + offsets
+    return hash_positions
+
+
+def _fnv1a64(keys):
+    """Hash each key of a NumPy byte string array with 64-bit FNV-1a."""
+    num_keys = len(keys)
+    hashes = np.full(num_keys, _FNV_OFFSET_BASIS, dtype=np.uint64)
+    if not num_keys or not keys.itemsize:
+        return hashes
+    lengths = np.char.str_len(keys)
+    octets = keys.view(np.uint8).reshape(num_keys, keys.itemsize)
+    for column in xrange(int(lengths.max())):
+        active = lengths > column
+        hashed = (hashes ^ octets[:, column]) * _FNV_PRIME
+        hashes = np.where(active, hashed, hashes)
+    return hashes
+
+
+def _splitmix64(x):
+    """The splitmix64 finalizer, used to derive a second independent hash."""
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+    return x ^ (x >> np.uint64(31))
+
+
+def _make_pybloom_hashes(num_slices, bits_per_slice):
+    """
+    Return a function mapping an array of N keys to an (N, num_slices) array
+    of bit positions, matching pybloom.make_hashfuncs exactly.
+    """
+    if bits_per_slice >= (1 << 31):
+        dtype, chunk_size = '<u8', 8
+    elif bits_per_slice >= (1 << 15):
+        dtype, chunk_size = '<u4', 4
+    else:
+        dtype, chunk_size = '<u2', 2
+    total_hash_bits = 8 * num_slices * chunk_size
+    if total_hash_bits > 384:
+        hashfn = hashlib.sha512
+    elif total_hash_bits > 256:
+        hashfn = hashlib.sha384
+    elif total_hash_bits > 160:
+        hashfn = hashlib.sha256
+    elif total_hash_bits > 128:
+        hashfn = hashlib.sha1
+    else:
+        hashfn = hashlib.md5
+    per_digest = hashfn().digest_size // chunk_size
+    num_salts, extra = divmod(num_slices, per_digest)
+    if extra:
+        num_salts += 1
+    salts = [hashfn(hashfn(pack('I', i)).digest()) for i in xrange(num_salts)]
+    slice_bits = np.uint64(bits_per_slice)
+    offsets = np.arange(num_slices, dtype=np.uint64) * slice_bits
+
+    def hash_positions(keys):
+        digests = []
+        for key in keys:
+            for salt in salts:
+                h = salt.copy()
+                h.update(key)
+                digests.append(h.digest())
+        words = np.fromstring(''.join(digests), dtype=dtype).reshape(
+            len(keys), num_salts * per_digest)[:, :num_slices]
+        return (words.astype(np.uint64) % slice_bits) + offsets
+    return hash_positions
@@ -0,0 +1,249 @@
+#!/usr/bin/python
+
+# Copyright (c) 2013, Paul Michael Furley <paul@paulfurley.com>
+# All rights reserved.
+
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+
+# - Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+# - Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# - Neither the name of the <ORGANIZATION> nor the names of its contributors
+#   may be used to endorse or promote products derived from this software
+#   without specific prior written permission.
+
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Stages of an index build which run on background threads, connected to the
+rest of the build by bounded queues so that no stage gets far ahead of the
+next. BackgroundIterator runs an iterator, such as the reader or parser, on
+its own thread. BackgroundWriter saves filters while the next one is built,
+each with write_atomically, so that readers only ever see whole files.
+"""
+
+import os
+import sys
+import Queue
+import threading
+
+# Number of items a BackgroundIterator hands over at a time, and the number
+# of such batches it may get ahead by.
+DEFAULT_BATCH_ITEMS = 4096
+DEFAULT_QUEUE_BATCHES = 8
+
+# Number of filters a BackgroundWriter may hold waiting to be written, on
+# top of the one it is writing.
+DEFAULT_QUEUE_WRITES = 1
+
+# How often a blocked thread checks whether it should stop.
+_STOP_POLL_SECONDS = 0.1
+
+_EOF = object()
+
+
+def write_atomically(path, write):
+    """
+    Call write with a file object to fill in the file named by path, which
+    is written under a temporary name, synced to disk and then renamed over
+    path, so that readers see either the old file or the whole new one.
+
+    >>> write_atomically('/tmp/atomic.txt', lambda f: f.write('whole'))
+    >>> open('/tmp/atomic.txt').read()
+    'whole'
+    >>> os.unlink('/tmp/atomic.txt')
+    """
+    tmp_path = path + '.tmp'
+    try:
+        with open(tmp_path, 'wb') as f:
+            write(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_path, path)
+    except:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+    sync_directory(os.path.dirname(path) or '.')
+
+
+def sync_directory(path):
+    """Sync the directory named by path, so that renames within it last."""
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass  # not supported for directories everywhere
+    finally:
+        os.close(fd)
+
+
+class BackgroundIterator(object):
+    """
+    Iterates over iterable on a background thread, handing the items over
+    in batches of batch_items through a queue of at most queue_batches, and
+    yields them in order. An exception raised by iterable is raised again
+    where it is consumed. Used as a context manager, the thread is stopped
+    on leaving, even if the items have not all been consumed.
+
+    >>> with BackgroundIterator(iter(xrange(10)), batch_items=3) as items:
+    ...     list(items)
+    [0, 1, 2, 3, 4, 5, 6, 7, 8, 9]
+    """
+
+    def __init__(self, iterable, batch_items=DEFAULT_BATCH_ITEMS,
+                 queue_batches=DEFAULT_QUEUE_BATCHES):
+        self.batch_items = batch_items
+        self._queue = Queue.Queue(queue_batches)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(iterable,))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
+    def __iter__(self):
+        while True:
+            batch = self._queue.get()
+            if batch is _EOF:
+                return
+            if isinstance(batch, tuple):
+                self._thread.join()
+                raise batch[0], batch[1], batch[2]
+            for item in batch:
+                yield item
+
+    def close(self):
+        """Stop the background thread, discarding anything it has queued."""
+        self._stop.set()
+        while self._thread.is_alive():
+            try:
+                self._queue.get(timeout=_STOP_POLL_SECONDS)
+            except Queue.Empty:
+                pass
+
+    def _run(self, iterable):
+        """Background thread: put batches of items on the queue."""
+        queue = self._queue
+        stop = self._stop
+        batch_items = self.batch_items
+        batch = []
+        try:
+            for item in iterable:
+                batch.append(item)
+                if len(batch) >= batch_items:
+                    if not _put(queue, stop, batch):
+                        return
+                    batch = []
+            end = _EOF
+        except Exception:
+            end = sys.exc_info()
+        if batch and not _put(queue, stop, batch):
+            return
+        _put(queue, stop, end)
+
+
+class BackgroundWriter(object):
+    """
+    Saves filters on a background thread, each with write_atomically, so
+    that the caller can go on to build the next one. At most queue_writes
+    filters wait to be written; write blocks until there is room. An error
+    in writing is raised again by the next write, or by close. Used as a
+    context manager, leaving waits for every filter to be written, unless
+    an exception is raised, in which case those not yet written are
+    abandoned.
+    """
+
+    def __init__(self, queue_writes=DEFAULT_QUEUE_WRITES):
+        self._queue = Queue.Queue(queue_writes)
+        self._stop = threading.Event()
+        self._error = None
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+        return False
+
+    def write(self, bloom_filter, path):
+        """Queue bloom_filter to be written to the file named by path."""
+        self._raise_error()
+        if not _put(self._queue, self._stop, (bloom_filter, path)):
+            self._raise_error()
+            raise IOError("background writer has stopped")
+
+    def close(self):
+        """Wait for the queued filters to be written."""
+        _put(self._queue, self._stop, _EOF)
+        self._thread.join()
+        self._raise_error()
+
+    def abort(self):
+        """Stop, leaving any filters not yet written unwritten."""
+        self._stop.set()
+        self._thread.join()
+
+    def _raise_error(self):
+        if self._error is not None:
+            error = self._error
+            self._error = None
+            raise error[0], error[1], error[2]
+
+    def _run(self):
+        """Background thread: write the queued filters in turn."""
+        while not self._stop.is_set():
+            try:
+                job = self._queue.get(timeout=_STOP_POLL_SECONDS)
+            except Queue.Empty:
+                continue
+            if job is _EOF:
+                return
+            (bloom_filter, path) = job
+            try:
+                write_atomically(path, bloom_filter.tofile)
+            except Exception:
+                self._error = sys.exc_info()
+                self._stop.set()
+                return
+
+
+def _put(queue, stop, item):
+    """
+    Put item on queue unless stop is set while waiting for room. Return
+    whether the item was put.
+    """
+    while not stop.is_set():
+        try:
+            queue.put(item, timeout=_STOP_POLL_SECONDS)
+            return True
+        except Queue.Full:
+            pass
+    return False
@@ -0,0 +1,346 @@
+#!/usr/bin/python
+
+# Copyright (c) 2013, Paul Michael Furley <paul@paulfurley.com>
+# All rights reserved.
+
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+
+# - Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+# - Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# - Neither the name of the <ORGANIZATION> nor the names of its contributors
+#   may be used to endorse or promote products derived from this software
+#   without specific prior written permission.
+
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Sizing models for the indexer's --plan mode, which reads a sample of the
+input instead of indexing it and predicts, for each column, how many
+distinct values it holds and how large its filter will be, and for the
+whole run the peak memory and build time. bloom_indexer.plan_index does the
+parsing; this module samples the input, extrapolates from the sample and
+writes the report.
+"""
+
+import os
+import sys
+import json
+import math
+import resource
+from struct import calcsize
+
+from cardinality import HyperLogLog
+from compression import detect_compression, open_input
+from filter_file import PAYLOAD_ALIGNMENT
+
+try:
+    from blocked_bloom import blocked_geometry, BLOCK_BITS
+    from fingerprint_filters import (cuckoo_num_buckets,
+                                     cuckoo_fingerprint_bits,
+                                     static_fingerprint_bits, xor_geometry,
+                                     binary_fuse_geometry, BUCKET_SIZE)
+except ImportError:
+    blocked_geometry = None
+
+DEFAULT_SAMPLE_BYTES = 16 * 1024 * 1024
+DEFAULT_SAMPLE_BLOCKS = 64
+
+PLAN_FORMATS = ('json', 'text')
+
+# Build modes, as chosen by bloom_indexer.open_and_create: 'memory' holds
+# every column's values in lists, 'streaming' makes a sketching pass and an
+# inserting pass, and 'parallel' does both in worker processes.
+PLAN_MODES = ('memory', 'streaming', 'parallel')
+
+# The smallest share of the sample given to any one input file.
+_MIN_FILE_SAMPLE_BYTES = 64 * 1024
+
+# Header sizes of the pybloom and tagged numpy file formats.
+_PYBLOOM_HEADER_BYTES = calcsize('<dQQQQ')
+_NUMPY_HEADER_BYTES = calcsize('<4sBBxxdQQQQ')
+
+# Memory taken by a CPython 2 str (plus its length), a list or set slot,
+# and the registers of a HyperLogLog sketch.
+_STR_BYTES = sys.getsizeof('')
+_POINTER_BYTES = calcsize('P')
+_SET_ENTRY_BYTES = 32
+_SKETCH_BYTES = HyperLogLog().num_registers
+
+# Memory per key of an xor or binary fuse filter: its pending 64-bit hash
+# (up to two copies before duplicates are dropped), and the arrays used
+# while peeling.
+_STATIC_HASH_BYTES = 16
+_STATIC_BUILD_BYTES = 64
+
+
+def read_sample(path, skip_lines, sample_bytes=DEFAULT_SAMPLE_BYTES,
+                num_blocks=DEFAULT_SAMPLE_BLOCKS):
+    """
+    Return (blocks, data_bytes): a list of blocks of whole lines, about
+    sample_bytes in all, spread evenly over the data of the file named by
+    path after its first skip_lines lines, and the size of that data. Files
+    no larger than sample_bytes are read whole. Compressed files are
+    sampled from the start, and the size of their data found by
+    decompressing the rest without parsing it.
+    """
+    if detect_compression(path):
+        with open_input(path) as f:
+            data = f.read(sample_bytes)
+            rest = sum(len(block) for block in iter(
+                lambda: f.read(DEFAULT_SAMPLE_BYTES), ''))
+        for i in xrange(skip_lines):
+            data = data[data.find('\n') + 1:] if '\n' in data else ''
+        data_bytes = len(data) + rest
+        if rest and '\n' in data:
+            data = data[:data.rfind('\n') + 1]
+        return ([data], data_bytes)
+
+    with open(path, 'rb') as f:
+        for i in xrange(skip_lines):
+            f.readline()
+        first = f.tell()
+        data_bytes = os.fstat(f.fileno()).st_size - first
+        if data_bytes <= sample_bytes:
+            return ([f.read()], data_bytes)
+
+        block_size = max(1, sample_bytes // num_blocks)
+        step = (data_bytes - block_size) // max(1, num_blocks - 1)
+        blocks = []
+        end = first
+        for i in xrange(num_blocks):
+            offset = first + i * step
+            if offset <= end:
+                f.seek(end)
+            else:
+                # Move to the start of the line holding offset - 1, so that
+                # a block starting on a line boundary keeps its first line.
+                f.seek(offset - 1)
+                f.readline()
+            block = f.read(block_size) + f.readline()
+            if not block:
+                break
+            blocks.append(block)
+            end = f.tell()
+    return (blocks, data_bytes)
+
+
+def sample_budgets(paths, sample_bytes=DEFAULT_SAMPLE_BYTES):
+    """
+    Share sample_bytes between the files named in paths in proportion to
+    their sizes.
+
+    >>> sample_budgets(['/dev/null'], 1000)
+    [65536]
+    """
+    sizes = [os.path.getsize(path) for path in paths]
+    total = max(1, sum(sizes))
+    return [max(_MIN_FILE_SAMPLE_BYTES, sample_bytes * size // total)
+            for size in sizes]
+
+
+class ColumnSample(object):
+    """
+    What the sample says about one column. Values are added with the ratio
+    of their file's data to its sample, so that the estimated counts cover
+    the whole input; values from alternate sample blocks are also sketched
+    separately, to see how fast distinct values accumulate.
+
+    >>> column = ColumnSample()
+    >>> for value in ['apple', 'banana', 'apple', '']:
+    ...     column.add(value, 10.0, True)
+    >>> (column.sampled_values, column.estimated_values)
+    (3, 30.0)
+    >>> column.estimated_distinct_values()
+    20
+    """
+
+    def __init__(self):
+        self.sampled_values = 0
+        self.half_values = 0
+        self.estimated_values = 0.0
+        self.empty_values = 0.0
+        self.value_bytes = 0
+        self.sketch = HyperLogLog()
+        self.half_sketch = HyperLogLog()
+
+    def add(self, value, scale, first_half):
+        """
+        Count a sampled value, which stands for scale values of the input;
+        first_half says whether it came from one of the alternate blocks.
+        """
+        if not value:
+            self.empty_values += scale
+            return
+        self.sampled_values += 1
+        self.estimated_values += scale
+        self.value_bytes += len(value)
+        self.sketch.add(value)
+        if first_half:
+            self.half_values += 1
+            self.half_sketch.add(value)
+
+    def mean_value_bytes(self):
+        """Return the mean length of the non-empty values sampled."""
+        return float(self.value_bytes) / max(1, self.sampled_values)
+
+    def estimated_distinct_values(self):
+        """
+        Extrapolate the number of distinct values in the input from the
+        sample, assuming it grows as a power of the number of values: the
+        exponent is given by the distinct values in the whole sample against
+        those in half of it, so a column of unique values scales with the
+        input and one of a few repeated values hardly at all. A column
+        whose values are close to running out within the input grows more
+        slowly than this, so its estimate errs on the high side.
+        """
+        distinct = self.sketch.cardinality()
+        total = self.estimated_values
+        if total <= self.sampled_values or not distinct:
+            return distinct
+        half_distinct = self.half_sketch.cardinality()
+        exponent = 1.0
+        if 0 < self.half_values < self.sampled_values and half_distinct:
+            exponent = (math.log(float(distinct) / half_distinct) /
+                        math.log(float(self.sampled_values) /
+                                 self.half_values))
+            exponent = min(1.0, max(0.0, exponent))
+        growth = (total / self.sampled_values) ** exponent
+        return int(min(total, distinct * growth) + 0.5)
+
+
+def filter_file_bytes(capacity, num_values, error_rate, engine='pybloom',
+                      filter_type='bloom'):
+    """
+    Return the size of the file written for a filter of capacity holding
+    num_values values, built by engine with filter_type as the indexer's
+    --engine and --filter-type options name them. Xor and binary fuse
+    filters are sized for the values they hold, not their capacity.
+
+    >>> filter_file_bytes(1000, 1000, 0.001)
+    3635
+    """
+    if filter_type == 'bloom' and engine in ('pybloom', 'numpy',
+                                             'numpy-compat'):
+        # As pybloom.BloomFilter sizes itself, which NumpyBloomFilter copies.
+        num_slices = int(math.ceil(math.log(1 / error_rate, 2)))
+        bits_per_slice = int(math.ceil(
+            (2 * capacity * abs(math.log(error_rate))) /
+            (num_slices * (math.log(2) ** 2))))
+        payload = (num_slices * bits_per_slice + 7) // 8
+        if engine == 'numpy':
+            return _NUMPY_HEADER_BYTES + payload
+        return _PYBLOOM_HEADER_BYTES + payload
+
+    if blocked_geometry is None:
+        raise ValueError("Sizing %s filters requires numpy" % (
+            engine if filter_type == 'bloom' else filter_type))
+    if filter_type == 'bloom':
+        payload = blocked_geometry(capacity, error_rate)[0] * BLOCK_BITS // 8
+    elif filter_type == 'cuckoo':
+        payload = (cuckoo_num_buckets(capacity) * BUCKET_SIZE *
+                   cuckoo_fingerprint_bits(error_rate) // 8)
+    else:
+        geometry = xor_geometry
+        if filter_type == 'binary-fuse':
+            geometry = binary_fuse_geometry
+        length = geometry(num_values)[0] if num_values else 0
+        payload = (length * static_fingerprint_bits(error_rate) + 7) // 8 + 8
+    return PAYLOAD_ALIGNMENT + payload
+
+
+def estimate_peak_memory(mode, columns, filter_type='bloom', num_workers=1,
+                         base_bytes=0, batch_size=65536):
+    """
+    Return the estimated peak memory of a build, in bytes, summed over any
+    worker processes. columns is a list of dictionaries of the estimated
+    values, non_empty_values, distinct_values, mean_value_bytes and
+    filter_bytes of each column; base_bytes is the memory of an idle
+    indexer, and batch_size the number of values streaming builds buffer
+    per column.
+
+    >>> column = {'values': 1000, 'non_empty_values': 1000,
+    ...           'distinct_values': 100, 'mean_value_bytes': 10,
+    ...           'filter_bytes': 4096}
+    >>> estimate_peak_memory('memory', [column])
+    62296
+    """
+    static = filter_type in ('xor', 'binary-fuse')
+
+    def held(column):
+        """Memory of the filter, or pending hashes, of a column."""
+        if static:
+            return column['distinct_values'] * _STATIC_HASH_BYTES
+        return column['filter_bytes']
+
+    def built(column):
+        """Extra memory while a column's filter is built and written."""
+        if static:
+            return (column['distinct_values'] * _STATIC_BUILD_BYTES +
+                    column['filter_bytes'])
+        return 0
+
+    def value_bytes(column, count):
+        return count * (_STR_BYTES + column['mean_value_bytes'] +
+                        _POINTER_BYTES)
+
+    if not columns:
+        return base_bytes
+    if mode == 'memory':
+        # Every value is held in per-column lists; each column's filter is
+        # then built from a set of its values and written in turn.
+        lists = sum(value_bytes(column, column['non_empty_values']) +
+                    (column['values'] - column['non_empty_values']) *
+                    _POINTER_BYTES for column in columns)
+        return base_bytes + lists + max(
+            column['distinct_values'] * _SET_ENTRY_BYTES + held(column) +
+            built(column) for column in columns)
+
+    filters = sum(held(column) + _SKETCH_BYTES for column in columns)
+    batches = sum(value_bytes(column, min(column['non_empty_values'],
+                                          batch_size))
+                  for column in columns)
+    building = max(built(column) for column in columns)
+    if mode == 'streaming':
+        return base_bytes + filters + batches + building
+    # Each worker holds partial filters for every column, and the parent the
+    # merged filters plus those of the worker it is merging.
+    return (base_bytes + num_workers * (filters + batches) + 2 * filters +
+            building)
+
+
+def current_memory():
+    """Return the peak resident memory of this process so far, in bytes."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def write_plan(plan, plan_format, out_file=sys.stdout):
+    """Write a plan made by bloom_indexer.plan_index as 'json' or 'text'."""
+    if plan_format == 'json':
+        json.dump(plan, out_file, indent=2, sort_keys=True)
+        out_file.write('\n')
+        return
+
+    for name in ('mode', 'workers', 'input_bytes', 'sampled_bytes',
+                 'peak_memory_bytes'):
+        out_file.write("%s: %s\n" % (name, plan[name]))
+    out_file.write("build_seconds: %.1f\n" % plan['build_seconds'])
+    for (stage, seconds) in sorted(plan['stages'].items()):
+        out_file.write("stage.%s: %.1fs\n" % (stage, seconds))
+    for (column_number, column) in sorted(plan['columns'].items()):
+        for (name, value) in sorted(column.items()):
+            out_file.write("column.%s.%s: %s\n" % (column_number, name,
+                                                   value))
@@ -0,0 +1,230 @@
+#!/usr/bin/python
+
+# Copyright (c) 2013, Paul Michael Furley <paul@paulfurley.com>
+# All rights reserved.
+
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+
+# - Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+# - Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# - Neither the name of the <ORGANIZATION> nor the names of its contributors
+#   may be used to endorse or promote products derived from this software
+#   without specific prior written permission.
+
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Hash-partitioned (sharded) indexes. Each value is routed to one of a number
+of shards by the high bits of its CRC-32, so that every build, on whatever
+machine, and every reader agree on where a value belongs. A sharded build
+writes one filter per column per shard, and a manifest listing the files:
+
+    {"bfshards": 1, "hash": "crc32", "num_shards": 4,
+     "columns": [{"label": "1", "files": ["data.csv.1.shard0-of-4.bfindex",
+                                           ...]}, ...]}
+
+Filenames are relative to the manifest's directory. A reader routes each
+key in the same way and only loads the shards its keys are routed to.
+"""
+
+import os
+import json
+import zlib
+
+from bfindex import load_filter, probe_many
+
+_MANIFEST_VERSION = 1
+_MANIFEST_PREFIX = '{\n  "bfshards": '
+SHARD_HASH = 'crc32'
+
+
+class MissingShard(IOError):
+    pass
+
+
+def shard_of(value, num_shards):
+    """
+    Return the shard, from 0 to num_shards - 1, which value is routed to.
+
+    >>> [shard_of(value, 4) for value in ('apple', 'banana', 'cherry')]
+    [2, 0, 3]
+    """
+    return ((zlib.crc32(value) & 0xffffffff) * num_shards) >> 32
+
+
+def shard_label(column_number, shard, num_shards):
+    """
+    Return the label under which one shard of a column is indexed.
+
+    >>> shard_label(3, 0, 4)
+    '3.shard0-of-4'
+    """
+    return "%s.shard%d-of-%d" % (column_number, shard, num_shards)
+
+
+def manifest_filename(infile):
+    """
+    Return the shard manifest filename for this input filename.
+    >>> manifest_filename('test.csv')
+    'test.csv.bfshards'
+    """
+    return "%s.bfshards" % infile
+
+
+class Sharding(object):
+    """
+    Routes the values of a build to num_shards shards, keeping only those
+    routed to one of shards (by default all of them), so that shards can be
+    built separately and each build only holds its own values. The columns
+    seen are remembered, so that a shard which receives no values for a
+    column still gets a filter.
+    """
+
+    def __init__(self, num_shards, shards=()):
+        self.num_shards = num_shards
+        self.shards = set(shards or xrange(num_shards))
+        self.columns = set()
+
+    def route(self, column_values):
+        """
+        Yield a (shard label, value) pair for each non-empty value of an
+        iterable of (column_number, value) pairs routed to a kept shard.
+
+        >>> sharding = Sharding(4, [2])
+        >>> list(sharding.route([(1, 'apple'), (1, 'banana'), (2, '')]))
+        [('1.shard2-of-4', 'apple')]
+        """
+        num_shards = self.num_shards
+        shards = self.shards
+        columns = self.columns
+        for (column_number, value) in column_values:
+            if not value:
+                continue
+            columns.add(column_number)
+            shard = shard_of(value, num_shards)
+            if shard in shards:
+                yield (shard_label(column_number, shard, num_shards), value)
+
+    def labels(self):
+        """Return the label of each kept shard of each column seen."""
+        return [shard_label(column_number, shard, self.num_shards)
+                for column_number in sorted(self.columns)
+                for shard in sorted(self.shards)]
+
+    def write_manifest(self, path, shard_filename):
+        """
+        Write the manifest to the file named by path, for the columns seen.
+        shard_filename(label) gives the file each shard is written to.
+        Every build of the same input writes the same manifest, whichever
+        shards it keeps.
+        """
+        directory = os.path.dirname(os.path.abspath(path))
+        columns = []
+        for column_number in sorted(self.columns):
+            files = [os.path.relpath(os.path.abspath(shard_filename(
+                shard_label(column_number, shard, self.num_shards))),
+                directory) for shard in xrange(self.num_shards)]
+            columns.append({'label': str(column_number), 'files': files})
+        with open(path, 'wb') as f:
+            json.dump({'bfshards': _MANIFEST_VERSION, 'hash': SHARD_HASH,
+                       'num_shards': self.num_shards, 'columns': columns},
+                      f, indent=2, sort_keys=True, separators=(',', ': '))
+            f.write('\n')
+
+
+def is_shard_manifest(path):
+    """
+    Return whether the file named by path is a shard manifest.
+
+    >>> is_shard_manifest('/dev/null')
+    False
+    """
+    with open(path, 'rb') as f:
+        return f.read(len(_MANIFEST_PREFIX)) == _MANIFEST_PREFIX
+
+
+def read_manifest(path):
+    """
+    Read the shard manifest named by path. Returns a list of (label, files)
+    pairs, one per column, each listing the paths of its shards in order.
+    """
+    with open(path, 'rb') as f:
+        manifest = json.load(f)
+    if manifest.get('bfshards') != _MANIFEST_VERSION:
+        raise ValueError("Unsupported shard manifest version %s" %
+                         manifest.get('bfshards'))
+    if manifest['hash'] != SHARD_HASH:
+        raise ValueError("Unsupported shard hash %s" % manifest['hash'])
+
+    directory = os.path.dirname(os.path.abspath(path))
+    columns = []
+    for column in manifest['columns']:
+        files = [os.path.normpath(os.path.join(directory, name))
+                 for name in column['files']]
+        if len(files) != manifest['num_shards']:
+            raise ValueError("Column %s of %s does not list %d shards" % (
+                column['label'], path, manifest['num_shards']))
+        columns.append((str(column['label']), [str(name) for name in files]))
+    return columns
+
+
+class ShardedIndex(object):
+    """
+    The shards of one column, behaving as a single read-only filter. Keys
+    are routed as the build routed values, and each shard is loaded, memory
+    mapped with use_mmap, the first time a key is routed to it.
+    """
+
+    def __init__(self, paths, use_mmap=True):
+        self.paths = paths
+        self.use_mmap = use_mmap
+        self._shards = {}
+
+    @property
+    def num_shards(self):
+        return len(self.paths)
+
+    def shard(self, shard):
+        """
+        Return the filter of one shard, loading it if need be. Raises
+        MissingShard if its file does not exist.
+        """
+        bloom_filter = self._shards.get(shard)
+        if bloom_filter is None:
+            path = self.paths[shard]
+            if not os.path.isfile(path):
+                raise MissingShard("missing shard %s" % path)
+            bloom_filter = load_filter(path, self.use_mmap)
+            self._shards[shard] = bloom_filter
+        return bloom_filter
+
+    def __contains__(self, key):
+        return key in self.shard(shard_of(key, self.num_shards))
+
+    def contains_many(self, keys):
+        """Return a list saying whether each of keys is in its shard."""
+        keys = list(keys)
+        by_shard = {}
+        for (i, key) in enumerate(keys):
+            by_shard.setdefault(shard_of(key, self.num_shards), []).append(i)
+
+        found = [False] * len(keys)
+        for (shard, positions) in by_shard.items():
+            hits = probe_many(self.shard(shard), [keys[i] for i in positions])
+            for (i, hit) in zip(positions, hits):
+                found[i] = bool(hit)
+        return found
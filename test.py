@@ -28,14 +28,59 @@
 # POSSIBILITY OF SUCH DAMAGE.
 
 import unittest
+import sys
 import os
+import re
 import glob
+import random
+import json
+import gzip
+import bz2
+import socket
+import threading
+import time
 
 from cStringIO import StringIO
 from pybloom import BloomFilter
 
-from bloom_indexer import (parse_arguments, create_index, MissingArgument,
-                           InvalidArgument)
+from bloom_indexer import (parse_arguments, open_and_create, create_index,
+                           create_streaming_index, create_parallel_index,
+                           create_incremental_index, split_byte_ranges,
+                           recurse_domain, DomainExpander, MissingArgument,
+                           InvalidArgument, parse_csv_file,
+                           iter_delimited_columns, plan_index,
+                           create_multi_file_index, composite_key,
+                           add_column_values, create_generation_index,
+                           open_index_writer)
+from checkpoint import read_checkpoint, fingerprint, SAMPLE_SIZE
+from isdomain import is_domain, is_domain_many, load_tld_file, TLD_FILE
+from benchmark import generate_csv, run_scenario, STAGES
+import bloom_query
+from bloom_query import load_bloom_filter, load_indexes, query_indexes
+import bloom_server
+from bloom_server import IndexSet, create_server
+from bfindex import load_filter, LayeredBloomFilter
+from build_stats import BuildStats
+from index_container import IndexContainer, ContainerWriter
+from shards import Sharding, ShardedIndex, shard_of, read_manifest
+from generations import Generations, GenerationalIndex
+from pipeline import BackgroundIterator, BackgroundWriter, write_atomically
+from normalize import Normalizer
+import bloom_combine
+import compression
+from compression import detect_compression, DecompressingReader
+import planner
+from planner import ColumnSample, read_sample, write_plan
+
+try:
+    import numpy_bloom
+    import blocked_bloom
+    import fingerprint_filters
+    from numpy_bloom import NumpyBloomFilter
+    from blocked_bloom import BlockedBloomFilter
+    from fingerprint_filters import CuckooFilter, XorFilter, BinaryFuseFilter
+except ImportError:
+    numpy_bloom = None
 
 TEST_FILE_CONTENT = (
     "FieldA,FieldB,FieldC\n"
@@ -102,6 +147,28 @@ class TopLevelTest(unittest.TestCase):
                      'google.co.uk', 'co.uk', 'uk'):
             self.assertEqual(True, word in b)
 
+    def test_streaming_matches_in_memory_build(self):
+        result = create_streaming_index(
+            '/tmp/fake.csv',  # input filename
+            self.test_file,   # file-like object
+            0.0001,           # error rate
+            1,                # skip lines
+            [1, 3],           # fields
+            ',',              # delimiter
+            True)             # recursive domain
+        self.assertEqual(
+            {'/tmp/fake.csv.1.bfindex': 5,
+             '/tmp/fake.csv.3.bfindex': 9},
+            result)
+
+        b1 = BloomFilter.fromfile(open('/tmp/fake.csv.1.bfindex', 'rb'))
+        b3 = BloomFilter.fromfile(open('/tmp/fake.csv.3.bfindex', 'rb'))
+        self.assertEqual(False, 'FieldA' in b1)
+        for word in ('apple', 'banana', 'orange', 'pear', 'pineapple'):
+            self.assertEqual(True, word in b1)
+        for word in ('www.google.co.uk', 'google.co.uk', 'co.uk', 'uk'):
+            self.assertEqual(True, word in b3)
+
     def test_higher_field_than_column_count(self):
         self.assertRaises(
             InvalidArgument,
@@ -115,6 +182,1482 @@ class TopLevelTest(unittest.TestCase):
                 False))           # recursive domain
 
 
+class AppendTest(unittest.TestCase):
+    def setUp(self):
+        create_index('/tmp/fake.csv', StringIO(TEST_FILE_CONTENT), 0.0001, 1,
+                     [1], ',', False)
+
+    def tearDown(self):
+        for tmpfile in glob.glob('/tmp/fake.csv.*.bfindex'):
+            os.unlink(tmpfile)
+
+    def test_append_known_values_keeps_plain_filter(self):
+        result = create_index('/tmp/fake.csv', StringIO(TEST_FILE_CONTENT),
+                              0.0001, 1, [1], ',', False, append=True)
+        self.assertEqual({'/tmp/fake.csv.1.bfindex': 5}, result)
+
+        b1 = BloomFilter.fromfile(open('/tmp/fake.csv.1.bfindex', 'rb'))
+        self.assertEqual(True, 'pineapple' in b1)
+
+    def test_append_beyond_capacity_adds_layer(self):
+        new_rows = 'header\n' + ''.join('fruit%d\n' % i for i in range(20))
+        for create in (create_index, create_streaming_index):
+            create('/tmp/fake.csv', StringIO(new_rows), 0.0001, 1, [1], ',',
+                   False, append=True)
+
+        b1 = load_filter('/tmp/fake.csv.1.bfindex')
+        self.assertTrue(isinstance(b1, LayeredBloomFilter))
+        self.assertEqual(2, len(b1.layers))
+        self.assertEqual(25, b1.count)
+        for word in ('apple', 'pineapple', 'fruit0', 'fruit19'):
+            self.assertEqual(True, word in b1)
+        self.assertEqual(False, 'header' in b1)
+        self.assertTrue(b1.layers[1].error_rate < 0.0001)
+
+
+class IncrementalIndexTest(unittest.TestCase):
+    def setUp(self):
+        with open('/tmp/fake.csv', 'wb') as f:
+            f.write(TEST_FILE_CONTENT + 'kiwi,pea')
+
+    def tearDown(self):
+        for tmpfile in glob.glob('/tmp/fake.csv*'):
+            os.unlink(tmpfile)
+
+    def index(self):
+        return create_incremental_index(
+            '/tmp/fake.csv', 0.0001, 1, [1], ',', False)
+
+    def test_only_new_lines_are_indexed(self):
+        self.assertEqual({'/tmp/fake.csv.1.bfindex': 5}, self.index())
+        self.assertEqual(len(TEST_FILE_CONTENT),
+                         read_checkpoint('/tmp/fake.csv')['offset'])
+
+        with open('/tmp/fake.csv', 'ab') as f:
+            f.write(',bean\nmango,pea\n')
+        self.assertEqual({'/tmp/fake.csv.1.bfindex': 7}, self.index())
+
+        b1 = load_filter('/tmp/fake.csv.1.bfindex')
+        for word in ('apple', 'pineapple', 'kiwi', 'mango'):
+            self.assertEqual(True, word in b1)
+        self.assertEqual(False, 'FieldA' in b1)
+
+    def test_rewritten_file_is_rebuilt(self):
+        self.index()
+        with open('/tmp/fake.csv', 'wb') as f:
+            f.write('FieldA,FieldB\n' + 'x' * len(TEST_FILE_CONTENT) + ',y\n')
+        self.assertEqual({'/tmp/fake.csv.1.bfindex': 1}, self.index())
+
+        b1 = load_filter('/tmp/fake.csv.1.bfindex')
+        self.assertEqual(False, 'apple' in b1)
+
+    def test_rewrite_in_the_middle_is_rebuilt(self):
+        # Far more than 64KB each side of the rewritten line.
+        content = TEST_FILE_CONTENT + ''.join(
+            'filler%06d,x\n' % i for i in xrange(20000))
+        with open('/tmp/fake.csv', 'wb') as f:
+            f.write(content)
+        self.index()
+        with open('/tmp/fake.csv', 'r+b') as f:
+            f.write(content.replace('filler010000', 'lychee010000'))
+        self.assertEqual({'/tmp/fake.csv.1.bfindex': 20005}, self.index())
+
+        b1 = load_filter('/tmp/fake.csv.1.bfindex')
+        self.assertEqual((True, False), ('lychee010000' in b1,
+                                         'filler010000' in b1))
+
+    def test_fingerprint_reads_a_bounded_sample(self):
+        class CountingFile(object):
+            def __init__(self, content):
+                self.f = StringIO(content)
+                self.bytes_read = 0
+
+            def seek(self, offset):
+                self.f.seek(offset)
+
+            def read(self, size):
+                data = self.f.read(size)
+                self.bytes_read += len(data)
+                return data
+
+        for size in (100, 10 * SAMPLE_SIZE):
+            f = CountingFile('x' * size)
+            digest = fingerprint(f, size)
+            self.assertTrue(f.bytes_read <= min(size, 2 * SAMPLE_SIZE))
+            self.assertNotEqual(digest, fingerprint(
+                StringIO('x' * (size - 1) + 'y'), size))
+
+    def test_missing_index_is_rebuilt(self):
+        self.index()
+        with open('/tmp/fake.csv', 'ab') as f:
+            f.write(',bean\nmango,pea\n')
+        os.unlink('/tmp/fake.csv.1.bfindex')
+        self.assertEqual({'/tmp/fake.csv.1.bfindex': 7}, self.index())
+        self.assertEqual(True, 'apple' in load_filter(
+            '/tmp/fake.csv.1.bfindex'))
+
+    @unittest.skipIf(numpy_bloom is None, "numpy is not installed")
+    def test_other_engine_is_rebuilt(self):
+        self.index()
+        with open('/tmp/fake.csv', 'ab') as f:
+            f.write(',bean\nmango,pea\n')
+        self.assertEqual({'/tmp/fake.csv.1.bfindex': 7},
+                         create_incremental_index(
+                             '/tmp/fake.csv', 0.0001, 1, [1], ',', False,
+                             engine='blocked'))
+        bloom = load_filter('/tmp/fake.csv.1.bfindex')
+        self.assertTrue(isinstance(bloom, BlockedBloomFilter))
+        self.assertEqual(True, 'apple' in bloom)
+
+
+class ParallelIndexTest(unittest.TestCase):
+    def setUp(self):
+        with open('/tmp/fake.csv', 'wb') as f:
+            f.write(TEST_FILE_CONTENT)
+
+    def tearDown(self):
+        for tmpfile in glob.glob('/tmp/fake.csv*'):
+            os.unlink(tmpfile)
+
+    def test_byte_ranges_are_line_aligned(self):
+        ranges = split_byte_ranges('/tmp/fake.csv', 1, 3)
+        self.assertEqual(3, len(ranges))
+        self.assertEqual(len('FieldA,FieldB,FieldC\n'), ranges[0][0])
+        self.assertEqual(len(TEST_FILE_CONTENT), ranges[-1][1])
+        for (start, end) in ranges:
+            self.assertEqual('\n', TEST_FILE_CONTENT[start - 1])
+
+    def test_parallel_matches_serial_build(self):
+        result = create_parallel_index(
+            '/tmp/fake.csv', 0.0001, 1, [1, 2, 3], ',', True, 3)
+        self.assertEqual(
+            {'/tmp/fake.csv.1.bfindex': 5,
+             '/tmp/fake.csv.2.bfindex': 6,
+             '/tmp/fake.csv.3.bfindex': 9},
+            result)
+
+        b1 = BloomFilter.fromfile(open('/tmp/fake.csv.1.bfindex', 'rb'))
+        b3 = BloomFilter.fromfile(open('/tmp/fake.csv.3.bfindex', 'rb'))
+        self.assertEqual(False, 'FieldA' in b1)
+        for word in ('apple', 'banana', 'orange', 'pear', 'pineapple'):
+            self.assertEqual(True, word in b1)
+        for word in ('example.domain.com', 'yahoo.com', 'co.uk'):
+            self.assertEqual(True, word in b3)
+
+    def test_parallel_higher_field_than_column_count(self):
+        self.assertRaises(
+            InvalidArgument,
+            lambda: create_parallel_index(
+                '/tmp/fake.csv', 0.0001, 1, [4], ',', False, 2))
+
+
+@unittest.skipIf(numpy_bloom is None, 'numpy is not installed')
+class NumpyEngineTest(unittest.TestCase):
+    def setUp(self):
+        self.test_file = StringIO(TEST_FILE_CONTENT)
+
+    def tearDown(self):
+        for tmpfile in glob.glob('/tmp/fake.csv.*.bfindex'):
+            os.unlink(tmpfile)
+
+    def test_compat_engine_is_readable_by_pybloom(self):
+        result = create_index(
+            '/tmp/fake.csv', self.test_file, 0.0001, 1, [1, 3], ',', True,
+            engine='numpy-compat')
+        self.assertEqual(
+            {'/tmp/fake.csv.1.bfindex': 5,
+             '/tmp/fake.csv.3.bfindex': 9},
+            result)
+
+        b3 = BloomFilter.fromfile(open('/tmp/fake.csv.3.bfindex', 'rb'))
+        for word in ('subdomain.yahoo.com', 'yahoo.com', 'com', 'co.uk'):
+            self.assertEqual(True, word in b3)
+        self.assertEqual(False, 'apple' in b3)
+
+    def test_numpy_engine_streaming(self):
+        result = create_streaming_index(
+            '/tmp/fake.csv', self.test_file, 0.0001, 1, [2], ',', False,
+            engine='numpy')
+        self.assertEqual({'/tmp/fake.csv.2.bfindex': 6}, result)
+
+        b2 = NumpyBloomFilter.fromfile(open('/tmp/fake.csv.2.bfindex', 'rb'))
+        self.assertEqual(
+            [True, True, False],
+            list(b2.contains_many(['carrot', 'broccoli', 'FieldB'])))
+
+    def test_mmapfile_is_read_only_view(self):
+        create_index('/tmp/fake.csv', self.test_file, 0.0001, 1, [1], ',',
+                     False, engine='numpy')
+        b1 = NumpyBloomFilter.mmapfile('/tmp/fake.csv.1.bfindex')
+        self.assertEqual(False, b1.bits.flags.writeable)
+        self.assertEqual(
+            [True, False], list(b1.contains_many(['apple', 'FieldA'])))
+        self.assertRaises(ValueError, lambda: b1.add('FieldA'))
+
+    def test_pybloom_round_trip(self):
+        bloom = BloomFilter(capacity=1000, error_rate=0.001)
+        for word in ('apple', 'banana'):
+            bloom.add(word)
+
+        converted = NumpyBloomFilter.from_pybloom(bloom)
+        self.assertEqual(
+            [True, True, False],
+            list(converted.contains_many(['apple', 'banana', 'cherry'])))
+        converted.add('cherry')
+        self.assertEqual(True, 'cherry' in converted.to_pybloom())
+
+
+@unittest.skipIf(numpy_bloom is None, "numpy is not installed")
+class BlockedBloomTest(unittest.TestCase):
+    def setUp(self):
+        with open('/tmp/fake.csv', 'wb') as f:
+            f.write(TEST_FILE_CONTENT)
+
+    def tearDown(self):
+        for tmpfile in glob.glob('/tmp/fake.csv*'):
+            os.unlink(tmpfile)
+
+    def test_false_positive_rate_holds(self):
+        for (error_rate, probes) in ((0.01, 100000), (0.001, 500000)):
+            bloom = BlockedBloomFilter(capacity=20000, error_rate=error_rate)
+            self.assertEqual(20000, bloom.add_many('key%d' % i
+                                                   for i in xrange(20000)))
+            self.assertTrue(bloom.contains_many('key%d' % i
+                                                for i in xrange(20000)).all())
+            false_positives = bloom.contains_many(
+                'absent%d' % i for i in xrange(probes)).sum()
+            self.assertTrue(false_positives <= error_rate * probes)
+            self.assertTrue(bloom.estimated_error_rate() < error_rate)
+
+    def test_build_and_load(self):
+        result = create_index('/tmp/fake.csv', StringIO(TEST_FILE_CONTENT),
+                              0.0001, 1, [1, 3], ',', True, engine='blocked')
+        self.assertEqual({'/tmp/fake.csv.1.bfindex': 5,
+                          '/tmp/fake.csv.3.bfindex': 9}, result)
+        with open('/tmp/fake.csv.3.bfindex', 'rb') as f:
+            self.assertEqual('BFTY', f.read(4))
+
+        for use_mmap in (False, True):
+            b3 = load_filter('/tmp/fake.csv.3.bfindex', use_mmap=use_mmap)
+            self.assertTrue(isinstance(b3, BlockedBloomFilter))
+            self.assertEqual(
+                [True, True, False],
+                list(b3.contains_many(['co.uk', 'yahoo.com', 'apple'])))
+        self.assertRaises(ValueError, lambda: b3.add('apple'))
+
+    def test_corrupt_file_is_rejected(self):
+        create_index('/tmp/fake.csv', StringIO(TEST_FILE_CONTENT), 0.0001, 1,
+                     [1], ',', False, engine='blocked')
+        with open('/tmp/fake.csv.1.bfindex', 'r+b') as f:
+            f.seek(-1, os.SEEK_END)
+            last = f.read(1)
+            f.seek(-1, os.SEEK_END)
+            f.write(chr(ord(last) ^ 1))
+        self.assertRaises(ValueError,
+                          lambda: load_filter('/tmp/fake.csv.1.bfindex'))
+
+    def test_append_and_parallel_build(self):
+        create_parallel_index('/tmp/fake.csv', 0.0001, 0, [1], ',', False, 2,
+                              engine='blocked')
+        new_rows = 'header\n' + ''.join('fruit%d\n' % i for i in range(20))
+        create_index('/tmp/fake.csv', StringIO(new_rows), 0.0001, 1, [1], ',',
+                     False, append=True)
+
+        b1 = load_filter('/tmp/fake.csv.1.bfindex', use_mmap=True)
+        self.assertTrue(isinstance(b1, LayeredBloomFilter))
+        self.assertTrue(isinstance(b1.layers[1], BlockedBloomFilter))
+        for word in ('FieldA', 'pineapple', 'fruit19'):
+            self.assertEqual(True, word in b1)
+
+    def test_append_past_full_layers(self):
+        for batch in xrange(4):
+            rows = ''.join('v%d-%d\n' % (batch, i) for i in xrange(1000))
+            create_index('/tmp/fake.csv', StringIO(rows), 0.001, 0, [1], ',',
+                         False, engine='blocked', append=batch > 0)
+
+        b1 = load_filter('/tmp/fake.csv.1.bfindex')
+        self.assertTrue(all(b1.contains_many('v3-%d' % i
+                                             for i in xrange(1000))))
+        self.assertEqual([0.001, 0.0005, 0.00025],
+                         [layer.error_rate for layer in b1.layers])
+
+
+@unittest.skipIf(numpy_bloom is None, "numpy is not installed")
+class FilterTypeTest(unittest.TestCase):
+    def setUp(self):
+        with open('/tmp/fake.csv', 'wb') as f:
+            f.write(TEST_FILE_CONTENT)
+
+    def tearDown(self):
+        for tmpfile in glob.glob('/tmp/fake.csv*'):
+            os.unlink(tmpfile)
+
+    def test_false_positive_rates_hold(self):
+        for filter_class in (CuckooFilter, XorFilter, BinaryFuseFilter):
+            f = filter_class(capacity=20000, error_rate=0.001)
+            f.add_many('key%d' % i for i in xrange(20000))
+            f.tofile(StringIO())
+            self.assertEqual(20000, f.count)
+            self.assertTrue(f.contains_many('key%d' % i
+                                            for i in xrange(20000)).all())
+            false_positives = f.contains_many('absent%d' % i
+                                              for i in xrange(100000)).sum()
+            self.assertTrue(false_positives < 150)
+
+    def test_static_filters_are_smaller(self):
+        bloom = BlockedBloomFilter(capacity=100000, error_rate=0.00001)
+        for filter_class in (XorFilter, BinaryFuseFilter):
+            f = filter_class(capacity=100000, error_rate=0.00001)
+            f.add_many('key%d' % i for i in xrange(100000))
+            f.build()
+            self.assertTrue(f.num_bits < 0.75 * bloom.num_bits)
+            self.assertRaises(ValueError, lambda: f.add('apple'))
+
+    def test_cuckoo_remove(self):
+        cuckoo = CuckooFilter(capacity=1000, error_rate=0.001)
+        cuckoo.add_many('key%d' % i for i in xrange(1000))
+        self.assertEqual(500, cuckoo.remove_many('key%d' % i
+                                                 for i in xrange(500)))
+        self.assertEqual(500, cuckoo.count)
+        self.assertTrue(cuckoo.contains_many('key%d' % i
+                                             for i in xrange(500, 1000)).all())
+        self.assertTrue(cuckoo.contains_many('key%d' % i
+                                             for i in xrange(500)).sum() < 5)
+
+    def test_build_and_load_each_type(self):
+        for filter_type in ('cuckoo', 'xor', 'binary-fuse'):
+            result = create_index('/tmp/fake.csv', StringIO(TEST_FILE_CONTENT),
+                                  0.0001, 1, [1, 3], ',', True,
+                                  filter_type=filter_type)
+            self.assertEqual({'/tmp/fake.csv.1.bfindex': 5,
+                              '/tmp/fake.csv.3.bfindex': 9}, result)
+            for use_mmap in (False, True):
+                b3 = load_filter('/tmp/fake.csv.3.bfindex', use_mmap=use_mmap)
+                self.assertEqual(9, b3.count)
+                self.assertEqual(
+                    [True, True, False],
+                    list(b3.contains_many(['co.uk', 'yahoo.com', 'apple'])))
+
+    def test_streaming_parallel_and_append(self):
+        create_index('/tmp/fake.csv', StringIO(TEST_FILE_CONTENT), 0.0001, 1,
+                     [1], ',', False, filter_type='xor')
+        expected = load_filter('/tmp/fake.csv.1.bfindex').count
+        create_streaming_index('/tmp/fake.csv', StringIO(TEST_FILE_CONTENT),
+                               0.0001, 1, [1], ',', False,
+                               filter_type='binary-fuse')
+        self.assertEqual(expected, load_filter('/tmp/fake.csv.1.bfindex').count)
+
+        result = create_parallel_index('/tmp/fake.csv', 0.0001, 1, [1], ',',
+                                       False, 2, filter_type='xor')
+        self.assertEqual({'/tmp/fake.csv.1.bfindex': expected}, result)
+
+        new_rows = 'header\n' + ''.join('fruit%d\n' % i for i in range(20))
+        create_index('/tmp/fake.csv', StringIO(new_rows), 0.0001, 1, [1], ',',
+                     False, append=True)
+        b1 = load_filter('/tmp/fake.csv.1.bfindex')
+        self.assertTrue(isinstance(b1, LayeredBloomFilter))
+        self.assertTrue(isinstance(b1.layers[1], XorFilter))
+        self.assertEqual(expected + 20, b1.count)
+        for word in ('pineapple', 'fruit19'):
+            self.assertEqual(True, word in b1)
+
+    def test_engine_only_applies_to_bloom(self):
+        self.assertRaises(InvalidArgument, lambda: parse_arguments([
+            'fake.py', '-i/tmp/fake.csv', '--filter-type=xor',
+            '--engine=numpy']))
+
+
+class PlanTest(unittest.TestCase):
+    def setUp(self):
+        with open('/tmp/fake.csv', 'wb') as f:
+            f.write(TEST_FILE_CONTENT)
+
+    def tearDown(self):
+        for tmpfile in glob.glob('/tmp/fake.csv*'):
+            os.unlink(tmpfile)
+
+    def test_predicts_file_sizes(self):
+        filter_kinds = [('pybloom', 'bloom')]
+        if numpy_bloom is not None:
+            filter_kinds.extend([('numpy', 'bloom'), ('blocked', 'bloom'),
+                                 ('pybloom', 'cuckoo'), ('pybloom', 'xor'),
+                                 ('pybloom', 'binary-fuse')])
+        for (engine, filter_type) in filter_kinds:
+            plan = plan_index(['/tmp/fake.csv'], '', 0.0001, 1, [1, 3], ',',
+                              True, engine=engine, filter_type=filter_type)
+            self.assertEqual([], glob.glob('/tmp/fake.csv.*.bfindex'))
+            self.assertEqual('memory', plan['mode'])
+            self.assertEqual([1, 3], sorted(plan['columns']))
+            create_index('/tmp/fake.csv', StringIO(TEST_FILE_CONTENT),
+                         0.0001, 1, [1, 3], ',', True, engine=engine,
+                         filter_type=filter_type)
+            for (column, distinct) in ((1, 5), (3, 9)):
+                predicted = plan['columns'][column]
+                self.assertEqual(distinct,
+                                 predicted['estimated_distinct_values'])
+                self.assertEqual(os.path.getsize(predicted['file']),
+                                 predicted['filter_bytes'])
+                os.unlink(predicted['file'])
+
+    def test_modes(self):
+        plan = plan_index(['/tmp/fake.csv'], '', 0.0001, 1, [1], ',', False,
+                          streaming=True)
+        self.assertEqual(('streaming', 1), (plan['mode'], plan['workers']))
+        self.assertEqual(['insert', 'sketch'], sorted(plan['stages']))
+        self.assertTrue(plan['columns'][1]['capacity'] >= 5)
+        plan = plan_index(['/tmp/fake.csv', '/tmp/fake.csv'], '/tmp/fake.csv',
+                          0.0001, 1, [1], ',', False, jobs=2)
+        self.assertEqual(('parallel', 2), (plan['mode'], plan['workers']))
+        self.assertEqual('/tmp/fake.csv.1.bfindex',
+                         plan['columns'][1]['file'])
+        self.assertEqual(2 * 140, plan['input_bytes'])
+
+    def test_sample_spans_file(self):
+        with open('/tmp/fake.csv', 'wb') as f:
+            f.write('header\n')
+            f.writelines('%06d\n' % i for i in xrange(100000))
+        (blocks, data_bytes) = read_sample('/tmp/fake.csv', 1, 70000, 10)
+        self.assertEqual(700000, data_bytes)
+        self.assertTrue(70000 <= sum(len(block) for block in blocks) < 70070)
+        for block in blocks:
+            self.assertTrue(block.endswith('\n'))
+            self.assertEqual(0, len(block) % 7)
+        self.assertEqual('000000\n', blocks[0][:7])
+        self.assertTrue(int(blocks[-1][:6]) > 80000)
+
+    def test_extrapolates_distinct_values(self):
+        unique = ColumnSample()
+        repeated = ColumnSample()
+        for i in xrange(10000):
+            first_half = (i // 1000) % 2 == 0
+            unique.add('key%d' % i, 10.0, first_half)
+            repeated.add('key%d' % (i % 100), 10.0, first_half)
+        self.assertTrue(90000 < unique.estimated_distinct_values() <= 100000)
+        self.assertTrue(90 < repeated.estimated_distinct_values() < 110)
+
+    def test_plan_option(self):
+        config = parse_arguments(['fake.py', '-i/tmp/fake.csv', '--plan'])
+        self.assertEqual(True, config['plan'])
+        out = StringIO()
+        write_plan({'mode': 'memory', 'stages': {'parse': 1.0}}, 'json', out)
+        self.assertEqual({'mode': 'memory', 'stages': {'parse': 1.0}},
+                         json.loads(out.getvalue()))
+
+
+class CompositeTest(unittest.TestCase):
+    def setUp(self):
+        with open('/tmp/fake.csv', 'wb') as f:
+            f.write(TEST_FILE_CONTENT)
+
+    def tearDown(self):
+        for tmpfile in glob.glob('/tmp/fake.csv*'):
+            os.unlink(tmpfile)
+
+    def assert_composite_index(self, result):
+        self.assertEqual({'/tmp/fake.csv.1.bfindex': 5,
+                          '/tmp/fake.csv.1+3.bfindex': 5}, result)
+        bloom = load_filter('/tmp/fake.csv.1+3.bfindex')
+        self.assertTrue(composite_key(['orange', 'subdomain.yahoo.com'])
+                        in bloom)
+        self.assertTrue(composite_key(['pear', '']) in bloom)
+        for values in (['orange', 'www.google.co.uk'],
+                       ['orange', 'yahoo.com'], ['', '']):
+            self.assertFalse(composite_key(values) in bloom)
+
+    def test_composite_groups(self):
+        for parser in ('csv', 'fast'):
+            self.assert_composite_index(create_index(
+                '/tmp/fake.csv', StringIO(TEST_FILE_CONTENT), 0.0001, 1,
+                [1, '1+3'], ',', True, parser=parser))
+            self.assert_composite_index(create_streaming_index(
+                '/tmp/fake.csv', StringIO(TEST_FILE_CONTENT), 0.0001, 1,
+                [1, '1+3'], ',', True, parser=parser))
+            result = create_multi_file_index(
+                ['/tmp/fake.csv'], '/tmp/fake.csv', 0.0001, 1, [1, '1+3'],
+                ',', True, parser=parser)
+            self.assertEqual(['/tmp/fake.csv.1+3.bfindex',
+                              '/tmp/fake.csv.1.bfindex'], sorted(result))
+
+    def test_composite_only(self):
+        config = parse_arguments(['fake.py', '-i/tmp/fake.csv', '-d,',
+                                  '--composite=2+1'])
+        self.assertEqual(['2+1'], config['composite'])
+        self.assertEqual({'/tmp/fake.csv.2+1.bfindex': 6},
+                         open_and_create(config))
+        self.assertRaises(InvalidArgument, lambda: open_and_create(
+            parse_arguments(['fake.py', '-i/tmp/fake.csv', '-d,',
+                             '--composite=1+4'])))
+
+    def test_query_composite_keys(self):
+        create_index('/tmp/fake.csv', StringIO(TEST_FILE_CONTENT), 0.0001, 1,
+                     ['1+2'], ',', False)
+        out = StringIO()
+        blooms = [('/tmp/fake.csv.1+2.bfindex',
+                   load_bloom_filter('/tmp/fake.csv.1+2.bfindex'))]
+        result = query_indexes(blooms, StringIO('apple\tcarrot\n'
+                                                'apple\tpotato\n'),
+                               out, misses_only=True, composite=True)
+        self.assertEqual((2, 1), result)
+        self.assertEqual('miss\tapple\x1fpotato\n', out.getvalue())
+
+
+class ContainerTest(unittest.TestCase):
+    def setUp(self):
+        with open('/tmp/fake.csv', 'wb') as f:
+            f.write(TEST_FILE_CONTENT)
+
+    def tearDown(self):
+        for tmpfile in glob.glob('/tmp/fake.csv*'):
+            os.unlink(tmpfile)
+
+    def test_build_modes(self):
+        expected = {'/tmp/fake.csv.bfpack#1': 5, '/tmp/fake.csv.bfpack#3': 9}
+        self.assertEqual(expected, create_index(
+            '/tmp/fake.csv', StringIO(TEST_FILE_CONTENT), 0.0001, 1, [1, 3],
+            ',', True, container=True))
+        self.assertEqual(expected, create_streaming_index(
+            '/tmp/fake.csv', StringIO(TEST_FILE_CONTENT), 0.0001, 1, [1, 3],
+            ',', True, container=True))
+        self.assertEqual(sorted(expected), sorted(create_multi_file_index(
+            ['/tmp/fake.csv'], '/tmp/fake.csv', 0.0001, 1, [1, 3], ',', True,
+            container=True)))
+        self.assertEqual(['/tmp/fake.csv', '/tmp/fake.csv.bfpack'],
+                         sorted(glob.glob('/tmp/fake.csv*')))
+
+    def test_directory_and_lazy_loading(self):
+        create_index('/tmp/fake.csv', StringIO(TEST_FILE_CONTENT), 0.0001, 1,
+                     [1, '2+1', 3], ',', True, container=True)
+        for use_mmap in (False, True):
+            with IndexContainer('/tmp/fake.csv.bfpack', use_mmap) as container:
+                self.assertEqual(['1', '2+1', '3'], sorted(container.labels))
+                entry = container.entry(3)
+                self.assertEqual((9, 9, 0.0001), (
+                    entry.count, entry.capacity, entry.error_rate))
+                self.assertEqual(0, entry.offset % 64)
+                self.assertTrue('co.uk' in container.load(3))
+                self.assertFalse('apple' in container.load('3'))
+                self.assertEqual(['3'], container._loaded.keys())
+                self.assertRaises(KeyError, lambda: container.load(2))
+
+    def test_checksum(self):
+        create_index('/tmp/fake.csv', StringIO(TEST_FILE_CONTENT), 0.0001, 1,
+                     [1, 3], ',', False, container=True)
+        entry = IndexContainer('/tmp/fake.csv.bfpack').entry(3)
+        with open('/tmp/fake.csv.bfpack', 'r+b') as f:
+            f.seek(entry.offset + entry.length - 1)
+            byte = f.read(1)
+            f.seek(entry.offset + entry.length - 1)
+            f.write(chr(ord(byte) ^ 1))
+        container = IndexContainer('/tmp/fake.csv.bfpack', verify=True)
+        self.assertTrue('apple' in container.load(1))
+        self.assertRaises(ValueError, lambda: container.load(3))
+
+    def test_abandoned_container(self):
+        def fail():
+            with ContainerWriter('/tmp/fake.csv.bfpack', [1]) as writer:
+                writer.write(1, BloomFilter(capacity=10))
+                raise IOError
+        self.assertRaises(IOError, fail)
+        self.assertEqual(['/tmp/fake.csv'], glob.glob('/tmp/fake.csv*'))
+
+    def test_query_and_serve_columns(self):
+        config = parse_arguments(['fake.py', '-i/tmp/fake.csv', '-d,', '-r',
+                                  '--container'])
+        open_and_create(config)
+        self.assertRaises(InvalidArgument, lambda: parse_arguments([
+            'fake.py', '-i/tmp/fake.csv', '--container', '--append']))
+
+        blooms = load_indexes(['/tmp/fake.csv.bfpack'], ['3'])
+        self.assertEqual(['/tmp/fake.csv.bfpack#3'],
+                         [name for (name, _) in blooms])
+        out = StringIO()
+        self.assertEqual((2, 1), query_indexes(
+            blooms, StringIO('apple\nyahoo.com\n'), out, hits_only=True))
+        self.assertEqual('hit\tyahoo.com\t/tmp/fake.csv.bfpack#3\n',
+                         out.getvalue())
+        self.assertRaises(InvalidArgument, lambda: load_indexes(
+            ['/tmp/fake.csv.bfpack'], ['4']))
+
+        indexes = IndexSet(['/tmp/fake.csv.bfpack'])
+        self.assertEqual(['/tmp/fake.csv.bfpack#%d' % i for i in (1, 2, 3)],
+                         sorted(name for (name, _) in indexes.blooms))
+        create_index('/tmp/fake.csv', StringIO('Fruit\nkiwi\n'), 0.0001, 1,
+                     [1], ',', False, container=True)
+        indexes.reload_changed()
+        self.assertEqual(['/tmp/fake.csv.bfpack'], indexes.reload_changed())
+        self.assertEqual([('/tmp/fake.csv.bfpack#1', True)],
+                         [(name, 'kiwi' in bloom)
+                          for (name, bloom) in indexes.blooms])
+
+
+class ShardTest(unittest.TestCase):
+    def setUp(self):
+        with open('/tmp/fake.csv', 'wb') as f:
+            f.write(TEST_FILE_CONTENT)
+
+    def tearDown(self):
+        for tmpfile in glob.glob('/tmp/fake.csv*'):
+            os.unlink(tmpfile)
+
+    def shard_values(self, column):
+        return [[value for value in ('apple', 'banana', 'orange', 'pear',
+                                     'pineapple')
+                 if value in load_filter(path)]
+                for path in dict(read_manifest('/tmp/fake.csv.bfshards'))[
+                    column]]
+
+    def test_independent_shards(self):
+        for create in (create_index, create_streaming_index):
+            index_stats = {}
+            manifests = []
+            for shard in xrange(3):
+                index_stats.update(create(
+                    '/tmp/fake.csv', StringIO(TEST_FILE_CONTENT), 0.0001, 1,
+                    [1, 3], ',', True, sharding=Sharding(3, [shard])))
+                with open('/tmp/fake.csv.bfshards') as f:
+                    manifests.append(f.read())
+            self.assertEqual(6, len(index_stats))
+            self.assertEqual(5, sum(
+                index_stats['/tmp/fake.csv.1.shard%d-of-3.bfindex' % shard]
+                for shard in xrange(3)))
+            self.assertEqual(1, len(set(manifests)))
+
+            found = self.shard_values('1')
+            self.assertEqual(['apple', 'banana', 'orange', 'pear',
+                              'pineapple'], sorted(sum(found, [])))
+            for (shard, values) in enumerate(found):
+                self.assertEqual([shard] * len(values),
+                                 [shard_of(value, 3) for value in values])
+
+        self.assertEqual([('1', ['/tmp/fake.csv.1.shard%d-of-3.bfindex' % i
+                                 for i in xrange(3)]),
+                          ('3', ['/tmp/fake.csv.3.shard%d-of-3.bfindex' % i
+                                 for i in xrange(3)])],
+                         read_manifest('/tmp/fake.csv.bfshards'))
+
+    def test_query_loads_only_routed_shards(self):
+        create_index('/tmp/fake.csv', StringIO(TEST_FILE_CONTENT), 0.0001, 1,
+                     [], ',', True, sharding=Sharding(8))
+        blooms = load_indexes(['/tmp/fake.csv.bfshards'], ['3'])
+        self.assertEqual(['/tmp/fake.csv.bfshards#3'],
+                         [name for (name, _) in blooms])
+        sharded = blooms[0][1]
+        out = StringIO()
+        self.assertEqual((4, 3), query_indexes(
+            blooms, StringIO('yahoo.com\ncom\nco.uk\napple\n'), out))
+        self.assertEqual(
+            sorted(set(shard_of(key, 8)
+                       for key in ('yahoo.com', 'com', 'co.uk', 'apple'))),
+            sorted(sharded._shards))
+        self.assertEqual([True, False], ShardedIndex(
+            sharded.paths).contains_many(['google.co.uk', 'carrot']))
+        self.assertRaises(InvalidArgument, lambda: load_indexes(
+            ['/tmp/fake.csv.bfshards'], ['4']))
+
+    def test_query_missing_shard(self):
+        create_index('/tmp/fake.csv', StringIO(TEST_FILE_CONTENT), 0.0001, 1,
+                     [1], ',', False, sharding=Sharding(4, [1]))
+        self.assertEqual(2, shard_of('apple', 4))
+        saved = (sys.argv, sys.stdin, sys.stdout, sys.stderr)
+        sys.argv = ['fake.py', '--index=/tmp/fake.csv.bfshards']
+        (sys.stdin, sys.stdout, sys.stderr) = (
+            StringIO('apple\n'), StringIO(), StringIO())
+        try:
+            with self.assertRaises(SystemExit) as context:
+                bloom_query.main()
+            self.assertEqual(2, context.exception.code)
+            self.assertTrue('missing shard /tmp/fake.csv.1.shard2-of-4.bfindex'
+                            in sys.stderr.getvalue())
+        finally:
+            (sys.argv, sys.stdin, sys.stdout, sys.stderr) = saved
+
+    def test_arguments(self):
+        config = parse_arguments(['fake.py', '-i/tmp/fake.csv', '-d,',
+                                  '--shards=4', '--shard=3,1'])
+        self.assertEqual((4, [1, 3]), (config['shards'], config['shard']))
+        open_and_create(config)
+        self.assertEqual(['/tmp/fake.csv.%d.shard%d-of-4.bfindex' % (
+            column, shard) for column in (1, 2, 3) for shard in (1, 3)],
+            sorted(glob.glob('/tmp/fake.csv.*.bfindex')))
+        self.assertEqual([4, 4, 4], [
+            len(files) for (_, files) in read_manifest(
+                '/tmp/fake.csv.bfshards')])
+        for argv in (['--shards=4', '--shard=4'], ['-N4', '-j2'],
+                     ['-N4', '--container'], ['-N4', '--incremental']):
+            self.assertRaises(InvalidArgument, lambda: parse_arguments(
+                ['fake.py', '-i/tmp/fake.csv'] + argv))
+
+
+@unittest.skipIf(numpy_bloom is None, "numpy is not installed")
+class CombineTest(unittest.TestCase):
+    def setUp(self):
+        for (path, first) in (('/tmp/fake.csv', 0), ('/tmp/fake.csv.other',
+                                                     200)):
+            with open(path, 'wb') as f:
+                f.write("Key,Value\n")
+                for i in xrange(first, first + 300):
+                    f.write("key%d,%d\n" % (i, i % 7))
+
+    def tearDown(self):
+        for tmpfile in glob.glob('/tmp/fake.csv*'):
+            os.unlink(tmpfile)
+
+    def build(self, engine, filter_type='bloom', fields=[1]):
+        for path in ('/tmp/fake.csv', '/tmp/fake.csv.other'):
+            with open(path, 'rb') as f:
+                create_index(path, f, 0.0001, 1, fields, ',', True,
+                             engine=engine, filter_type=filter_type)
+        return ['/tmp/fake.csv.1.bfindex', '/tmp/fake.csv.other.1.bfindex']
+
+    def assertAbout(self, expected, estimate):
+        self.assertTrue(abs(estimate - expected) <= 0.1 * expected,
+                        "%r is not within 10%% of %r" % (estimate, expected))
+
+    def test_union_and_intersection(self):
+        for engine in ('pybloom', 'numpy', 'blocked'):
+            paths = self.build(engine)
+            with open(paths[0], 'rb') as f:
+                source = f.read()
+            for (operation, expected) in (('union', xrange(0, 500)),
+                                          ('intersection', xrange(200, 300))):
+                report = bloom_combine.combine_index_files(
+                    paths, operation, '/tmp/fake.csv.combined')
+                bloom = load_filter('/tmp/fake.csv.combined')
+                self.assertEqual(len(expected), sum(
+                    'key%d' % i in bloom for i in xrange(-100, 600)))
+                self.assertAbout(len(expected), len(bloom))
+                result = report['result']
+                self.assertEqual(len(bloom),
+                                 round(result['estimated_cardinality']))
+                self.assertTrue(0 < result['fill_ratio'] < 1)
+                self.assertTrue(result['estimated_error_rate'] < 0.01)
+                self.assertAbout(300, report['indexes'][paths[1]][
+                    'estimated_cardinality'])
+            with open(paths[0], 'rb') as f:
+                self.assertEqual(source, f.read())
+
+    def test_incompatible_filters(self):
+        paths = self.build('numpy')
+        for (engine, filter_type) in (('blocked', 'bloom'),
+                                      ('numpy-compat', 'bloom'),
+                                      ('numpy', 'xor')):
+            with open('/tmp/fake.csv.other', 'rb') as f:
+                create_index('/tmp/fake.csv.other', f, 0.0001, 1, [1], ',',
+                             True, engine=engine, filter_type=filter_type)
+            self.assertRaises(InvalidArgument,
+                              lambda: bloom_combine.combine_index_files(
+                                  paths, 'union', '/tmp/fake.csv.combined'))
+        self.build('numpy', fields=[1, 2])
+        self.assertRaises(InvalidArgument,
+                          lambda: bloom_combine.combine_index_files(
+                              ['/tmp/fake.csv.1.bfindex',
+                               '/tmp/fake.csv.2.bfindex'], 'intersection',
+                              '/tmp/fake.csv.combined'))
+        self.assertFalse(os.path.exists('/tmp/fake.csv.combined'))
+
+    def test_arguments(self):
+        paths = self.build('numpy')
+        config = bloom_combine.parse_arguments(
+            ['fake.py', '-b', paths[0], '--index=' + paths[1], '-I',
+             '-o/tmp/fake.csv.combined', '--report=json'])
+        self.assertEqual({'indexes': paths, 'operation': 'intersection',
+                          'output': '/tmp/fake.csv.combined',
+                          'report': 'json'}, config)
+        out = StringIO()
+        bloom_combine.write_report(
+            bloom_combine.combine_index_files(paths), 'text', out)
+        self.assertTrue('index.%s.bits_set: ' % paths[0] in out.getvalue())
+        for (error, argv) in ((InvalidArgument, ['-U', '-I', '-o/tmp/x']),
+                              (MissingArgument, ['-U']),
+                              (InvalidArgument, ['-o/tmp/x']),
+                              (InvalidArgument, ['-U', '-o' + paths[0]])):
+            self.assertRaises(error, lambda: bloom_combine.parse_arguments(
+                ['fake.py', '-b', paths[0], '-b', paths[1]] + argv))
+        self.assertRaises(InvalidArgument, lambda: bloom_combine.
+                          parse_arguments(['fake.py', '-b', paths[0], '-U',
+                                           '-o/tmp/fake.csv.combined']))
+
+
+class GenerationTest(unittest.TestCase):
+    def setUp(self):
+        self.now = time.time()
+
+    def tearDown(self):
+        for tmpfile in glob.glob('/tmp/fake.csv*'):
+            os.unlink(tmpfile)
+
+    def build(self, day, values, window=2, streaming=False):
+        with open('/tmp/fake.csv', 'wb') as f:
+            f.write("Value,Day\n")
+            for value in values:
+                f.write("%s,%d\n" % (value, day))
+        return create_generation_index(
+            ['/tmp/fake.csv'], '/tmp/fake.csv.feed', 0.0001, 1, [1], ',',
+            False, Generations(window, 86400,
+                               now=self.now - (3 - day) * 86400),
+            streaming=streaming)
+
+    def probe(self, keys):
+        blooms = load_indexes(['/tmp/fake.csv.feed.bfgenerations'])
+        self.assertEqual(['/tmp/fake.csv.feed.bfgenerations#1'],
+                         [name for (name, _) in blooms])
+        return [key for (key, found) in zip(keys, blooms[0][1].contains_many(
+            keys)) if found]
+
+    def test_rotation(self):
+        for day in xrange(4):
+            self.build(day, ['day%d-%d' % (day, i) for i in xrange(50)])
+        self.assertEqual(2, len(glob.glob('/tmp/fake.csv.feed.gen*')))
+        with open('/tmp/fake.csv.feed.bfgenerations') as f:
+            manifest = json.load(f)
+        self.assertEqual(2, len(manifest['generations']))
+        self.assertTrue(manifest['generations'][0]['start'] >
+                        manifest['generations'][1]['start'])
+
+        keys = ['day%d-%d' % (day, i) for day in xrange(4)
+                for i in xrange(50)]
+        self.assertEqual(keys[100:], self.probe(keys))
+
+    def test_same_bucket_appends(self):
+        for streaming in (False, True):
+            self.build(3, ['apple', 'banana'], streaming=streaming)
+            self.build(3, ['cherry'], streaming=streaming)
+            self.assertEqual(['apple', 'banana', 'cherry'],
+                             self.probe(['apple', 'banana', 'cherry',
+                                         'damson']))
+            self.assertEqual(1, len(glob.glob('/tmp/fake.csv.feed.gen*')))
+            self.tearDown()
+
+    def test_newest_first_until_expired(self):
+        self.build(2, ['apple', 'banana'])
+        self.build(3, ['banana', 'cherry'])
+        probed = []
+
+        class Recording(object):
+            def __init__(self, bloom_filter):
+                self.bloom_filter = bloom_filter
+
+            def contains_many(self, keys):
+                probed.append(list(keys))
+                return self.bloom_filter.contains_many(keys)
+
+        now = [self.now]
+        index = load_indexes(['/tmp/fake.csv.feed.bfgenerations'])[0][1]
+        index.clock = lambda: now[0]
+        index.generations = [(expires, Recording(bloom_filter))
+                             for (expires, bloom_filter) in index.generations]
+        self.assertEqual([True, True, True, False], index.contains_many(
+            ['apple', 'banana', 'cherry', 'damson']))
+        self.assertEqual([['apple', 'banana', 'cherry', 'damson'],
+                          ['apple', 'damson']], probed)
+
+        now[0] += 86400
+        self.assertEqual([False, True, True], index.contains_many(
+            ['apple', 'banana', 'cherry']))
+        now[0] += 86400
+        self.assertEqual([False, False], index.contains_many(
+            ['banana', 'cherry']))
+
+    def test_arguments(self):
+        self.build(3, ['apple'])
+        config = parse_arguments(['fake.py', '-i/tmp/fake.csv', '-G7',
+                                  '--bucket=6h'])
+        self.assertEqual((7, 21600), (config['generations'],
+                                      config['bucket']))
+        for argv in (['-G7', '-j2'], ['-G7', '--append'], ['-G7', '-N2'],
+                     ['--bucket=6h'], ['-G0']):
+            self.assertRaises(InvalidArgument, lambda: parse_arguments(
+                ['fake.py', '-i/tmp/fake.csv'] + argv))
+
+
+class PipelineTest(unittest.TestCase):
+    def tearDown(self):
+        for tmpfile in glob.glob('/tmp/fake.csv*'):
+            os.unlink(tmpfile)
+
+    def test_background_iterator(self):
+        def failing():
+            for i in xrange(5):
+                yield i
+            raise ValueError('parse error')
+        items = []
+        def consume():
+            with BackgroundIterator(failing(), batch_items=2) as iterator:
+                for item in iterator:
+                    items.append(item)
+        self.assertRaises(ValueError, consume)
+        self.assertEqual(range(5), items)
+
+        iterator = BackgroundIterator(iter(int, 1), batch_items=1,
+                                      queue_batches=1)
+        self.assertEqual(0, next(iter(iterator)))
+        iterator.close()
+        self.assertFalse(iterator._thread.is_alive())
+
+    def test_atomic_write(self):
+        with open('/tmp/fake.csv.1.bfindex', 'wb') as f:
+            f.write('old')
+        def fail(f):
+            f.write('half')
+            raise IOError
+        self.assertRaises(IOError, lambda: write_atomically(
+            '/tmp/fake.csv.1.bfindex', fail))
+        self.assertEqual(['/tmp/fake.csv.1.bfindex'],
+                         glob.glob('/tmp/fake.csv*'))
+        self.assertEqual('old', open('/tmp/fake.csv.1.bfindex').read())
+
+    def test_background_writer(self):
+        bloom = BloomFilter(capacity=10)
+        bloom.add('apple')
+        with BackgroundWriter() as writer:
+            for column in xrange(1, 4):
+                writer.write(bloom, '/tmp/fake.csv.%d.bfindex' % column)
+        self.assertEqual(['/tmp/fake.csv.%d.bfindex' % column
+                          for column in xrange(1, 4)],
+                         sorted(glob.glob('/tmp/fake.csv*')))
+        self.assertTrue('apple' in load_filter('/tmp/fake.csv.3.bfindex'))
+
+        writer = BackgroundWriter()
+        writer.write(bloom, '/tmp/no-such-directory/fake.csv.1.bfindex')
+        self.assertRaises(IOError, writer.close)
+
+    def test_insert_stage(self):
+        blooms = {1: BloomFilter(capacity=10), 2: BloomFilter(capacity=10)}
+        add_column_values(blooms, [(1, 'apple'), (2, ''), (2, 'leek')])
+        self.assertEqual([1, 1], [blooms[1].count, blooms[2].count])
+
+        def failing():
+            yield (1, 'pear')
+            raise InvalidArgument('Field 9 invalid')
+        self.assertRaises(InvalidArgument, lambda: add_column_values(
+            blooms, failing()))
+
+
+NORMALIZE_FILE_CONTENT = (
+    "Name,Site\n"
+    "Alice,WWW.Google.COM\n"
+    " alice ,www.google.com.\n"
+    "ALICE, www.google.com \n"
+    "Bob,b\xc3\xbccher.DE\n"
+    "bob,xn--bcher-kva.de\n"
+    "Carol, \n")
+
+
+class NormalizeTest(unittest.TestCase):
+    def setUp(self):
+        with open('/tmp/fake.csv', 'wb') as f:
+            f.write(NORMALIZE_FILE_CONTENT)
+
+    def tearDown(self):
+        for tmpfile in glob.glob('/tmp/fake.csv*'):
+            os.unlink(tmpfile)
+
+    def test_variants_share_entries(self):
+        self.assertEqual(
+            {'/tmp/fake.csv.1.bfindex': 6, '/tmp/fake.csv.2.bfindex': 9},
+            create_index('/tmp/fake.csv', StringIO(NORMALIZE_FILE_CONTENT),
+                         0.0001, 1, [], ',', True))
+        expected = {'/tmp/fake.csv.1.bfindex': 3,
+                    '/tmp/fake.csv.2.bfindex': 5}
+        for parser in ('csv', 'fast'):
+            self.assertEqual(expected, create_index(
+                '/tmp/fake.csv', StringIO(NORMALIZE_FILE_CONTENT), 0.0001, 1,
+                [], ',', True, parser=parser, normalize=['space', 'case',
+                                                         'idna', 'dot']))
+            self.assertEqual(expected, create_streaming_index(
+                '/tmp/fake.csv', StringIO(NORMALIZE_FILE_CONTENT), 0.0001, 1,
+                [], ',', True, parser=parser, normalize=['space', 'case',
+                                                         'idna', 'dot']))
+
+        bloom = load_filter('/tmp/fake.csv.2.bfindex')
+        for value in ('www.google.com', 'google.com', 'com',
+                      'xn--bcher-kva.de', 'de'):
+            self.assertTrue(value in bloom)
+        for value in ('www.google.com.', 'b\xc3\xbccher.de', ''):
+            self.assertFalse(value in bloom)
+
+    def test_queries_normalize_alike(self):
+        config = parse_arguments(['fake.py', '-i/tmp/fake.csv', '-d,', '-r',
+                                  '--normalize=all'])
+        self.assertEqual(['space', 'case', 'idna', 'dot'],
+                         config['normalize'])
+        open_and_create(config)
+        blooms = load_indexes(['/tmp/fake.csv.2.bfindex'])
+        keys = 'Google.com.\nB\xc3\xbcCHER.de\n  \nyahoo.com\n'
+        out = StringIO()
+        self.assertEqual((6, 5), query_indexes(
+            blooms, StringIO(keys), out, recursive_domains=True,
+            normalize=config['normalize']))
+        self.assertEqual('miss\tyahoo.com\n', out.getvalue().splitlines(
+            True)[-2])
+        self.assertEqual((1, 0), query_indexes(
+            blooms, StringIO('Google.com.\n'), StringIO()))
+
+        server = create_server(IndexSet(['/tmp/fake.csv.2.bfindex']), '',
+                               0, True, normalize=config['normalize'])
+        self.assertEqual(['space', 'case', 'idna', 'dot'],
+                         server.normalizer.steps)
+        server.server_close()
+
+        self.assertRaises(InvalidArgument, lambda: parse_arguments([
+            'fake.py', '-i/tmp/fake.csv', '--normalize=case,upper']))
+
+    def test_memo_is_bounded(self):
+        calls = []
+        def expand(value, normalized):
+            calls.append(value)
+            return []
+        normalizer = Normalizer(['case'], expand=expand, max_size=2)
+        for value in ('A', 'B', 'A', 'C', 'A', 'D', 'E', 'B'):
+            normalizer.normalize(value)
+        self.assertEqual(['A', 'B', 'C', 'D', 'E', 'B'], calls)
+        self.assertTrue(len(normalizer._recent) <= 2)
+        self.assertTrue(len(normalizer._older) <= 2)
+
+
+class QueryTest(unittest.TestCase):
+    def setUp(self):
+        create_index('/tmp/fake.csv', StringIO(TEST_FILE_CONTENT), 0.0001, 1,
+                     [1, 3], ',', True)
+        self.blooms = [
+            (name, load_bloom_filter(name))
+            for name in ('/tmp/fake.csv.1.bfindex', '/tmp/fake.csv.3.bfindex')]
+
+    def tearDown(self):
+        for tmpfile in glob.glob('/tmp/fake.csv.*.bfindex'):
+            os.unlink(tmpfile)
+
+    def test_hits_and_misses(self):
+        out = StringIO()
+        result = query_indexes(
+            self.blooms, StringIO('apple\nco.uk\ncarrot\n'), out)
+        self.assertEqual((3, 2), result)
+        self.assertEqual(
+            'hit\tapple\t/tmp/fake.csv.1.bfindex\n'
+            'hit\tco.uk\t/tmp/fake.csv.3.bfindex\n'
+            'miss\tcarrot\n',
+            out.getvalue())
+
+    def test_recursive_domains_and_small_batches(self):
+        out = StringIO()
+        result = query_indexes(
+            self.blooms[1:], StringIO('mail.yahoo.com\n'), out,
+            batch_size=2, recursive_domains=True, misses_only=True)
+        self.assertEqual((3, 2), result)
+        self.assertEqual('miss\tmail.yahoo.com\n', out.getvalue())
+
+
+class ServerTest(unittest.TestCase):
+    def setUp(self):
+        create_index('/tmp/fake.csv', StringIO(TEST_FILE_CONTENT), 0.0001, 1,
+                     [1, 3], ',', True)
+        self.indexes = IndexSet(['/tmp/fake.csv.1.bfindex',
+                                 '/tmp/fake.csv.3.bfindex'])
+        self.server = create_server(self.indexes, '/tmp/fake.sock', 0,
+                                    recursive_domains=True)
+        thread = threading.Thread(target=self.server.serve_forever,
+                                  args=(0.05,))
+        thread.daemon = True
+        thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        for tmpfile in glob.glob('/tmp/fake.csv*') + ['/tmp/fake.sock']:
+            os.unlink(tmpfile)
+
+    def query(self, text):
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        client.connect('/tmp/fake.sock')
+        client.sendall(text)
+        client.shutdown(socket.SHUT_WR)
+        answer = ''.join(iter(lambda: client.recv(4096), ''))
+        client.close()
+        return answer
+
+    def test_arguments(self):
+        config = bloom_server.parse_arguments(
+            ['fake.py', '-b/tmp/fake.csv.1.bfindex', '-u/tmp/fake2.sock',
+             '--normalize=case,space', '-H'])
+        self.assertEqual({'indexes': ['/tmp/fake.csv.1.bfindex'],
+                          'socket': '/tmp/fake2.sock', 'port': 0,
+                          'reload-interval': 1.0, 'columns': [],
+                          'index-domains-recursively': False,
+                          'hits-only': True, 'misses-only': False,
+                          'normalize': ['space', 'case']}, config)
+        self.assertRaises(InvalidArgument, lambda: bloom_server.
+                          parse_arguments(['fake.py', '-p8015',
+                                           '-b/tmp/fake.csv.1.bfindex',
+                                           '--normalize=upper']))
+
+        (argv, stderr) = (sys.argv, sys.stderr)
+        sys.argv = ['fake.py', '--help']
+        sys.stderr = StringIO()
+        try:
+            with self.assertRaises(SystemExit) as context:
+                bloom_server.main()
+            self.assertTrue('--normalize' in sys.stderr.getvalue())
+        finally:
+            (sys.argv, sys.stderr) = (argv, stderr)
+        self.assertEqual(0, context.exception.code)
+
+    def test_pipelined_batches(self):
+        answer = self.query('apple\ncarrot\n\nmail.yahoo.com\n\n')
+        self.assertEqual(
+            'hit\tapple\t/tmp/fake.csv.1.bfindex\n'
+            'miss\tcarrot\n'
+            '\n'
+            'miss\tmail.yahoo.com\n'
+            'hit\tyahoo.com\t/tmp/fake.csv.3.bfindex\n'
+            'hit\tcom\t/tmp/fake.csv.3.bfindex\n'
+            '\n',
+            answer)
+
+    def test_reload_rebuilt_index(self):
+        old_blooms = self.indexes.blooms
+        create_index('/tmp/fake.csv.new', StringIO('Fruit\ncarrot\n'),
+                     0.0001, 1, [1], ',', False)
+        os.rename('/tmp/fake.csv.new.1.bfindex', '/tmp/fake.csv.1.bfindex')
+
+        # A change is only loaded once it has been seen twice.
+        self.assertEqual([], self.indexes.reload_changed())
+        self.assertEqual(['/tmp/fake.csv.1.bfindex'],
+                         self.indexes.reload_changed())
+        self.assertEqual([], self.indexes.reload_changed())
+        self.assertEqual(old_blooms[1], self.indexes.blooms[1])
+        self.assertTrue('apple' in old_blooms[0][1])
+
+        answer = self.query('apple\ncarrot\n\n')
+        self.assertEqual('miss\tapple\n'
+                         'hit\tcarrot\t/tmp/fake.csv.1.bfindex\n\n', answer)
+
+    def test_keeps_filter_when_reload_fails(self):
+        with open('/tmp/fake.csv.3.bfindex', 'r+b') as f:
+            f.truncate(10)
+        self.indexes.reload_changed()
+        self.assertEqual([], self.indexes.reload_changed())
+        self.assertEqual('hit\tco.uk\t/tmp/fake.csv.3.bfindex\n'
+                         'hit\tuk\t/tmp/fake.csv.3.bfindex\n\n',
+                         self.query('co.uk\n\n'))
+
+
+class CompressedInputTest(unittest.TestCase):
+    def setUp(self):
+        self.config = parse_arguments(['fake.py', '-i/etc/profile', '-d,',
+                                       '-f1'])
+        self.config['infile'] = '/tmp/fake.csv'
+
+    def tearDown(self):
+        for tmpfile in glob.glob('/tmp/fake.csv*'):
+            os.unlink(tmpfile)
+
+    def test_gzip_and_bz2_input(self):
+        for (name, opener) in (('gzip', gzip.GzipFile), ('bz2', bz2.BZ2File)):
+            f = opener('/tmp/fake.csv', 'wb')
+            f.write(TEST_FILE_CONTENT)
+            f.close()
+            self.assertEqual(name, detect_compression('/tmp/fake.csv'))
+
+            for (streaming, parser) in ((False, 'csv'), (True, 'fast')):
+                self.config['streaming'] = streaming
+                self.config['parser'] = parser
+                self.assertEqual({'/tmp/fake.csv.1.bfindex': 5},
+                                 open_and_create(self.config))
+                b = load_filter('/tmp/fake.csv.1.bfindex')
+                self.assertTrue('pineapple' in b)
+
+    def test_reader_with_small_blocks(self):
+        f = gzip.GzipFile('/tmp/fake.csv', 'wb')
+        f.write(TEST_FILE_CONTENT)
+        f.close()
+        reader = DecompressingReader('/tmp/fake.csv', 'gzip', block_size=5,
+                                     queue_blocks=1)
+        self.assertEqual(TEST_FILE_CONTENT.splitlines(True), list(reader))
+        reader.seek(0)
+        self.assertEqual(TEST_FILE_CONTENT[:12], reader.read(12))
+        reader.close()  # with the background thread blocked on the queue
+        reader.seek(0)
+        self.assertEqual(TEST_FILE_CONTENT, reader.read())
+        reader.close()
+
+    def test_compressed_input_with_jobs(self):
+        f = bz2.BZ2File('/tmp/fake.csv', 'wb')
+        f.write(TEST_FILE_CONTENT)
+        f.close()
+        self.config['jobs'] = 2
+        self.assertEqual({'/tmp/fake.csv.1.bfindex': 5},
+                         open_and_create(self.config))
+
+    @unittest.skipIf(compression.lzma is not None, "lzma is installed")
+    def test_xz_without_lzma(self):
+        with open('/tmp/fake.csv', 'wb') as f:
+            f.write('\xfd7zXZ\x00junk')
+        self.assertEqual('xz', detect_compression('/tmp/fake.csv'))
+        self.assertRaises(InvalidArgument,
+                          lambda: open_and_create(self.config))
+
+
+class MultiFileIndexTest(unittest.TestCase):
+    def setUp(self):
+        rows = TEST_FILE_CONTENT.splitlines(True)
+        (header, rows) = (rows[0], rows[1:])
+        for (i, shard) in enumerate((rows[:2], rows[2:4], rows[4:])):
+            with open('/tmp/fake-shard-%d.csv' % i, 'wb') as f:
+                f.write(header + ''.join(shard))
+        f = gzip.GzipFile('/tmp/fake-shard-3.csv.gz', 'wb')
+        f.write(header + 'kiwi,kale,example.domain.com\n')
+        f.close()
+
+    def tearDown(self):
+        for tmpfile in glob.glob('/tmp/fake-shard-*') + \
+                glob.glob('/tmp/fake-merged.*'):
+            os.unlink(tmpfile)
+
+    def check_merged_index(self, result):
+        self.assertEqual({'/tmp/fake-merged.1.bfindex': 6,
+                          '/tmp/fake-merged.3.bfindex': 9}, result)
+        b1 = load_filter('/tmp/fake-merged.1.bfindex')
+        b3 = load_filter('/tmp/fake-merged.3.bfindex')
+        for word in ('apple', 'banana', 'orange', 'pear', 'pineapple',
+                     'kiwi'):
+            self.assertTrue(word in b1)
+        for word in ('subdomain.yahoo.com', 'co.uk', 'example.domain.com'):
+            self.assertTrue(word in b3)
+        self.assertFalse('FieldA' in b1)
+
+    def test_glob_input(self):
+        for jobs in ('1', '3'):
+            config = parse_arguments([
+                'fake.py', '--infile=/tmp/fake-shard-*', '-o/tmp/fake-merged',
+                '-f1,3', '-d,', '-r', '-j' + jobs])
+            self.check_merged_index(open_and_create(config))
+
+    def test_workers_count_rows_and_values(self):
+        infiles = sorted(glob.glob('/tmp/fake-shard-*'))
+        for jobs in (1, 3):
+            stats = BuildStats()
+            create_multi_file_index(infiles, '/tmp/fake-merged', 0.0001, 1,
+                                    [1, 3], ',', True, jobs, stats=stats)
+            metrics = stats.as_dict()
+            self.assertEqual(7, metrics['rows_read'])
+            self.assertEqual((7, 1), (metrics['columns'][1]['values'],
+                                      metrics['columns'][1]['empty_values']))
+            self.assertEqual(4, metrics['columns'][3]['domains_expanded'])
+            self.assertEqual(6, metrics['columns'][1]['entries'])
+
+    def test_file_list_input(self):
+        with open('/tmp/fake-shard-list', 'wb') as f:
+            f.write('\n'.join(sorted(glob.glob('/tmp/fake-shard-*.csv*'))))
+        config = parse_arguments([
+            'fake.py', '--file-list=/tmp/fake-shard-list',
+            '--output=/tmp/fake-merged', '-f1,3', '-d,', '-r', '-Pfast'])
+        self.check_merged_index(open_and_create(config))
+
+    def test_several_files_need_output(self):
+        config = parse_arguments(['fake.py', '-i/tmp/fake-shard-*', '-d,'])
+        self.assertRaises(InvalidArgument,
+                          lambda: open_and_create(config))
+
+
+class FastParserTest(unittest.TestCase):
+    def parse_both(self, content, limit_fields, recursive_domains=False,
+                   skip_lines=1):
+        results = []
+        for parser in ('csv', 'fast'):
+            results.append(parse_csv_file(
+                StringIO(content), ',', recursive_domains, limit_fields,
+                skip_lines, parser=parser))
+        return results
+
+    def test_matches_csv_parser(self):
+        for limit_fields in ([], [1], [3, 1], [2, 2]):
+            for recursive_domains in (False, True):
+                (expected, result) = self.parse_both(
+                    TEST_FILE_CONTENT, limit_fields, recursive_domains)
+                self.assertEqual(expected, result)
+
+    def test_small_buffers_and_line_endings(self):
+        rand = random.Random(1)
+        lines = ['%s,%s.com,%d' % (rand.choice('abc'), rand.choice('xyz'), i)
+                 for i in range(200)]
+        for content in ('h\n' + '\n'.join(lines),
+                        'h\r\n' + '\r\n'.join(lines) + '\r\n'):
+            expected = parse_csv_file(StringIO(content), ',', True, [2, 3], 1)
+            for buffer_size in (1, 7, 100):
+                data = {}
+                for (column_number, values) in iter_delimited_columns(
+                        StringIO(content), ',', True, [2, 3], 1,
+                        buffer_size=buffer_size):
+                    data.setdefault(column_number, []).extend(values)
+                self.assertEqual(expected, data)
+
+    def test_ragged_and_empty_rows(self):
+        content = 'h\na,b\nc\n\nd,e,f\n'
+        (expected, result) = self.parse_both(content, [])
+        self.assertEqual(expected, result)
+        self.assertRaises(InvalidArgument,
+                          lambda: self.parse_both(content, [1]))
+
+        (expected, result) = self.parse_both('h\na,b\nc,d,e\n', [2])
+        self.assertEqual(expected, result)
+
+    def test_falls_back_to_csv_for_quotes(self):
+        content = TEST_FILE_CONTENT + '|kiwi,lime|,|bok\nchoy|,x.com\n'
+        (expected, result) = self.parse_both(content, [1, 2])
+        self.assertEqual(expected, result)
+        self.assertTrue('kiwi,lime' in result[1])
+        self.assertTrue('bok\nchoy' in result[2])
+
+    def test_parallel_build_with_fast_parser(self):
+        with open('/tmp/fake.csv', 'wb') as f:
+            f.write(TEST_FILE_CONTENT)
+        try:
+            result = create_parallel_index('/tmp/fake.csv', 0.0001, 1, [1],
+                                           ',', False, 2, parser='fast')
+            self.assertEqual({'/tmp/fake.csv.1.bfindex': 5}, result)
+        finally:
+            for tmpfile in glob.glob('/tmp/fake.csv*'):
+                os.unlink(tmpfile)
+
+
+class IsDomainTest(unittest.TestCase):
+    def test_matches_tld_alternation_regex(self):
+        tlds = load_tld_file(TLD_FILE)
+        domain_re = re.compile(
+            r'^([A-Z0-9\-\.]+\.(' + '|'.join(tlds) + r'))$', re.IGNORECASE)
+
+        rand = random.Random(0)
+        values = ['..com', '.com', 'a.com\n', 'a.com\n\n', 'a.com ', 'com',
+                  'xn--p1ai.XN--P1AI', u'a.com', u'\xe9.com']
+        values.extend(''.join(rand.choice('acmoukzA.-_ 9\n')
+                              for i in range(rand.randint(0, 10)))
+                      for j in range(20000))
+
+        expected = [domain_re.match(value) is not None for value in values]
+        self.assertEqual(expected, [is_domain(value) for value in values])
+        self.assertEqual(expected, is_domain_many(values))
+
+    def test_custom_tld_file(self):
+        with open('/tmp/fake.tlds', 'wb') as f:
+            f.write('# comment\nbob\n\n')
+        try:
+            tlds = load_tld_file('/tmp/fake.tlds')
+        finally:
+            os.unlink('/tmp/fake.tlds')
+        self.assertEqual(frozenset(['BOB']), tlds)
+        self.assertEqual([True, False],
+                         is_domain_many(['www.google.bob', 'google.com'], tlds))
+
+
+class DomainExpanderTest(unittest.TestCase):
+    def test_small_cache_produces_every_sub_part(self):
+        rand = random.Random(0)
+        domains = ['%s.%s.%s' % (rand.choice('abcdefgh'), rand.choice('ijk'),
+                                 rand.choice(['com', 'co.uk', 'org']))
+                   for i in range(500)]
+        expected = []
+        for domain in domains:
+            expected.extend(recurse_domain(domain))
+
+        expander = DomainExpander(max_size=4)
+        produced = []
+        for domain in domains:
+            produced.extend(expander.expand(domain))
+        self.assertEqual(set(expected), set(produced))
+        self.assertTrue(len(produced) < len(expected))
+
+
+class BenchmarkTest(unittest.TestCase):
+    def test_generated_csv_is_deterministic(self):
+        (first, second) = (StringIO(), StringIO())
+        for out in (first, second):
+            generate_csv(out, 50, 3, 10, 0.5, 16, seed=7)
+        self.assertEqual(first.getvalue(), second.getvalue())
+
+        rows = first.getvalue().splitlines()
+        self.assertEqual(51, len(rows))
+        values = set(value for row in rows[1:] for value in row.split(';'))
+        self.assertTrue(len(values) <= 30)
+        self.assertTrue(any(value.startswith('www.') for value in values))
+
+    def test_run_scenario_times_each_stage(self):
+        result = run_scenario({'name': 'tiny', 'rows': 100, 'columns': 2,
+                               'cardinality': 20, 'domain_ratio': 0.5,
+                               'value_length': 12})
+        self.assertEqual(sorted(STAGES), sorted(result['stages']))
+        self.assertTrue(sum(result['stages'].values()) <= result['seconds'])
+        self.assertTrue(result['rows_per_second'] > 0)
+        self.assertTrue(result['peak_rss_kb'] > 0)
+
+
+class StatsTest(unittest.TestCase):
+    def tearDown(self):
+        for tmpfile in glob.glob('/tmp/fake.csv.*.bfindex'):
+            os.unlink(tmpfile)
+
+    def test_in_memory_build_metrics(self):
+        stats = BuildStats()
+        create_index('/tmp/fake.csv', StringIO(TEST_FILE_CONTENT), 0.0001, 1,
+                     [1, 3], ',', True, stats=stats)
+        metrics = json.loads(json.dumps(stats.as_dict()))
+
+        self.assertEqual(6, metrics['rows_read'])
+        self.assertEqual(['dedup', 'expand', 'insert', 'parse', 'write'],
+                         sorted(metrics['stages']))
+        self.assertTrue(all(seconds >= 0
+                            for seconds in metrics['stages'].values()))
+        column = metrics['columns']['1']
+        self.assertEqual((6, 1, 5, 0), (
+            column['values'], column['empty_values'],
+            column['distinct_values'], column['duplicates_dropped']))
+
+        column = metrics['columns']['3']
+        self.assertEqual((3, 1, 9), (
+            column['domains_expanded'], column['sub_parts_skipped'],
+            column['entries']))
+        self.assertTrue(0 < column['bits_set'] < column['bits'])
+        self.assertTrue(0 < column['fill_ratio'] < 1)
+        self.assertTrue(column['estimated_false_positive_rate'] < 0.0001)
+
+    def test_write_stage_waits_for_background_writes(self):
+        class SlowFilter(object):
+            count = capacity = 1
+
+            def tofile(self, f):
+                time.sleep(0.2)
+                f.write('slow')
+
+        for container in (False, True):
+            stats = BuildStats()
+            with open_index_writer('/tmp/fake.csv', [1], container,
+                                   stats) as writer:
+                with stats.timer('write'):
+                    writer.write(1, SlowFilter())
+            self.assertTrue(stats.stages['write'] >= 0.2)
+        os.unlink('/tmp/fake.csv.bfpack')
+
+    def test_streaming_build_metrics(self):
+        stats = BuildStats()
+        create_streaming_index('/tmp/fake.csv', StringIO(TEST_FILE_CONTENT),
+                               0.0001, 1, [1], ',', False, stats=stats)
+        metrics = stats.as_dict()
+
+        self.assertEqual(6, metrics['rows_read'])
+        self.assertEqual(['insert', 'sketch', 'write'],
+                         sorted(metrics['stages']))
+        self.assertEqual(6, metrics['columns'][1]['values'])
+        self.assertEqual(5, metrics['columns'][1]['entries'])
+
+    def test_text_output(self):
+        stats = BuildStats()
+        create_index('/tmp/fake.csv', StringIO(TEST_FILE_CONTENT), 0.0001, 1,
+                     [2], ',', False, stats=stats)
+        out = StringIO()
+        stats.write('text', out)
+        self.assertTrue('rows_read: 6\n' in out.getvalue())
+        self.assertTrue('column.2.entries: 6\n' in out.getvalue())
+
+
 class ParseArgumentsTest(unittest.TestCase):
     def test_long_version(self):
         config = parse_arguments([
@@ -131,7 +1674,25 @@ class ParseArgumentsTest(unittest.TestCase):
              'fields': [2, 6],
              'index-domains-recursively': True,
              'infile': '/etc/profile',
-             'skip-lines': 3},
+             'file-list': '',
+             'output': '',
+             'skip-lines': 3,
+             'streaming': False,
+             'engine': 'pybloom',
+             'jobs': 1,
+             'append': False,
+             'incremental': False,
+             'stats': '',
+             'parser': 'csv',
+             'filter-type': 'bloom',
+             'plan': False,
+             'composite': [],
+             'container': False,
+             'shards': 1,
+             'shard': [],
+             'normalize': [],
+             'generations': 0,
+             'bucket': 86400},
             config)
 
     def test_short_version(self):
@@ -149,7 +1710,25 @@ class ParseArgumentsTest(unittest.TestCase):
              'fields': [2, 6],
              'index-domains-recursively': True,
              'infile': '/etc/profile',
-             'skip-lines': 3},
+             'file-list': '',
+             'output': '',
+             'skip-lines': 3,
+             'streaming': False,
+             'engine': 'pybloom',
+             'jobs': 1,
+             'append': False,
+             'incremental': False,
+             'stats': '',
+             'parser': 'csv',
+             'filter-type': 'bloom',
+             'plan': False,
+             'composite': [],
+             'container': False,
+             'shards': 1,
+             'shard': [],
+             'normalize': [],
+             'generations': 0,
+             'bucket': 86400},
             config)
 
     def test_missing_infile(self):
@@ -173,13 +1752,53 @@ class ParseArgumentsTest(unittest.TestCase):
              'fields': [],  # meaning all
              'index-domains-recursively': False,
              'infile': '/etc/profile',
-             'skip-lines': 1},
+             'file-list': '',
+             'output': '',
+             'skip-lines': 1,
+             'streaming': False,
+             'engine': 'pybloom',
+             'jobs': 1,
+             'append': False,
+             'incremental': False,
+             'stats': '',
+             'parser': 'csv',
+             'filter-type': 'bloom',
+             'plan': False,
+             'composite': [],
+             'container': False,
+             'shards': 1,
+             'shard': [],
+             'normalize': [],
+             'generations': 0,
+             'bucket': 86400},
             config)
 
 if __name__ == '__main__':
     import doctest
     import bloom_indexer
-    if doctest.testmod(bloom_indexer).failed > 0:
-        import sys
-        sys.exit(1)
+    import bloom_query
+    import bloom_server
+    import cardinality
+    import bfindex
+    import checkpoint
+    import isdomain
+    import benchmark
+    import build_stats
+    import filter_file
+    import index_container
+    import shards
+    import generations
+    import pipeline
+    import normalize
+    modules = [bloom_indexer, bloom_query, bloom_server, cardinality, bfindex,
+               checkpoint, isdomain, benchmark, build_stats, compression,
+               filter_file, planner, index_container, shards, pipeline,
+               normalize, generations]
+    if numpy_bloom is not None:
+        modules.extend([numpy_bloom, blocked_bloom, fingerprint_filters,
+                        bloom_combine])
+    for module in modules:
+        if doctest.testmod(module).failed > 0:
+            import sys
+            sys.exit(1)
     unittest.main()